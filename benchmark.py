@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# ly2video - generate performances video from LilyPond source files
+# Copyright (C) 2012 Jiri "FireTight" Szabo
+# Copyright (C) 2012 Adam Spiers
+# Copyright (C) 2014 Emmanuel Leguy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For more information about this program, please visit
+# <https://github.com/aspiers/ly2video/>.
+
+"""
+Micro-benchmarks of the per-frame rendering steps.  Every benchmark
+prints the average time it takes to render a single 1080p frame.
+
+Usage: python benchmark.py [NAME...]
+"""
+
+import sys
+import timeit
+
+from ly2video.video import *
+from PIL import Image
+
+WIDTH, HEIGHT = 1920, 1080
+REPEAT = 200
+
+def benchCopy(frame):
+    # baseline: every cursor is drawn on a fresh copy of the frame
+    frame.copy()
+
+def benchCursorLine(frame):
+    writeCursorLine(frame.copy(), 960, (255,0,0))
+
+def benchCursorLine_antiAliased(frame):
+    writeCursorLine(frame.copy(), 960.25, (255,0,0,160))
+
+def benchMeasureCursor(frame):
+    writeMeasureCursor(frame.copy(), 400, 1500, (255,0,0))
+
+def benchMeasureCursor_antiAliased(frame):
+    writeMeasureCursor(frame.copy(), 400.5, 1500.5, (255,0,0,160))
+
+SCORE_WIDTH = 100000
+BOX = (0, 0, WIDTH, HEIGHT)
+scoreImages = {}
+
+def getScoreImage(scrollNotes, mode = "RGB"):
+    """Returns a ScoreImage of a score SCORE_WIDTH pixels wide."""
+    if (scrollNotes, mode) not in scoreImages:
+        picture = Image.new("RGB", (SCORE_WIDTH, HEIGHT + 200),
+                            (255,255,255))
+        for y in xrange(HEIGHT / 2, HEIGHT / 2 + 50, 10):
+            picture.paste((0,0,0), (0, y, SCORE_WIDTH, y + 1))
+        notes = range(WIDTH, SCORE_WIDTH - WIDTH, 100)
+        scoreImage = ScoreImage(WIDTH, HEIGHT, convertScore(picture, mode),
+                                notes, [], scrollNotes=scrollNotes)
+        # detect the margins and staff lines outside of the benchmark
+        scoreImage.makeFrame(0, 1)
+        scoreImages[scrollNotes, mode] = scoreImage
+    return scoreImages[scrollNotes, mode]
+
+def benchScoreImage_scrollNotes(frame):
+    getScoreImage(True).paintFrame(frame, BOX, 0, 1)
+
+def benchScoreImage_scrollCursor(frame):
+    getScoreImage(False).paintFrame(frame, BOX, 0, 1)
+
+def benchScoreImage_scrollNotes_grayscale(frame):
+    getScoreImage(True, "L").paintFrame(frame, BOX, 0, 1)
+
+def benchScoreImage_scrollNotes_1bit(frame):
+    getScoreImage(True, "1").paintFrame(frame, BOX, 0, 1)
+
+def benchScoreImage_scrollCursor_grayscale(frame):
+    getScoreImage(False, "L").paintFrame(frame, BOX, 0, 1)
+
+BENCHMARKS = [
+    benchCopy,
+    benchCursorLine,
+    benchCursorLine_antiAliased,
+    benchMeasureCursor,
+    benchMeasureCursor_antiAliased,
+    benchScoreImage_scrollNotes,
+    benchScoreImage_scrollCursor,
+    benchScoreImage_scrollNotes_grayscale,
+    benchScoreImage_scrollNotes_1bit,
+    benchScoreImage_scrollCursor_grayscale,
+]
+
+def main():
+    names = sys.argv[1:]
+    frame = Image.new("RGB", (WIDTH, HEIGHT), (255,255,255))
+    for bench in BENCHMARKS:
+        if names and bench.__name__ not in names:
+            continue
+        bench(frame) # warm up
+        secs = timeit.timeit(lambda: bench(frame), number=REPEAT)
+        print "%-40s %8.3f ms/frame" % (bench.__name__,
+                                        secs * 1000.0 / REPEAT)
+
+if __name__ == "__main__":
+    main()
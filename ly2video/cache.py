@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# ly2video - generate performances video from LilyPond source files
+# Copyright (C) 2012 Jiri "FireTight" Szabo
+# Copyright (C) 2012 Adam Spiers
+# Copyright (C) 2014 Emmanuel Leguy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For more information about this program, please visit
+# <https://github.com/aspiers/ly2video/>.
+
+from utils import *
+from ly2video.ly.parse import findIncludeFiles
+import hashlib
+import os
+import shutil
+
+
+def defaultCacheDir():
+    """
+    Returns the directory of the ly2video cache, as per the XDG Base
+    Directory Specification.
+    """
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cacheHome, "ly2video")
+
+
+class RenderCache(object):
+
+    """
+    Persistent cache of the outputs of LilyPond runs: the files it
+    generated and what it printed.  Entries are keyed by a hash of
+    the LilyPond source, of every file it includes, and of anything
+    else the output depends on (LilyPond version, resolution...).
+
+    Every entry is a directory named after its key.  The least
+    recently used entries are evicted when the cache grows bigger
+    than its maximum size.
+    """
+
+    OUTPUT_FILE = "output.txt"
+
+    def __init__(self, cacheDir, maxSize):
+        """
+        Params:
+          - cacheDir:          directory holding the cache entries
+          - maxSize:           maximum size of the cache in bytes
+        """
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    def key(self, lyFileName, includePath, *params):
+        """
+        Returns the key of the output of LilyPond for the given file,
+        looking for included files in the given list of directories.
+        The key doesn't depend on where these directories are.
+        """
+        sha = hashlib.sha1()
+        for param in params:
+            sha.update(repr(param) + "\0")
+        bases = [os.path.dirname(lyFileName)] + list(includePath)
+        fileNames = findIncludeFiles(lyFileName, includePath)
+        for name, fileName in sorted((self.__relativeName(fileName, bases),
+                                      fileName) for fileName in fileNames):
+            # the temporary file itself is anywhere, but where the
+            # included files are matters
+            if fileName != lyFileName:
+                if isinstance(name, unicode):
+                    name = name.encode("utf-8")
+                sha.update(name + "\0")
+            with open(fileName, "rb") as f:
+                sha.update(hashlib.sha1(f.read()).hexdigest())
+        return sha.hexdigest()
+
+    @staticmethod
+    def __relativeName(fileName, bases):
+        """
+        Returns the name of the given included file relative to the
+        first of the given directories it is in, along with the index
+        of that directory, or its absolute name if it is in none.
+        """
+        for i, base in enumerate(bases):
+            name = os.path.relpath(fileName, base)
+            if name != os.pardir and \
+               not name.startswith(os.pardir + os.sep):
+                return "%d:%s" % (i, name)
+        return os.path.abspath(fileName)
+
+    def __entryDir(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def __newDir(self, key):
+        # entries are built aside so that they appear all at once
+        return "%s.%d.tmp" % (self.__entryDir(key), os.getpid())
+
+    def fetch(self, key, destDir):
+        """
+        Copies the files of the given entry into destDir and returns
+        the output of LilyPond, or returns None if there is no such
+        entry.
+        """
+        entryDir = self.__entryDir(key)
+        if not os.path.isdir(entryDir):
+            return None
+        try:
+            for fileName in os.listdir(entryDir):
+                if fileName != self.OUTPUT_FILE:
+                    shutil.copy(os.path.join(entryDir, fileName), destDir)
+            with open(os.path.join(entryDir, self.OUTPUT_FILE)) as f:
+                output = f.read()
+            # mark the entry as recently used
+            os.utime(entryDir, None)
+        except (IOError, OSError) as e:
+            warn("Ignoring broken cache entry %s: %s" % (entryDir, e))
+            return None
+        return output
+
+    def begin(self, key):
+        """
+        Starts building the given entry, and returns the file which
+        the output of LilyPond is to be written into while it is
+        printed, or None if the entry can't be built.  The entry only
+        appears once store() is called, and discard() drops it.
+        """
+        newDir = self.__newDir(key)
+        try:
+            if os.path.isdir(newDir):
+                shutil.rmtree(newDir)
+            os.makedirs(newDir)
+            return open(os.path.join(newDir, self.OUTPUT_FILE), "w")
+        except (IOError, OSError) as e:
+            warn("Failed to store LilyPond output in cache %s: %s" %
+                 (self.cacheDir, e))
+            shutil.rmtree(newDir, ignore_errors=True)
+            return None
+
+    def discard(self, key):
+        """
+        Drops the entry started by begin().
+        """
+        shutil.rmtree(self.__newDir(key), ignore_errors=True)
+
+    def store(self, key, srcDir, fileNames, output=None):
+        """
+        Stores the given files from srcDir and the output of LilyPond
+        as the given entry, then evicts old entries if needed.  If the
+        output is None, it was already written by the entry started by
+        begin().
+        """
+        entryDir = self.__entryDir(key)
+        newDir = self.__newDir(key)
+        try:
+            if output is not None:
+                f = self.begin(key)
+                if f is None:
+                    return
+                with f:
+                    f.write(output)
+            for fileName in fileNames:
+                shutil.copy(os.path.join(srcDir, fileName), newDir)
+            if os.path.isdir(entryDir):
+                shutil.rmtree(entryDir)
+            os.rename(newDir, entryDir)
+        except (IOError, OSError) as e:
+            warn("Failed to store LilyPond output in cache %s: %s" %
+                 (self.cacheDir, e))
+            shutil.rmtree(newDir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no
+        bigger than its maximum size.
+        """
+        entries = []
+        totalSize = 0
+        for name in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, name)
+            if not os.path.isdir(entryDir) or name.endswith(".tmp"):
+                continue
+            size = sum(os.path.getsize(os.path.join(entryDir, fileName))
+                       for fileName in os.listdir(entryDir))
+            entries.append((os.path.getmtime(entryDir), size, entryDir))
+            totalSize += size
+        entries.sort()
+        while entries and totalSize > self.maxSize:
+            mtime, size, entryDir = entries.pop(0)
+            debug("Evicting %s from cache" % entryDir)
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalSize -= size
@@ -25,8 +25,10 @@
 # Used to determine --version output for released versions, not
 # when running from a git check-out:
 
+import array
 import collections
 import copy
+import multiprocessing
 import os
 import re
 import shutil
@@ -37,12 +39,13 @@ import pipes
 from collections import namedtuple
 from distutils.version import StrictVersion
 from argparse import ArgumentParser
-from struct import pack
 
 from PIL import Image, ImageDraw, ImageFont
 from ly2video.ly.tokenize import MusicTokenizer, Tokenizer
 import ly2video.ly.tools
 import midi
+from ly2video.cache import RenderCache, defaultCacheDir
+import ly2video.filters
 from ly2video.utils import *
 from ly2video.video import *
 
@@ -199,132 +202,211 @@ def preprocessLyFile(lyFile, lilypondVersion, dumper):
     return newLyFile
 
 
-def runLilyPond(lyFileName, dpi, *args):
+def runLilyPond(lyFileName, dpi, parser, outputFile=None):
+    """
+    Runs LilyPond on the given file, handing every line of its output
+    over to the SpaceTimeParser as soon as it is printed, and writing
+    it into outputFile if given.  Returns the output, without the
+    lines taken by the parser.
+    """
     progress("Generating PNG and MIDI files ...")
     cmd = [
         "lilypond",
         "--png",
         "-I", runDir,
         "-dmidi-extension=midi",  # default on Windows is .mid
-        "-dresolution=%d" % dpi
-    ] + list(args) + [lyFileName]
+        "-dresolution=%d" % dpi,
+        lyFileName
+    ]
     output_divider_line()
     os.chdir(tmpPath())
-    output = safeRun(cmd, exitcode=9)
+    lines = []
+    def handleLine(line):
+        if outputFile is not None:
+            outputFile.write(line)
+        if not parser.feed(line):
+            lines.append(line)
+    safeRunLines(cmd, handleLine, exitcode=9)
     output_divider_line()
     progress("Generated PNG and MIDI files")
-    return output
+    return "".join(lines)
 
 
-def getLeftmostGrobsByMoment(output, dpi, leftPaperMarginPx):
+def runLilyPondCached(lyFileName, dpi, lilypondVersion, options, parser):
     """
-    Parse the ly2video data output by LilyPond, and return a
-    sorted list of (moment, xcoord) tuples where each X co-ordinate
-    corresponds to the left-most grob at that moment.
+    Runs LilyPond like runLilyPond(), unless the same source (and
+    the same included files) was already rendered by the same version
+    of LilyPond at the same resolution, in which case the PNG and MIDI
+    files are restored from the cache, and the parser is fed the
+    output saved with them.  Otherwise the output is written into the
+    new cache entry while it is printed.
     """
+    if options.noCache:
+        return runLilyPond(lyFileName, dpi, parser)
 
-    lines = output.split('\n')
+    cache = RenderCache(options.cacheDir, options.cacheSize * 1024 * 1024)
+    key = cache.key(lyFileName, [runDir], lilypondVersion, dpi)
+    os.chdir(tmpPath())
+    output = cache.fetch(key, tmpPath())
+    if output is not None:
+        progress("Reusing PNG and MIDI files from cache %s" % key)
+        lines = []
+        for line in output.splitlines(True):
+            if not parser.feed(line):
+                lines.append(line)
+        return "".join(lines)
+
+    outputFile = cache.begin(key)
+    if outputFile is None:
+        return runLilyPond(lyFileName, dpi, parser)
+    try:
+        with outputFile:
+            output = runLilyPond(lyFileName, dpi, parser, outputFile)
+    except:
+        cache.discard(key)
+        raise
+    base = os.path.splitext(os.path.basename(lyFileName))[0]
+    fileNames = [fileName for fileName in os.listdir(tmpPath())
+                 if fileName.startswith(base) and
+                 os.path.splitext(fileName)[1] in (".png", ".midi")]
+    # Don't cache failures, so that they are reported again.
+    if base + ".png" in fileNames:
+        cache.store(key, tmpPath(), fileNames)
+    else:
+        cache.discard(key)
+    return output
 
-    leftmostGrobs = {}
-    currentLySrcFile = None
 
-    for line in lines:
-        if not line.startswith('ly2video: '):
-            continue
+GROB_LINE_RE = re.compile(
+    '^ly2video:\\s+'
+    # X-extents
+    '\\(\\s*(-?\\d+\\.\\d+),\\s*(-?\\d+\\.\\d+)\\s*\\)'
+    # delimiter
+    '\\s+@\\s+'
+    # moment
+    '(-?\\d+\\.\\d+)'
+    # delimiter
+    '\\s+from\\s+'
+    # file:line:char
+    '([^:]+): *(\\d+):(\\d+)'
+    '$')
+
+BAR_LINE_RE = re.compile(
+    '^ly2videoBar:\\s+'
+    # X-extents
+    '\\(\\s*(-?\\d+\\.\\d+),\\s*(-?\\d+\\.\\d+)\\s*\\)'
+    # delimiter
+    '\\s+@\\s+'
+    # moment
+    '(-?\\d+\\.\\d+)'
+    '$')
+
+
+class SpaceTimeParser(object):
+    """
+    Parses the ly2video data output by LilyPond one line at a time,
+    as it is printed.  Only the left-most grob of every moment and the
+    position of every bar line are kept, in arrays rather than objects,
+    since large scores print hundreds of thousands of lines.
+    """
+
+    def __init__(self, dpi, leftPaperMarginPx):
+        self.dpi = dpi
+        self.leftPaperMarginPx = leftPaperMarginPx
+        # slot of every moment in the arrays below
+        self.__slots = {}
+        self.__xs = array.array('l')
+        self.__files = array.array('l')
+        self.__lines = array.array('l')
+        self.__columns = array.array('l')
+        # source files by number, and their numbers
+        self.__fileNames = []
+        self.__fileNums = {}
+        self.__bars = set()
+
+    def __xcoord(self, left, right):
+        centre = (float(left) + float(right)) / 2
+        return int(round(staffSpacesToPixels(centre, self.dpi))) + \
+            self.leftPaperMarginPx
+
+    def feed(self, line):
+        """
+        Parses a line of the output of LilyPond, and returns whether it
+        was ly2video data.
+        """
+        if line.startswith('ly2video: '):
+            self.__feedGrob(line.rstrip('\r\n'))
+        elif line.startswith('ly2videoBar: '):
+            self.__feedBar(line.rstrip('\r\n'))
+        else:
+            return False
+        return True
 
-        m = re.match('^ly2video:\\s+'
-                     # X-extents
-                     '\\(\\s*(-?\\d+\\.\\d+),\\s*(-?\\d+\\.\\d+)\\s*\\)'
-                     # delimiter
-                     '\\s+@\\s+'
-                     # moment
-                     '(-?\\d+\\.\\d+)'
-                     # delimiter
-                     '\\s+from\\s+'
-                     # file:line:char
-                     '([^:]+): *(\d+):(\d+)'
-                     '$', line)
+    def __feedGrob(self, line):
+        m = GROB_LINE_RE.match(line)
         if not m:
             bug("Failed to parse ly2video line:\n%s" % line)
-        left, right, moment, filename, line, column = m.groups()
-
-        if currentLySrcFile is None or currentLySrcFile != filename:
-            currentLySrcFile = filename
-            debug("Current .ly source file: %s" % currentLySrcFile)
+        left, right, moment, filename, lineNum, column = m.groups()
 
-        left   = float(left)
-        right  = float(right)
-        centre = (left + right) / 2
+        x = self.__xcoord(left, right)
         moment = float(moment)
-        line   = int(line) - 1  # LilyPond counts from 1
-        column = int(column)
-        x = int(round(staffSpacesToPixels(centre, dpi))) + leftPaperMarginPx
-
-        if moment not in leftmostGrobs or x < leftmostGrobs[moment][0]:
-            location = LySrcLocation(filename, line, column)
-            leftmostGrobs[moment] = [x, location]
-            debug("leftmost grob for moment %9f is now x =%5d @ %3d:%d"
-                  % (moment, x, line + 1, column))
-
-    groblist = [tuple([moment] + leftmostGrobs[moment])
-                for moment in sorted(leftmostGrobs.keys())]
-
-    if not groblist:
-        bug("Didn't find any notes; something must have gone wrong "
-            "with the use of dump-spacetime-info.")
-
-    return groblist
-
+        slot = self.__slots.get(moment)
+        if slot is not None and x >= self.__xs[slot]:
+            return
 
-def getMeasuresIndices(output, dpi, leftPaperMarginPx):
-    ret = []
-    ret.append(leftPaperMarginPx)
-    lines = output.split('\n')
+        fileNum = self.__fileNums.get(filename)
+        if fileNum is None:
+            fileNum = self.__fileNums[filename] = len(self.__fileNames)
+            self.__fileNames.append(filename)
+            debug("Current .ly source file: %s" % filename)
+        lineNum = int(lineNum) - 1  # LilyPond counts from 1
+        column = int(column)
 
-    for line in lines:
-        if not line.startswith('ly2videoBar: '):
-            continue
+        if slot is None:
+            self.__slots[moment] = len(self.__xs)
+            self.__xs.append(x)
+            self.__files.append(fileNum)
+            self.__lines.append(lineNum)
+            self.__columns.append(column)
+        else:
+            self.__xs[slot] = x
+            self.__files[slot] = fileNum
+            self.__lines[slot] = lineNum
+            self.__columns[slot] = column
 
-        m = re.match('^ly2videoBar:\\s+'
-                     # X-extents
-                     '\\(\\s*(-?\\d+\\.\\d+),\\s*(-?\\d+\\.\\d+)\\s*\\)'
-                     # delimiter
-                     '\\s+@\\s+'
-                     # moment
-                     '(-?\\d+\\.\\d+)'
-                     '$', line)
+    def __feedBar(self, line):
+        m = BAR_LINE_RE.match(line)
         if not m:
             bug("Failed to parse ly2video line:\n%s" % line)
         left, right, moment = m.groups()
-
-        left   = float(left)
-        right  = float(right)
-        centre = (left + right) / 2
-        moment = float(moment)
-        x = int(round(staffSpacesToPixels(centre, dpi))) + leftPaperMarginPx
-
-        if x not in ret:
-            ret.append(x)
-
-    ret.sort()
-    return ret
-
-
-def findStaffLines(imageFile, lineLength):
-    """
-    Takes a image and returns y co-ordinates of staff lines in pixels.
-
-    Params:
-      - imageFile:    filename of image containing staff lines
-      - lineLength:   required length of line for acceptance as staff line
-
-    Returns a list of y co-ordinates of staff lines.
-    """
-    progress("Looking for staff lines in %s" % imageFile)
-    image = Image.open(imageFile)
-
-    x, ys = findStaffLinesInImage(image, lineLength)
-    return ys
+        self.__bars.add(self.__xcoord(left, right))
+
+    def leftmostGrobs(self):
+        """
+        Returns a sorted list of (moment, xcoord, location) tuples
+        where each X co-ordinate corresponds to the left-most grob at
+        that moment, and the location is its LySrcLocation.
+        """
+        if not self.__slots:
+            bug("Didn't find any notes; something must have gone wrong "
+                "with the use of dump-spacetime-info.")
+        groblist = []
+        for moment in sorted(self.__slots):
+            slot = self.__slots[moment]
+            location = LySrcLocation(self.__fileNames[self.__files[slot]],
+                                     self.__lines[slot],
+                                     self.__columns[slot])
+            groblist.append((moment, self.__xs[slot], location))
+            debug("leftmost grob for moment %9f is x =%5d @ %s"
+                  % (moment, self.__xs[slot], location))
+        return groblist
+
+    def measuresXpositions(self):
+        """
+        Returns the sorted X co-ordinates of the left paper margin and
+        of every bar line.
+        """
+        return sorted(self.__bars | set([self.leftPaperMarginPx]))
 
 
 def generateTitleFrame(titleText, width, height, ttfFile):
@@ -383,13 +465,13 @@ def pixelsToMm(pixels, dpi):
     return pixels * mmPerPixel
 
 
-def writePaperHeader(fFile, dpi, numOfLines, lilypondVersion):
+def writePaperHeader(fFile, dpi, lilypondVersion):
     """
     Writes own paper block into given file.
 
     Params:
     - fFile:        given opened file
-    - numOfLines:   number of staff lines
+    - dpi:          resolution in DPI
     """
     fFile.write("\\paper {\n")
     fFile.write("   page-breaking = #ly:one-line-breaking\n")
@@ -581,14 +663,21 @@ def getMidiPitches(events, pitchBends):
     return midiPitches
 
 
+# Why a grob or a MIDI tick was left out of the alignment
+SKIP_TICK_WITHOUT_GROB = "tick without grob"
+SKIP_GROB_WITHOUT_TICK = "grob without tick"
+SKIP_PITCH_MISMATCH    = "pitch mismatch"
+
+Alignment = namedtuple("Alignment",
+                       "noteIndices midiTicks keepTicks pairs skips")
+
+
 def getNoteIndices(leftmostGrobsByMoment,
                    midiResolution, midiTicks, notesInTicks, pitchBends):
     """
-    Build a list of note indices which align with the ticks in
-    midiTicks, by aligning the moments in the space-time data from
-    LilyPond with the MIDI ticks.  As a side-effect, any MIDI ticks
-    which do not match notes in these indices are removed from
-    midiTicks.
+    Aligns the moments in the space-time data from LilyPond with the
+    MIDI ticks in a single pass over both, and builds a list of note
+    indices which align with the ticks kept.
 
     If the (leftmost) grob at a given moment is found to have no
     corresponding MIDI event (e.g. when the grob is on the right-hand
@@ -597,7 +686,7 @@ def getNoteIndices(leftmostGrobsByMoment,
     If none of the MIDI events at a given moment are found to have a
     corresponding grob (e.g. when notes are hidden via \hideNotes, or
     generated via a ChordName), they are skipped and the containing
-    tick is removed from midiTicks.
+    tick is left out.
 
     Parameters:
       - leftmostGrobsByMoment:
@@ -607,39 +696,52 @@ def getNoteIndices(leftmostGrobsByMoment,
       - midiTicks:
           A sorted list of which ticks contain NoteOn events.  The
           last tick corresponds to the earliest EndOfTrackEvent found
-          across all MIDI channels.
+          across all MIDI channels.  It is left untouched.
       - notesInTicks:           as returned by getNotesInTicks()
       - pitchBends:             as returned by getNotesInTicks()
 
-    Returns:
-      - alignedNoteIndices:
+    Returns an Alignment of:
+      - noteIndices:
           a sorted list containing all the
-          indices aligned in order with the MIDI ticks
-
-    Side-effect:
-      - midiTicks is potentially trimmed down
+          indices aligned in order with the MIDI ticks kept
+      - midiTicks:
+          the MIDI ticks kept
+      - keepTicks:
+          a list telling which of the given MIDI ticks are kept
+      - pairs:
+          the (grob, tick) pairs of indices into leftmostGrobsByMoment
+          and the given midiTicks which were aligned
+      - skips:
+          the (reason, grob, tick) indices of whatever was skipped,
+          where reason is one of the SKIP_* constants
     """
 
-    # index into list of MIDI ticks
-    midiIndex = 0
+    tickCount = len(midiTicks)
+    keepTicks = [True] * tickCount
+    pairs = []
+    skips = []
 
-    originalTickCount = len(midiTicks)
-    ticksSkipped  = 0
+    # index into the list of MIDI ticks, and number of ticks kept
+    # before it
+    t = 0
+    ticksKept = 0
+    ticksSkipped = 0
     lastChord = []
 
-    # final indices of notes
-    alignedNoteIndices = []
-
     # index into list of note indices
     i = 0
 
     currentLySrcFile = None
 
+    # the pitches of the current grob and tick are only worked out
+    # once, however many times they are compared
+    grobPitchIndex = tickPitchIndex = None
+
     index = None
     while i < len(leftmostGrobsByMoment):
-        if midiIndex == len(midiTicks):
+        if t == tickCount:
             warn("Ran out of MIDI indices after %d. Current index: %d" %
-                 (midiIndex, index))
+                 (ticksKept, index))
             break
 
         moment, index, lySrcLocation = leftmostGrobsByMoment[i]
@@ -648,15 +750,17 @@ def getNoteIndices(leftmostGrobsByMoment,
             currentLySrcFile = lySrcLocation.filename
             debug("Current .ly source file: %s" % currentLySrcFile)
 
-        midiTick = midiTicks[midiIndex]
+        midiTick = midiTicks[t]
         grobTick = int(round(moment * midiResolution * 4))
 
-        grobPitchValue, grobPitchToken = lySrcLocation.getAbsolutePitch()
-        if grobPitchToken == 'q':
-            if len(lastChord) < 2:
-                bug("Encountered a 'q' repeated chord token at %s "
-                    "but didn't have a last chord saved." % lySrcLocation)
-            grobPitchValue = lastChord[0]
+        if grobPitchIndex != i:
+            grobPitchIndex = i
+            grobPitchValue, grobPitchToken = lySrcLocation.getAbsolutePitch()
+            if grobPitchToken == 'q':
+                if len(lastChord) < 2:
+                    bug("Encountered a 'q' repeated chord token at %s "
+                        "but didn't have a last chord saved." % lySrcLocation)
+                grobPitchValue = lastChord[0]
 
         debug("%-3s @ %3d:%3d | grob(time=%3.4f, x=%5d, tick=%5d) | "
               "MIDI(tick=%5d)" %
@@ -667,22 +771,27 @@ def getNoteIndices(leftmostGrobsByMoment,
         if midiTick not in notesInTicks:
             # This should mean that we reached the tick corresponding
             # to the final EndOfTrackEvent (see getMidiEvents()).
-            midiIndex += 1
-            if midiIndex < len(midiTicks):
+            t += 1
+            ticksKept += 1
+            if t < tickCount:
                 bug("No notes in tick %d (%d/%d)" %
-                    (midiTick, midiIndex, len(midiTicks)))
+                    (midiTick, ticksKept, tickCount - ticksSkipped))
             debug("    no notes in final tick %d" % midiTick)
             continue
 
         events = notesInTicks[midiTick]
-        midiPitches = getMidiPitches(events, pitchBends)
+        if tickPitchIndex != t:
+            tickPitchIndex = t
+            midiPitches = getMidiPitches(events, pitchBends)
 
         if midiTick < grobTick:
             # No grobs matched this MIDI tick - maybe it was a note
             # hidden by \hideNotes, or notes from a chord.  So let's
             # skip the tick.
+            keepTicks[t] = False
+            skips.append((SKIP_TICK_WITHOUT_GROB, None, t))
+            t += 1
             ticksSkipped += 1
-            midiTicks.pop(midiIndex)
             msg = "    WARNING: skipping MIDI tick %d since " \
                   "no grob matched; contents:" % midiTick
             for event in events:
@@ -700,6 +809,7 @@ def getNoteIndices(leftmostGrobsByMoment,
             # FIXME: make sure.
             debug("    No MIDI events for this grob; "
                   "probably a tie/ChordName - skipping grob.")
+            skips.append((SKIP_GROB_WITHOUT_TICK, i - 1, None))
             continue
 
         # We're looking at the same point in time in the notated
@@ -716,50 +826,55 @@ def getNoteIndices(leftmostGrobsByMoment,
         if grobPitchValue not in midiPitches:
             debug("    grob's pitch %d not found in midiPitches; "
                   "probably a tie/ChordName" % grobPitchValue)
-            midiPitches = [str(event.get_pitch()) for event in events]
             debug("    midiPitches: %s" %
-                  " ".join(["%s (%s)" % (pitch, NOTE_NAMES[int(pitch) % 12])
-                            for pitch in sorted(midiPitches)]))
-            if midiIndex == 0:
+                  " ".join(["%d (%s)" % (pitch, NOTE_NAMES[pitch % 12])
+                            for pitch in sorted(event.get_pitch()
+                                                for event in events)]))
+            if ticksKept == 0:
                 # This is the first MIDI event - we can't skip it,
                 # because then the audio and video would start in
                 # different places.
                 progress("    Starting by hovering over the first grob")
             else:
                 progress("    Skipping grob and tick")
+                keepTicks[t] = False
+                skips.append((SKIP_PITCH_MISMATCH, i - 1, t))
+                t += 1
                 ticksSkipped += 1
-                midiTicks.pop(midiIndex)
                 continue
 
-        midiIndex += 1
-        alignedNoteIndices.append(index)
+        pairs.append((i - 1, t))
+        t += 1
+        ticksKept += 1
 
         if len(midiPitches) > 1:
             # technically it would be more correct to save the grob
             # pitches not MIDI pitches,
-            lastChord = midiPitches
+            lastChord = sorted(midiPitches)
         else:
             lastChord = []
 
-    if midiIndex < len(midiTicks) - 1:
+    keptTicks = [tick for tick, keep in zip(midiTicks, keepTicks) if keep]
+    if ticksKept < len(keptTicks) - 1:
         # Could happen if last note is a dangling tie?
         warn("ran out of notes at MIDI tick %d (%d/%d ticks)" %
-             (midiTicks[midiIndex], midiIndex + 1, len(midiTicks)))
+             (midiTicks[t], ticksKept + 1, len(keptTicks)))
 
+    noteIndices = [leftmostGrobsByMoment[grob][1] for grob, tick in pairs]
     progress("sync points found: %5d\n"
              "             from: %5d original indices\n"
              "              and: %5d original ticks\n"
              "   last tick used: %5d\n"
              "    ticks skipped: %5d"   %
-             (len(alignedNoteIndices),
+             (len(noteIndices),
               len(leftmostGrobsByMoment),
-              originalTickCount,
-              midiIndex, ticksSkipped))
+              tickCount,
+              ticksKept, ticksSkipped))
 
-    if len(alignedNoteIndices) < 2:
+    if len(noteIndices) < 2:
         bug("Not enough synchronization points found!  Aborting.")
 
-    return alignedNoteIndices
+    return Alignment(noteIndices, keptTicks, keepTicks, pairs, skips)
 
 
 def genWavFile(timidity, midiPath):
@@ -771,61 +886,70 @@ def genWavFile(timidity, midiPath):
     """
     progress("Running TiMidity++ on %s to generate .wav audio ..." % midiPath)
     dirname, midiFile = os.path.split(midiPath)
-    os.chdir(dirname)
     cmd = [timidity, midiFile, "-Ow"]
-    progress(safeRun(cmd, exitcode=11))
+    progress(safeRun(cmd, exitcode=11, cwd=dirname))
     wavExpected = midiPath.replace('.midi', '.wav')
     if not os.path.exists(wavExpected):
         bug("TiMidity++ failed to generate %s" % wavExpected)
     return wavExpected
 
 
-def generateSilence(name, length):
+def encodeAudio(ffmpeg, wavPath, encoderArgs):
+    """
+    Encodes the .wav audio with the given ffmpeg options, ready to be
+    muxed into the video without further encoding.
     """
-    Generates silent audio for the title screen.
+    progress("Encoding audio %s ..." % wavPath)
+    audioPath = os.path.splitext(wavPath)[0] + ".mka"
+    cmd = [
+        ffmpeg,
+        "-i", wavPath,
+    ] + encoderArgs + [
+        audioPath
+    ]
+    safeRun(cmd, exitcode=11)
+    return audioPath
 
-    author: Mister Muffin,
-    http://blog.mister-muffin.de/2011/06/04/generate-silent-wav/
 
-    Params:
-    - length: length of that silence
+class AudioJob(object):
+    """
+    Synthesises the audio of the MIDI file with TiMidity++ and encodes
+    it in a child process, which mostly waits for these two programs,
+    so that this overlaps with the rendering of the frames.  This is a
+    process rather than a thread since the rendering forks its workers
+    afterwards, which must not inherit locks held by a running thread.
     """
 
-    #
-    channels = 2    # number of channels
-    bps = 16        # bits per sample
-    sample = 44100  # sample rate
-    ExtraParamSize = 0
-    Subchunk1Size = 16 + 2 + ExtraParamSize
-    Subchunk2Size = int(length * sample * channels * bps / 8)
-    ChunkSize = 4 + (8 + Subchunk1Size) + (8 + Subchunk2Size)
-
-    outdir = tmpPath("silence")
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
-    out = os.path.join(outdir, name + '.wav')
-
-    fSilence = open(out, "w")
-
-    fSilence.write("".join([
-        'RIFF',                                   # ChunkID (magic)      # 0x00
-        pack('<I', ChunkSize),                    # ChunkSize            # 0x04
-        'WAVE',                                   # Format               # 0x08
-        'fmt ',                                   # Subchunk1ID          # 0x0c
-        pack('<I', Subchunk1Size),                # Subchunk1Size        # 0x10
-        pack('<H', 1),                            # AudioFormat (1=PCM)  # 0x14
-        pack('<H', channels),                     # NumChannels          # 0x16
-        pack('<I', sample),                       # SampleRate           # 0x18
-        pack('<I', bps / 8 * channels * sample),  # ByteRate             # 0x1c
-        pack('<H', bps / 8 * channels),           # BlockAlign           # 0x20
-        pack('<H', bps),                          # BitsPerSample        # 0x22
-        pack('<H', ExtraParamSize),               # ExtraParamSize       # 0x22
-        'data',                                   # Subchunk2ID          # 0x24
-        pack('<I', Subchunk2Size),                # Subchunk2Size        # 0x28
-        '\0' * Subchunk2Size
-    ]))
-    fSilence.close()
-    return out
+    def __init__(self, timidity, ffmpeg, midiPath, encoderArgs):
+        self.__pathReader, pathWriter = multiprocessing.Pipe(False)
+        self.__process = multiprocessing.Process(
+            target=self.__run,
+            args=(pathWriter, timidity, ffmpeg, midiPath, encoderArgs))
+        self.__process.daemon = True
+        self.__process.start()
+        pathWriter.close()
+
+    def __run(self, pathWriter, timidity, ffmpeg, midiPath, encoderArgs):
+        # fatal() has already reported any error by the time it
+        # raises SystemExit, which gives this process its status.
+        try:
+            wavPath = genWavFile(timidity, midiPath)
+            pathWriter.send(encodeAudio(ffmpeg, wavPath, encoderArgs))
+        except Exception as e:
+            stderr("ERROR: audio generation failed: %s" % e)
+            sys.exit(1)
+
+    def join(self):
+        """
+        Waits for the audio, and returns the path of the encoded
+        audio file, or exits if it couldn't be generated.
+        """
+        while self.__process.is_alive():
+            # a timeout keeps the main thread interruptible
+            self.__process.join(1)
+        if self.__process.exitcode != 0:
+            sys.exit(max(self.__process.exitcode, 1))
+        return self.__pathReader.recv()
 
 
 def parseOptions():
@@ -834,7 +958,7 @@ def parseOptions():
     group_inout = parser.add_argument_group(title='Input/output files')
 
     group_inout.add_argument(
-        "-i", "--input", required=True,
+        "-i", "--input",
         help="input LilyPond file", metavar="INPUT-FILE")
     group_inout.add_argument(
         "-b", "--beatmap",
@@ -845,10 +969,20 @@ def parseOptions():
         help="input file prefix to generate a slide show "
         "(see doc/slideshow.txt)",
         metavar="SLIDESHOW-PREFIX")
+    group_inout.add_argument(
+        "--save-sync", dest="saveSync",
+        help="save the positions and timing of the notes, along with "
+        "the score image and the MIDI file, into a sync file",
+        metavar="SYNC-FILE")
+    group_inout.add_argument(
+        "--load-sync", dest="loadSync",
+        help="generate the video from a sync file saved by --save-sync "
+        "rather than from INPUT-FILE, without running LilyPond",
+        metavar="SYNC-FILE")
     group_inout.add_argument(
         "-o", "--output",
         help='name of output video (e.g. "myNotes.avi") '
-        '[INPUT-FILE.avi]',
+        '[INPUT-FILE.avi or SYNC-FILE.avi]',
         metavar="OUTPUT-FILE")
 
     group_scroll = parser.add_argument_group(title='Scrolling')
@@ -874,8 +1008,65 @@ def parseOptions():
     group_video.add_argument(
         "-q", "--quality",
         help="video encoding quality as used by ffmpeg's -q option "
-        '(1 is best, 31 is worst) [%(default)s]',
+        'with the mpeg1 codec (1 is best, 31 is worst) [%(default)s]',
         type=int, metavar="N", default=10)
+    group_video.add_argument(
+        "--video-codec", dest="videoCodec",
+        help='video codec, with a matching audio codec: mpeg1 (with '
+        'MP2 audio), h264 (with AAC) or vp9 (with Opus) [h264 for '
+        '.mp4, .m4v, .mov and .mkv output files, vp9 for .webm, '
+        'mpeg1 otherwise]',
+        choices=VIDEO_CODECS)
+    group_video.add_argument(
+        "--crf", dest="crf",
+        help='constant rate factor of the h264 and vp9 codecs, lower '
+        'is better [23 for h264, 31 for vp9]',
+        type=int, metavar="N")
+    group_video.add_argument(
+        "--preset", dest="preset",
+        help='encoding speed preset of the h264 codec, from ultrafast '
+        'to veryslow [%(default)s]',
+        metavar="PRESET", default="medium")
+    group_video.add_argument(
+        "--threads", dest="threads",
+        help='number of threads of the video encoder, or 0 to let '
+        'ffmpeg choose [%(default)s]',
+        type=int, metavar="N", default=0)
+    group_video.add_argument(
+        "--encoders", dest="encoders",
+        help='number of segments of the video encoded in parallel by '
+        'separate ffmpeg processes, then joined [%(default)s]',
+        type=int, metavar="N", default=1)
+    group_video.add_argument(
+        "--ffmpeg-render", dest="ffmpegRender",
+        help='let ffmpeg animate the score image by itself rather than '
+        'rendering every frame in Python, which is much faster '
+        '(not with --slide-show or --png-frames, nor with '
+        '--measure-cursor and --scroll-notes together; overrides '
+        '--encoders and --drop-duplicates)',
+        action="store_true", default=False)
+    group_video.add_argument(
+        "--drop-duplicates", dest="dropDuplicates",
+        help="don't render nor encode again the frames which look the "
+        "same as the previous one, but show that one for longer, "
+        "which makes a variable frame rate video",
+        action="store_true", default=False)
+    group_video.add_argument(
+        "--cfr", dest="cfr",
+        help="with --drop-duplicates, re-encode the video at a constant "
+        "frame rate at the end (done anyway for containers which "
+        "don't support a variable frame rate, such as .avi and .mpg)",
+        action="store_true", default=False)
+    group_video.add_argument(
+        "--no-faststart", dest="faststart",
+        help="don't move the index of .mp4, .m4v and .mov files to "
+        "their start, which lets them play while being downloaded",
+        action="store_false", default=True)
+    group_video.add_argument(
+        "-j", "--jobs", dest="jobs",
+        help='number of processes rendering frames in parallel, '
+        'or 0 for one per CPU [%(default)s]',
+        type=int, metavar="N", default=1)
     group_video.add_argument(
         "-r", "--resolution", dest="dpi",
         help='resolution in DPI [%(default)s]',
@@ -892,6 +1083,24 @@ def parseOptions():
         "-y", "--height",
         help='pixel height of final video [%(default)s]',
         metavar="HEIGHT", type=int, default=720)
+    group_video.add_argument(
+        "--in-memory-score", dest="inMemoryScore",
+        help='keep the whole score image decoded in memory, rather '
+        'than in a memory-mapped file in the temporary directory',
+        action="store_true", default=False)
+    group_video.add_argument(
+        "--score-mode", dest="scoreMode",
+        help='how the score image is held while rendering: RGB, '
+        '8-bit grayscale (L, a third of the memory) or 1-bit black and '
+        'white (1, a 24th of the memory, without anti-aliasing).  '
+        'The cursor is still drawn in color [%(default)s]',
+        choices=SCORE_MODES, default="RGB")
+    group_video.add_argument(
+        "--blank-threshold", dest="blankThreshold",
+        help='pixels with no color channel darker than this count as '
+        'white when cropping the margins of the score, so that faint '
+        'anti-aliasing can be cropped too [%(default)s]',
+        type=int, metavar="N", default=255)
 
     group_cursors = parser.add_argument_group(title='Cursors')
 
@@ -899,6 +1108,17 @@ def parseOptions():
         "-c", "--color",
         help='name of the cursor color [%(default)s]',
         metavar="COLOR", default="red")
+    group_cursors.add_argument(
+        "--cursor-opacity", dest="cursorOpacity",
+        help='opacity of the cursors, from 0 (invisible) to 1 '
+        '[%(default)s]',
+        type=float, metavar="OPACITY", default=1.0)
+    group_cursors.add_argument(
+        "--antialias-cursor", dest="antialiasCursor",
+        help='draw the note cursor at fractional positions in between '
+        'notes, blending its edges, rather than rounding it to whole '
+        'pixels (no effect with --scroll-notes)',
+        action="store_true", default=False)
     group_cursors.add_argument(
         "--no-cursor", dest="noteCursor",
         help='do not generate a cursor',
@@ -937,6 +1157,23 @@ def parseOptions():
         help='time to pause on initial and final frames [%(default)s]',
         metavar="SECS,SECS", default='1,1')
 
+    group_cache = parser.add_argument_group(title='LilyPond cache')
+
+    group_cache.add_argument(
+        "--no-cache", dest="noCache",
+        help="always run LilyPond, rather than reusing its output "
+        "from a previous run on the same input",
+        action="store_true", default=False)
+    group_cache.add_argument(
+        "--cache-dir", dest="cacheDir",
+        help='directory of the cache of LilyPond outputs [%(default)s]',
+        metavar="PATH", default=defaultCacheDir())
+    group_cache.add_argument(
+        "--cache-size", dest="cacheSize",
+        help='maximum size of the cache of LilyPond outputs in MB '
+        '[%(default)s]',
+        type=int, metavar="MB", default=500)
+
     group_os = parser.add_argument_group(title='External programs')
 
     group_os.add_argument(
@@ -960,6 +1197,12 @@ def parseOptions():
         "-k", "--keep", dest="keepTempFiles",
         help="don't remove temporary working files",
         action="store_true", default=False)
+    group_debug.add_argument(
+        "--png-frames", dest="pngFrames",
+        help="save every frame as a PNG file in ly2video.tmp/notes/ "
+        "and encode them afterwards, rather than streaming them "
+        "straight into ffmpeg (slower, but handy for debugging)",
+        action="store_true", default=False)
     group_debug.add_argument(
         "-v", "--version", dest="showVersion",
         help="show program version",
@@ -974,12 +1217,31 @@ def parseOptions():
     if options.showVersion:
         showVersion()
 
+    if (options.input is None) == (options.loadSync is None):
+        fatal("Must specify either --input=INPUT-FILE or "
+              "--load-sync=SYNC-FILE.")
+    if options.loadSync and options.beatmap:
+        fatal("--beatmap must be applied when saving the sync file.")
+
     if options.titleAtStart and options.titleTtfFile is None:
         fatal("Must specify --title-ttf=FONT-FILE with --title-at-start.")
 
     if options.debug:
         setDebug()
 
+    if options.encoders < 1:
+        fatal("The number of encoders must be at least 1.")
+    if options.threads < 0:
+        fatal("The number of encoder threads must not be negative.")
+
+    if options.jobs < 0:
+        fatal("The number of jobs must not be negative.")
+    if options.jobs == 0:
+        options.jobs = multiprocessing.cpu_count()
+
+    if not 0 < options.blankThreshold <= 255:
+        fatal("The blank threshold must be in between 1 and 255.")
+
     return options
 
 
@@ -1022,35 +1284,67 @@ def applyBeatmap(src, dst, beatmap):
     debug(safeRun(cmd))
 
 
-def safeRun(cmd, errormsg=None, exitcode=None, shell=False, issues=[]):
+def quoteCmd(cmd, shell=False):
     if shell:
-        quotedCmd = cmd
+        return cmd
+    quotedCmd = [cmd[0]]
+    for arg in cmd[1:]:
+        quotedCmd.append(pipes.quote(arg))
+    return " ".join(quotedCmd)
+
+
+def safeRunFailed(quotedCmd, errormsg, exitcode, issues):
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    excmsg = "%s: %s" % (exc_type.__name__, exc_value)
+    if errormsg is None:
+        errormsg = "Failed to run command: %s:\n%s" % \
+            (quotedCmd, excmsg)
+    if issues:
+        bug(errormsg, *issues)
     else:
-        quotedCmd = [cmd[0]]
-        for arg in cmd[1:]:
-            quotedCmd.append(pipes.quote(arg))
-        quotedCmd = " ".join(quotedCmd)
+        fatal(errormsg, exitcode)
 
+
+def safeRun(cmd, errormsg=None, exitcode=None, shell=False, issues=[],
+            cwd=None):
+    quotedCmd = quoteCmd(cmd, shell)
     debug("Running: %s\n" % quotedCmd)
 
     try:
-        stdout = subprocess.check_output(cmd, shell=shell)
+        stdout = subprocess.check_output(cmd, shell=shell, cwd=cwd)
     except KeyboardInterrupt:
         fatal("Interrupted via keyboard; aborting.")
     except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        excmsg = "%s: %s" % (exc_type.__name__, exc_value)
-        if errormsg is None:
-            errormsg = "Failed to run command: %s:\n%s" % \
-                (quotedCmd, excmsg)
-        if issues:
-            bug(errormsg, *issues)
-        else:
-            fatal(errormsg, exitcode)
+        safeRunFailed(quotedCmd, errormsg, exitcode, issues)
 
     return stdout
 
 
+def safeRunLines(cmd, lineHandler, errormsg=None, exitcode=None, issues=[],
+                 cwd=None):
+    """
+    Runs the command like safeRun(), but hands every line of its
+    output over to lineHandler as soon as it is printed, rather than
+    returning the whole output at the end.
+    """
+    quotedCmd = quoteCmd(cmd)
+    debug("Running: %s\n" % quotedCmd)
+
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=cwd)
+        # iterating over the pipe itself would read ahead in blocks
+        for line in iter(process.stdout.readline, ''):
+            lineHandler(line)
+        process.stdout.close()
+        status = process.wait()
+        if status:
+            raise subprocess.CalledProcessError(status, cmd)
+    except KeyboardInterrupt:
+        fatal("Interrupted via keyboard; aborting.")
+    except:
+        safeRunFailed(quotedCmd, errormsg, exitcode, issues)
+
+
 def findExecutableDependencies(options):
     stdout = safeRun(["lilypond", "-v"], "LilyPond was not found.", 1)
     progress("LilyPond was found.")
@@ -1088,20 +1382,26 @@ def findExecutableDependencies(options):
 def getCursorLineColor(options):
     options.color = options.color.lower()
     if options.color == "black":
-        return (0, 0, 0)
+        color = (0, 0, 0)
     elif options.color == "yellow":
-        return (255, 255, 0)
+        color = (255, 255, 0)
     elif options.color == "red":
-        return (255, 0, 0)
+        color = (255, 0, 0)
     elif options.color == "green":
-        return (0, 128, 0)
+        color = (0, 128, 0)
     elif options.color == "blue":
-        return (0, 0, 255)
+        color = (0, 0, 255)
     elif options.color == "brown":
-        return (165, 42, 42)
+        color = (165, 42, 42)
     else:
         warn("Color was not found, ly2video will use default one ('red').")
-        return (255, 0, 0)
+        color = (255, 0, 0)
+    if not 0 <= options.cursorOpacity <= 1:
+        fatal("--cursor-opacity must be between 0 and 1")
+    if options.cursorOpacity < 1:
+        # an RGBA color is blended with the score
+        color += (int(round(options.cursorOpacity * 255)),)
+    return color
 
 
 def absPathFromRunDir(path):
@@ -1113,58 +1413,243 @@ def absPathFromRunDir(path):
 def getOutputFile(options):
     outputFile = options.output
     if outputFile is None:
-        basename, ext = os.path.splitext(options.input)
+        basename, ext = os.path.splitext(options.input or options.loadSync)
         outputFile = basename + '.avi'
     return absPathFromRunDir(outputFile)
 
 
-def generateNotesVideo(ffmpeg, fps, quality, wavPath):
-    progress("Generating video with animated notation\n")
-    notesPath = tmpPath("notes.mpg")
-    framePath = tmpPath('notes', 'frame%d.png')
+Encoding = namedtuple("Encoding", "videoArgs audioArgs outputArgs")
+
+VIDEO_CODECS = ("mpeg1", "h264", "vp9")
+
+# The audio codec and sample rate matching every video codec.  The
+# sample rate is forced so that all the segments can be joined.
+AUDIO_ENCODER_ARGS = {
+    "mpeg1": ["-c:a", "mp2", "-ar", "44100", "-ac", "2"],
+    "h264":  ["-c:a", "aac", "-b:a", "192k", "-ar", "44100", "-ac", "2"],
+    "vp9":   ["-c:a", "libopus", "-b:a", "128k", "-ar", "48000", "-ac", "2"],
+}
+
+DEFAULT_CRF = {
+    "h264": 23,
+    "vp9":  31,
+}
+
+# Containers which can be played while being downloaded, once the
+# index is moved to the start of the file.
+FASTSTART_EXTENSIONS = (".mp4", ".m4v", ".mov")
+
+# Containers which keep the timestamps of a variable frame rate video.
+VFR_EXTENSIONS = (".mp4", ".m4v", ".mov", ".mkv", ".webm")
+
+
+def getEncoding(options, outputFile):
+    """
+    Returns the ffmpeg options encoding every segment of the video,
+    which must all be encoded alike to be joined without re-encoding.
+    The video codec defaults to one fitting the extension of the output
+    file.
+    """
+    ext = os.path.splitext(outputFile)[1].lower()
+    codec = options.videoCodec
+    if codec is None:
+        codec = {
+            ".mp4":  "h264",
+            ".m4v":  "h264",
+            ".mov":  "h264",
+            ".mkv":  "h264",
+            ".webm": "vp9",
+        }.get(ext, "mpeg1")
+
+    crf = options.crf
+    if crf is None:
+        crf = DEFAULT_CRF.get(codec)
+    if codec == "h264":
+        videoArgs = ["-c:v", "libx264", "-preset", options.preset,
+                     "-crf", str(crf)]
+    elif codec == "vp9":
+        videoArgs = ["-c:v", "libvpx-vp9", "-crf", str(crf), "-b:v", "0"]
+    else:
+        videoArgs = ["-c:v", "mpeg1video", "-q:v", str(options.quality)]
+    videoArgs += ["-pix_fmt", "yuv420p"]
+    if options.threads:
+        videoArgs += ["-threads", str(options.threads)]
+
+    outputArgs = []
+    if options.faststart and ext in FASTSTART_EXTENSIONS:
+        outputArgs += ["-movflags", "+faststart"]
+
+    return Encoding(videoArgs, AUDIO_ENCODER_ARGS[codec], outputArgs)
+
+
+def writeSegmentedVideo(ffmpeg, frameWriter, count, encoding):
+    """
+    Splits the animated notation into count segments starting with a
+    note, which are rendered together and encoded by as many ffmpeg
+    processes in parallel, then joined without re-encoding.  Every
+    segment is made of whole frames of the same schedule, so the
+    joined video is frame for frame the one a single encoder makes,
+    and stays in sync with the audio.  Returns the silent video.
+    """
+    segments = []
+    for i, (start, end) in enumerate(frameWriter.segmentBounds(count)):
+        path = tmpPath("notes-silent-%d.mkv" % i)
+        sink = PipeFrameSink(ffmpeg, path, encoding.videoArgs,
+                             firstFrame=start,
+                             variableRate=frameWriter.dropDuplicates)
+        segments.append((start, end, sink))
+    progress("Encoding %d segments in parallel" % len(segments))
+    frameWriter.writeSegments(segments)
+    output_divider_line()
+
+    # The segments are laid out by their schedule rather than by the
+    # timestamps of their last frames, which may last longer.
+    silentNotesPath = tmpPath("notes-silent.mkv")
+    joinVideos(ffmpeg, [sink.outputPath for start, end, sink in segments],
+               silentNotesPath,
+               durations=[(end - start) / float(frameWriter.fps)
+                          for start, end, sink in segments])
+    return silentNotesPath
+
+
+def canRenderWithFfmpeg(options):
+    """
+    Tells whether ffmpeg can render the notation by itself with the
+    given options, warning about why not otherwise, or about the
+    options it ignores.
+    """
+    if not options.ffmpegRender:
+        return False
+    if options.pngFrames or options.slideShow or \
+            (options.scrollNotes and options.measureCursor) or \
+            (options.antialiasCursor and not options.scrollNotes):
+        warn("--ffmpeg-render doesn't support --slide-show, --png-frames, "
+             "--antialias-cursor, or --measure-cursor with --scroll-notes; "
+             "rendering the frames in Python instead.")
+        return False
+    if options.encoders > 1 or options.dropDuplicates:
+        warn("--ffmpeg-render makes every frame at a constant rate in a "
+             "single ffmpeg process; ignoring --encoders and "
+             "--drop-duplicates.")
+    return True
+
+
+def renderWithFfmpeg(ffmpeg, frameWriter, encoding):
+    """
+    Has ffmpeg render the animated notation from the score image alone,
+    following the frame schedule of the frameWriter, and returns the
+    silent video.  Only the first and last frames, which the padding
+    segments are made of, are rendered in Python.
+    """
+    frameWriter.compile()
+    frameCount = frameWriter.timecode.frameCount
+    scoreImage = frameWriter.scoreImage
+
+    os.mkdir(tmpPath("notes"))
+    for frame in set([0, frameCount - 1]):
+        for image in frameWriter.renderFrames(frame, frame + 1):
+            image.save(tmpPath("notes", "frame%d.png" % frame))
+
+    progress("Rendering %d frames with ffmpeg" % frameCount)
+    stripPath = tmpPath("strip.png")
+    ly2video.filters.writeScoreStrip(scoreImage, stripPath)
+    if scoreImage.scrollNotes:
+        graph = ly2video.filters.scrollNotesGraph(
+            scoreImage, frameWriter.timecode, frameWriter.fps,
+            tmpPath("scroll.cmd"))
+    else:
+        graph = ly2video.filters.cursorPagesGraph(
+            scoreImage, frameWriter.timecode, frameWriter.fps,
+            tmpPath("cursor.cmd"))
+
+    silentNotesPath = tmpPath("notes-silent.mkv")
     cmd = [
         ffmpeg,
-        "-f", "image2",
-        "-r", str(fps),
-        "-i", framePath,
-        "-i", wavPath,
-        "-q:v", quality,
-        notesPath
+        "-i", stripPath,
+        "-filter_complex", graph,
+        "-frames:v", str(frameCount),
+        "-r", str(frameWriter.fps),
+    ] + encoding.videoArgs + [
+        silentNotesPath
     ]
     safeRun(cmd, exitcode=15)
-    output_divider_line()
-    return notesPath
-
+    return silentNotesPath
 
-def generateStaticVideoFrames(name, frames, srcFrame):
-    outdir = tmpPath(name)
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
-    frameFileTemplate = "frame%d.png"
 
-    for i in xrange(frames):
-        os.symlink(srcFrame, os.path.join(outdir, frameFileTemplate % i))
-
-    progress("Generated %d frames in %s/ from %s\n" %
-             (frames, outdir, srcFrame))
-    return tmpPath(name, frameFileTemplate)
+def generateNotesVideo(ffmpeg, fps, encoding, audioPath,
+                       silentNotesPath=None, variableRate=False):
+    """
+    Adds the (already encoded) audio to the animated notation.  If the
+    frames were streamed into ffmpeg while being rendered,
+    silentNotesPath is the resulting video, which only needs the audio
+    muxing in; otherwise the PNG frames in notes/ are encoded here,
+    following the durations listed in notes.txt if duplicate frames
+    were dropped.
+    """
+    progress("Generating video with animated notation\n")
+    notesPath = tmpPath("notes.mkv")
+    if silentNotesPath:
+        cmd = [
+            ffmpeg,
+            "-i", silentNotesPath,
+            "-i", audioPath,
+            "-map", "0:v",
+            "-map", "1:a",
+            "-c", "copy",
+            notesPath
+        ]
+    elif variableRate:
+        cmd = [
+            ffmpeg,
+            "-f", "concat",
+            "-safe", "0",
+            "-i", tmpPath("notes.txt"),
+            "-i", audioPath,
+            "-vsync", "vfr",
+        ] + encoding.videoArgs + [
+            "-c:a", "copy",
+            notesPath
+        ]
+    else:
+        framePath = tmpPath('notes', 'frame%d.png')
+        cmd = [
+            ffmpeg,
+            "-f", "image2",
+            "-r", str(fps),
+            "-i", framePath,
+            "-i", audioPath,
+        ] + encoding.videoArgs + [
+            "-c:a", "copy",
+            notesPath
+        ]
+    safeRun(cmd, exitcode=15)
+    output_divider_line()
+    return notesPath
 
 
-def generateSilentVideo(ffmpeg, fps, quality, desiredDuration, name, srcFrame):
-    out         = tmpPath('%s.mpg' % name)
+def generateSilentVideo(ffmpeg, fps, encoding, desiredDuration, name,
+                        srcFrame):
+    """
+    Encodes a video showing a single still image for the given
+    duration, with silent audio.  ffmpeg loops over the image and
+    generates the silence itself, so neither the frames nor the audio
+    are ever stored.
+    """
+    out         = tmpPath('%s.mkv' % name)
     frames = int(desiredDuration * fps)
     trueDuration = float(frames) / fps
     progress("Generating silent video %s, duration %fs\n" %
              (out, trueDuration))
-    framePath   = generateStaticVideoFrames(name, frames, srcFrame)
-    silentAudio = generateSilence(name, trueDuration)
     cmd = [
         ffmpeg,
-        "-f", "image2",
-        "-r", str(fps),
-        "-i", framePath,
-        "-i", silentAudio,
-        "-q:v", quality,
+        "-loop", "1",
+        "-framerate", str(fps),
+        "-i", srcFrame,
+        "-f", "lavfi",
+        "-i", "anullsrc=channel_layout=stereo:sample_rate=44100",
+        "-frames:v", str(frames),
+        "-t", "%f" % trueDuration,
+    ] + encoding.videoArgs + encoding.audioArgs + [
         out
     ]
     safeRun(cmd, exitcode=14)
@@ -1172,22 +1657,54 @@ def generateSilentVideo(ffmpeg, fps, quality, desiredDuration, name, srcFrame):
     return out
 
 
-def generateVideo(ffmpeg, options, wavPath, titleText, finalFrame, outputFile):
+def joinVideos(ffmpeg, videos, outputFile, outputArgs=[], durations=None):
+    """
+    Joins the given videos, which were all encoded alike, into the
+    output file with ffmpeg's concat demuxer.  The streams are only
+    copied, and remuxed into the container of the output file.  If
+    their durations are given, every video starts where the previous
+    one should end.
+    """
+    progress("Joining videos:\n%s" %
+             "".join(["  %s\n" % video for video in videos]))
+    listName = os.path.splitext(os.path.basename(outputFile))[0] + ".txt"
+    listPath = tmpPath(listName)
+    with open(listPath, "w") as f:
+        for i, video in enumerate(videos):
+            f.write("file '%s'\n" % video.replace("'", "'\\''"))
+            if durations:
+                f.write("duration %.6f\n" % durations[i])
+    cmd = [
+        ffmpeg,
+        "-y",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", listPath,
+        "-map", "0",
+        "-c", "copy",
+    ] + outputArgs + [
+        outputFile
+    ]
+    safeRun(cmd, exitcode=16)
+
+
+def generateVideo(ffmpeg, options, encoding, audioPath, titleText,
+                  finalFrame, outputFile, silentNotesPath=None):
     fps = float(options.fps)
-    quality = str(options.quality)
 
-    videos = [generateNotesVideo(ffmpeg, fps, quality, wavPath)]
+    videos = [generateNotesVideo(ffmpeg, fps, encoding, audioPath,
+                                 silentNotesPath, options.dropDuplicates)]
 
     initialPadding, finalPadding = options.padding.split(",")
 
     if float(initialPadding) > 0:
-        video = generateSilentVideo(ffmpeg, fps, quality,
+        video = generateSilentVideo(ffmpeg, fps, encoding,
                                     float(initialPadding), 'initial-padding',
                                     tmpPath("notes/frame0.png"))
         videos.insert(0, video)
 
     if float(finalPadding) > 0:
-        video = generateSilentVideo(ffmpeg, fps, quality,
+        video = generateSilentVideo(ffmpeg, fps, encoding,
                                     float(finalPadding), 'final-padding',
                                     tmpPath(finalFrame))
         videos.append(video)
@@ -1198,29 +1715,33 @@ def generateVideo(ffmpeg, options, wavPath, titleText, finalFrame, outputFile):
                                         options.titleTtfFile)
         output_divider_line()
 
-        video = generateSilentVideo(ffmpeg, fps, quality,
+        video = generateSilentVideo(ffmpeg, fps, encoding,
                                     float(options.titleDuration),
                                     'title', titleFrame)
         videos.insert(0, video)
 
-    if len(videos) == 1:
-        os.rename(videos[0], outputFile)
+    ext = os.path.splitext(outputFile)[1].lower()
+    if options.dropDuplicates and \
+            (options.cfr or ext not in VFR_EXTENSIONS):
+        # The joined video has a variable frame rate, which has to be
+        # made constant again for the output file.
+        vfrPath = tmpPath("vfr" + ext)
+        joinVideos(ffmpeg, videos, vfrPath)
+        progress("Re-encoding at a constant frame rate of %g fps" % fps)
+        cmd = [
+            ffmpeg,
+            "-y",
+            "-i", vfrPath,
+            "-map", "0",
+            "-vf", "fps=fps=%r" % fps,
+        ] + encoding.videoArgs + [
+            "-c:a", "copy",
+        ] + encoding.outputArgs + [
+            outputFile
+        ]
+        safeRun(cmd, exitcode=16)
     else:
-        progress("Joining videos:\n%s" %
-                 "".join(["  %s\n" % video for video in videos]))
-
-        if sys.platform.startswith("linux"):
-            inputArgs = " ".join([pipes.quote(video) for video in videos])
-            safeRun("cat %s > '%s'" % (inputArgs, outputFile), shell=True)
-        elif sys.platform.startswith("win"):
-            inputArgs = " + ".join(['"%s" /B' % video for video in videos])
-            os.system('copy %s "%s" /B' % (inputArgs, outputFile))
-
-    # Could also do this with ffmpeg:
-    #
-    #   ffmpeg -i concat:"title.mpg|notes.mpg" -codec copy out.mpg
-    #
-    # See: http://stackoverflow.com/questions/7333232/concatenate-two-mp4-files-using-ffmpeg
+        joinVideos(ffmpeg, videos, outputFile, encoding.outputArgs)
 
 
 def getLyVersion(fileName):
@@ -1250,53 +1771,6 @@ def getLyVersion(fileName):
     return version
 
 
-def getNumStaffLines(lyFileName, dpi):
-    # generate preview of notes
-    output = runLilyPond(
-        lyFileName, dpi,
-        "-dpreview",
-        "-dprint-pages=#f",
-    )
-
-    # move generated files into temporary directory
-    dirname, filename = os.path.split(lyFileName)
-    if dirname != tmpPath():
-        basename, suffix = os.path.splitext(filename)
-        for ext in ('png', 'eps'):
-            generated = basename + '.' + ext
-            src = os.path.join(dirname, generated)
-            dst = tmpPath(generated)
-            os.rename(src, dst)
-            progress("Moved %s to %s" % (src, dst))
-
-    # find preview image and get num of staff lines
-    previewPic = None
-    for fileName in os.listdir("."):
-        if "preview" in fileName:
-            if fileName.split(".")[-1] == "png":
-                previewPic = fileName
-
-    if previewPic is None:
-        error = "Failed to generate a .png preview file from %s" % lyFileName
-        msg = error
-
-        if re.search('\S', output):
-            msg = "%s\nlilypond output: [%s]\n\n%s; please check lilypond output immediately above." % \
-                (error, output, msg)
-
-        fatal("%s\n\n"
-              "Maybe your input .ly file was missing a \\layout { } "
-              "command?  See:\n\n"
-              "  http://www.lilypond.org/doc/v2.16/Documentation/learning/introduction-to-the-lilypond-file-structure\n\n"
-              "for more information." % msg)
-
-    staffYs = findStaffLines(previewPic, 50)
-    numStaffLines = len(staffYs)
-
-    progress("Found %d staff lines" % numStaffLines)
-    return numStaffLines
-
-
 def writeSpaceTimeDumper():
     filename = 'dump-spacetime-info.ly'
     f = open(tmpPath(filename), 'w')
@@ -1371,7 +1845,7 @@ def writeSpaceTimeDumper():
     return '\\include "%s"\n' % filename
 
 
-def sanitiseLy(lyFile, dumper, width, height, dpi, numStaffLines,
+def sanitiseLy(lyFile, dumper, width, height, dpi,
                titleText, lilypondVersion):
     fLyFile = open(lyFile, "r")
 
@@ -1402,7 +1876,7 @@ def sanitiseLy(lyFile, dumper, width, height, dpi, numStaffLines,
         elif line.find("\\version") != -1:
             fSanitisedLyFile.write(line)
             leftPaperMarginPx = writePaperHeader(
-                fSanitisedLyFile, dpi, numStaffLines, lilypondVersion)
+                fSanitisedLyFile, dpi, lilypondVersion)
             paperBlock = True
 
         # get needed info from header block and ignore it
@@ -1473,7 +1947,7 @@ def sanitiseLy(lyFile, dumper, width, height, dpi, numStaffLines,
     # if I didn't find \version, write own paper block
     if not paperBlock:
         leftPaperMarginPx = writePaperHeader(fSanitisedLyFile,
-                                             numStaffLines, lilypondVersion)
+                                             dpi, lilypondVersion)
 
     fSanitisedLyFile.close()
     progress("Wrote sanitised version of %s into %s" %
@@ -1482,38 +1956,12 @@ def sanitiseLy(lyFile, dumper, width, height, dpi, numStaffLines,
     return sanitisedLyFileName, leftPaperMarginPx
 
 
-def main():
+def syncScore(options, lilypondVersion, titleText):
     """
-    Main function of ly2video script.
-
-    It performs the following steps:
-
-    - use Lilypond to generate PNG images, and MIDI files of the
-      music
-
-    - find the spatial and temporal position of each note in the PNG
-      and MIDI files
-
-    - combine the positions together to generate the required number
-      of video frames
-
-    - create a video file from the individual frames
+    Engraves the input file with LilyPond, and finds out where and
+    when every note is on the score and in the MIDI file.  Returns
+    the SyncData.
     """
-    options = parseOptions()
-
-    lilypondVersion, ffmpeg, timidity = findExecutableDependencies(options)
-
-    # FIXME.  Ugh, eventually this will be an instance method, and
-    # we'll have somewhere nice to save state.
-    global runDir
-    runDir = os.getcwd()
-    setRunDir(runDir)
-
-    # Delete old temporary files.
-    if os.path.isdir(tmpPath()):
-        shutil.rmtree(tmpPath())
-    os.mkdir(tmpPath())
-
     # .ly input file from user (string)
     lyFile = options.input
 
@@ -1523,27 +1971,36 @@ def main():
     # version, try to convert it
     lyFile = preprocessLyFile(lyFile, lilypondVersion, dumper)
 
-    numStaffLines = getNumStaffLines(lyFile, options.dpi)
-
-    titleText = collections.namedtuple("titleText", "name author")
-    titleText.name = "<name of song>"
-    titleText.author = "<author>"
-
     sanitisedLyFileName, leftPaperMargin = \
         sanitiseLy(lyFile, dumper,
                    options.width, options.height, options.dpi,
-                   numStaffLines, titleText, lilypondVersion)
+                   titleText, lilypondVersion)
 
-    output = runLilyPond(sanitisedLyFileName, options.dpi)
-    leftmostGrobsByMoment = getLeftmostGrobsByMoment(output, options.dpi,
-                                                     leftPaperMargin)
+    parser = SpaceTimeParser(options.dpi, leftPaperMargin)
+    output = runLilyPondCached(sanitisedLyFileName, options.dpi,
+                               lilypondVersion, options, parser)
+    notesImage = tmpPath("sanitised.png")
+    if not os.path.exists(notesImage):
+        error = "Failed to generate a .png file from %s" % sanitisedLyFileName
+        msg = error
 
-    measuresXpositions = None
-    if options.measureCursor:
-        measuresXpositions = getMeasuresIndices(output, options.dpi,
-                                                leftPaperMargin)
+        if re.search('\S', output):
+            msg = "%s\nlilypond output: [%s]\n\n%s; please check lilypond output immediately above." % \
+                (error, output, msg)
 
-    notesImage = tmpPath("sanitised.png")
+        fatal("%s\n\n"
+              "Maybe your input .ly file was missing a \\layout { } "
+              "command?  See:\n\n"
+              "  http://www.lilypond.org/doc/v2.16/Documentation/learning/introduction-to-the-lilypond-file-structure\n\n"
+              "for more information." % msg)
+
+    leftmostGrobsByMoment = parser.leftmostGrobs()
+
+    # Bar lines are cheap to find, and saved in sync files even
+    # without --measure-cursor.
+    measuresXpositions = None
+    if options.measureCursor or options.saveSync:
+        measuresXpositions = parser.measuresXpositions()
 
     midiPath = tmpPath("sanitised.midi")
     if not os.path.exists(midiPath):
@@ -1567,38 +2024,136 @@ def main():
 
     output_divider_line()
 
-    noteIndices = getNoteIndices(leftmostGrobsByMoment,
-                                 midiResolution, midiTicks, notesInTicks,
-                                 pitchBends)
+    alignment = getNoteIndices(leftmostGrobsByMoment,
+                               midiResolution, midiTicks, notesInTicks,
+                               pitchBends)
+
+    return SyncData(alignment.noteIndices, alignment.midiTicks,
+                    temposList, midiResolution,
+                    measuresXpositions, notesImage, midiPath,
+                    titleText.name, titleText.author)
+
+
+def main():
+    """
+    Main function of ly2video script.
+
+    It performs the following steps:
+
+    - use Lilypond to generate PNG images, and MIDI files of the
+      music
+
+    - find the spatial and temporal position of each note in the PNG
+      and MIDI files
+
+    - combine the positions together to generate the required number
+      of video frames
+
+    - create a video file from the individual frames
+    """
+    options = parseOptions()
+
+    lilypondVersion, ffmpeg, timidity = findExecutableDependencies(options)
+
+    # FIXME.  Ugh, eventually this will be an instance method, and
+    # we'll have somewhere nice to save state.
+    global runDir
+    runDir = os.getcwd()
+    setRunDir(runDir)
+
+    # Delete old temporary files.
+    if os.path.isdir(tmpPath()):
+        shutil.rmtree(tmpPath())
+    os.mkdir(tmpPath())
+
+    titleText = collections.namedtuple("titleText", "name author")
+    titleText.name = "<name of song>"
+    titleText.author = "<author>"
+
+    if options.loadSync:
+        try:
+            sync = SyncData.load(absPathFromRunDir(options.loadSync),
+                                 tmpPath())
+        except SyncFileError as e:
+            fatal(str(e))
+        progress("Loaded synchronisation data from %s" % options.loadSync)
+        if sync.title is not None:
+            titleText.name = sync.title
+        if sync.author is not None:
+            titleText.author = sync.author
+    else:
+        sync = syncScore(options, lilypondVersion, titleText)
+    if options.saveSync:
+        sync.save(absPathFromRunDir(options.saveSync))
+        progress("Saved synchronisation data into %s" % options.saveSync)
     output_divider_line()
 
+    midiPath = sync.midiPath
+    midiResolution, midiTicks, temposList = \
+        sync.midiResolution, sync.midiTicks, sync.temposList
+    measuresXpositions = None
+    if options.measureCursor:
+        measuresXpositions = sync.measuresXpositions
+        if measuresXpositions is None:
+            fatal("%s has no bar lines for --measure-cursor." %
+                  options.loadSync)
+
+    # The audio only depends on the MIDI file, so it is generated
+    # while the frames are rendered.
+    outputFile = getOutputFile(options)
+    encoding = getEncoding(options, outputFile)
+    audioJob = AudioJob(timidity, ffmpeg, midiPath, encoding.audioArgs)
+
     # frame rate of output video
     fps = options.fps
 
     # generate notes
     frameWriter = VideoFrameWriter(
         fps, getCursorLineColor(options),
-        midiResolution, midiTicks, temposList)
+        midiResolution, midiTicks, temposList, options.jobs)
     leftMargin, rightMargin = options.cursorMargins.split(",")
+    if options.inMemoryScore:
+        scorePicture = convertScore(Image.open(sync.scorePath),
+                                    options.scoreMode)
+    else:
+        scorePicture = TiledImage.open(sync.scorePath,
+                                       tmpPath("sanitised.raw"),
+                                       mode=options.scoreMode)
+    frameWriter.dropDuplicates = options.dropDuplicates
     frameWriter.scoreImage = ScoreImage(
         options.width, options.height,
-        Image.open(notesImage), noteIndices, measuresXpositions,
+        scorePicture, sync.noteIndices, measuresXpositions,
         int(leftMargin), int(rightMargin),
-        options.scrollNotes, options.noteCursor)
+        options.scrollNotes, options.noteCursor, options.blankThreshold)
+    frameWriter.scoreImage.antialiasCursor = options.antialiasCursor
     if options.slideShow:
         lastOffset = midiTicks[-1] / midiResolution
         frameWriter.push(
             SlideShow(options.slideShow, options.slideShowCursor, lastOffset))
-    frameWriter.write()
+    if options.pngFrames:
+        frameWriter.write(PngFrameSink())
+        silentNotesPath = None
+    elif canRenderWithFfmpeg(options):
+        # ffmpeg makes every frame at a constant rate by itself
+        options.dropDuplicates = False
+        silentNotesPath = renderWithFfmpeg(ffmpeg, frameWriter, encoding)
+    elif options.encoders > 1:
+        silentNotesPath = writeSegmentedVideo(ffmpeg, frameWriter,
+                                              options.encoders, encoding)
+    else:
+        silentNotesPath = tmpPath("notes-silent.mkv")
+        frameWriter.write(PipeFrameSink(ffmpeg, silentNotesPath,
+                                        encoding.videoArgs,
+                                        variableRate=options.dropDuplicates))
     output_divider_line()
 
-    wavPath = genWavFile(timidity, midiPath)
+    audioPath = audioJob.join()
 
     output_divider_line()
 
-    outputFile = getOutputFile(options)
-    finalFrame = "notes/frame%d.png" % (frameWriter.frameNum - 1)
-    generateVideo(ffmpeg, options, wavPath, titleText, finalFrame, outputFile)
+    finalFrame = "notes/frame%d.png" % (frameWriter.timecode.frameCount - 1)
+    generateVideo(ffmpeg, options, encoding, audioPath, titleText,
+                  finalFrame, outputFile, silentNotesPath)
 
     output_divider_line()
 
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# ly2video - generate performances video from LilyPond source files
+# Copyright (C) 2012 Jiri "FireTight" Szabo
+# Copyright (C) 2012 Adam Spiers
+# Copyright (C) 2014 Emmanuel Leguy
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For more information about this program, please visit
+# <https://github.com/aspiers/ly2video/>.
+
+"""
+Builds ffmpeg filter graphs which render the animated notation from
+still images, so that no frame has to be made in Python.  The motion
+comes from commands scheduled with ffmpeg's sendcmd filter, which
+follow the compiled frame schedule of the VideoFrameWriter exactly.
+
+The still image is looped into frames with exact timestamps, so the
+number of every frame is computed from its timestamp rather than
+taken from the frame counters of the filters, which don't all count
+from the same frame.
+"""
+
+from utils import *
+
+# The cursor line drawn by writeCursorLine()
+CURSOR_WIDTH = 2
+
+
+def escapeFilterValue(value):
+    """
+    Escapes a value for an option of a filter, then for the filter
+    graph, as explained in the "Quoting and escaping" section of the
+    ffmpeg-filters manual.
+    """
+    for special in ("\\':", "\\'[],;"):
+        value = "".join("\\" + c if c in special else c for c in value)
+    return value
+
+
+def ffmpegColor(color):
+    """
+    Returns the ffmpeg color of an RGB or RGBA tuple.
+    """
+    alpha = color[3] if len(color) > 3 else 255
+    return "0x%02x%02x%02x@%.4f" % (color[0], color[1], color[2],
+                                    alpha / 255.0)
+
+
+def noteMotions(timecode, notesXpositions):
+    """
+    Yields a (startFrame, startX, travelPerFrame) tuple for every note
+    shown by at least one frame: frame n of the video, shown while
+    that note is played, has the index
+    startX + round((n - startFrame) * travelPerFrame)
+    as computed by ScoreImage for the same note.
+    """
+    for note in xrange(len(timecode.noteStartFrames) - 1):
+        among = int(timecode.noteFrames[note])
+        if among == 0:
+            continue
+        travel = notesXpositions[note + 1] - notesXpositions[note]
+        yield (int(timecode.noteStartFrames[note]), notesXpositions[note],
+               float(travel) / among)
+
+
+def frameExpression(fps):
+    """
+    Returns the ffmpeg expression of the number of the current frame,
+    in a graph whose frames are timestamped by loopFilters().
+    """
+    return "round(t*%r)" % fps
+
+
+def motionExpression(startFrame, startX, travelPerFrame, fps):
+    """
+    Returns the ffmpeg expression of the index of the current frame
+    of a note.  The travel is written with repr() so that ffmpeg
+    computes with the very same double, and rounds it the same way as
+    Python.
+    """
+    return "%d+round((%s-%d)*%r)" % (startX, frameExpression(fps),
+                                     startFrame, travelPerFrame)
+
+
+def loopFilters(fps):
+    """
+    Returns the filters repeating a still image forever, as frames
+    timestamped at the given rate.  The microsecond time base keeps
+    the timestamps within a microsecond of the frame times whatever
+    the rate.
+    """
+    return [
+        "loop=loop=-1:size=1:start=0",
+        "settb=AVTB",
+        "setpts=N/(%r*TB)" % fps,
+    ]
+
+
+def writeCommands(path, commands, fps):
+    """
+    Writes a script for ffmpeg's sendcmd filter, which runs every
+    given (frame, target, command, argument) command just before the
+    given frame.
+    """
+    with open(path, "w") as f:
+        for frame, target, command, arg in commands:
+            secs = max(frame - 0.5, 0) / fps
+            f.write("%.6f %s %s %s;\n" % (secs, target, command, arg))
+
+
+def sendCommands(path, commands, fps):
+    """
+    Writes the given commands with writeCommands(), and returns the
+    sendcmd filter running them, in a list which is empty if there
+    are no commands, since ffmpeg refuses an empty script.
+    """
+    writeCommands(path, commands, fps)
+    if not commands:
+        return []
+    return ["sendcmd=f=%s" % escapeFilterValue(path)]
+
+
+def writeScoreStrip(scoreImage, path):
+    """
+    Saves the rows of the score shown in the video as an image.
+    """
+    top, bottom = scoreImage.cropBox
+    width, height = scoreImage.picture.size
+    scoreImage.picture.crop((0, top, width, bottom)).save(path)
+
+
+def scrollNotesGraph(scoreImage, timecode, fps, commandsPath):
+    """
+    Returns the filter graph rendering the video of a ScoreImage in
+    note scrolling mode from its strip, as saved by writeScoreStrip(),
+    and writes the commands it needs into commandsPath.
+
+    The strip is padded (as black as PIL pads the windows outside of
+    the picture) then looped forever in memory, and every frame is
+    cropped out of it at the index of the frame.  The crop is moved
+    by a command at the start of every note.
+    """
+    width = scoreImage.width
+    centre = width / 2
+    commands = [(startFrame, "crop@scroll", "x",
+                 motionExpression(startFrame, startX, travelPerFrame, fps))
+                for startFrame, startX, travelPerFrame in
+                noteMotions(timecode, scoreImage.notesXpostions)]
+
+    filters = [
+        "format=rgb24",
+        # The index is the left edge of the window plus the padding.
+        "pad=w=iw+%d:h=ih:x=%d:y=0:color=black" % (width, centre),
+    ] + loopFilters(fps) + sendCommands(commandsPath, commands, fps) + [
+        "crop@scroll=w=%d:h=ih:x=0:y=0" % width,
+    ]
+    if scoreImage.noteCursor:
+        filters.append("drawbox=x=%d:y=0:w=%d:h=ih:color=%s:t=fill" %
+                       (centre, CURSOR_WIDTH,
+                        ffmpegColor(scoreImage.cursorLineColor)))
+    return ",".join(filters)
+
+
+def pageRuns(scoreImage):
+    """
+    Returns the (startFrame, endFrame, left, right) runs of consecutive
+    frames of a ScoreImage in cursor scrolling mode which show the same
+    page, that is the same window of the picture.
+    """
+    viewports = scoreImage.frameViewports
+    runs = []
+    for frame, (index, left, right, cursorX) in enumerate(viewports):
+        if runs and runs[-1][2:] == [left, right]:
+            runs[-1][1] = frame + 1
+        else:
+            runs.append([frame, frame + 1, int(left), int(right)])
+    return [tuple(run) for run in runs]
+
+
+def pageCommands(runs, padding):
+    """
+    Returns the commands moving the window of a ScoreImage in cursor
+    scrolling mode to the page of every run but the first one, in a
+    strip padded on the left by the given width.
+    """
+    return [(start, "crop@page", "x", str(left + padding))
+            for start, end, left, right in runs[1:]]
+
+
+def cursorCommands(scoreImage, timecode, fps):
+    """
+    Returns the commands moving the note cursor of a ScoreImage in
+    cursor scrolling mode, one at the start of every note and wherever
+    the origin of the cursor positions changes within a note.
+    """
+    viewports = scoreImage.frameViewports
+    motions = dict((startFrame, (startX, travelPerFrame))
+                   for startFrame, startX, travelPerFrame in
+                   noteMotions(timecode, scoreImage.notesXpostions))
+    commands = []
+    current = None
+    for frame, (index, left, right, cursorX) in enumerate(viewports):
+        note = int(timecode.frameNotes[frame])
+        origin = int(index - cursorX)
+        if (note, origin) == current:
+            continue
+        current = (note, origin)
+        startFrame = int(timecode.noteStartFrames[note])
+        startX, travelPerFrame = motions[startFrame]
+        commands.append((frame, "overlay@cursor", "x",
+                         motionExpression(startFrame, startX - origin,
+                                          travelPerFrame, fps)))
+    return commands
+
+
+def measureCommands(scoreImage):
+    """
+    Returns the commands moving the measure cursor of a ScoreImage in
+    cursor scrolling mode, wherever the measure or the origin of the
+    cursor positions changes.
+    """
+    measures = scoreImage.measuresXpositions
+    viewports = scoreImage.frameViewports
+    commands = []
+    current = None
+    for frame, measure in enumerate(scoreImage.frameMeasures):
+        index, left, right, cursorX = viewports[frame]
+        origin = int(index - cursorX)
+        if (measure, origin) == current:
+            continue
+        current = (measure, origin)
+        start = measures[measure] - origin
+        end = measures[measure + 1] - origin
+        commands.append((frame, "drawbox@measure", "x", str(start)))
+        commands.append((frame, "drawbox@measure", "w", str(end - start)))
+    return commands
+
+
+def cursorPagesGraph(scoreImage, timecode, fps, commandsPath,
+                     cursorHeight=10):
+    """
+    Returns the filter graph rendering the video of a ScoreImage in
+    cursor scrolling mode from its strip, as saved by
+    writeScoreStrip(), and writes the commands it needs into
+    commandsPath.
+
+    The strip is padded as far as the pages go beyond it, then looped
+    forever in memory, and every page is cropped out of it from the
+    first frame of its run.  The cursor moving across the page is an
+    overlay or, for the measure cursor, a drawbox.  Both are moved by
+    commands following the schedule.
+    """
+    width, height = scoreImage.width, scoreImage.height
+    runs = pageRuns(scoreImage)
+    pictureWidth = scoreImage.picture.size[0]
+    # PIL pads the windows outside of the picture with black
+    padLeft = max([0] + [-left for start, end, left, right in runs])
+    padRight = max([0] + [right - pictureWidth
+                          for start, end, left, right in runs])
+    commands = pageCommands(runs, padLeft)
+    color = ffmpegColor(scoreImage.cursorLineColor)
+    if scoreImage.measuresXpositions:
+        commands += measureCommands(scoreImage)
+    elif scoreImage.noteCursor:
+        commands += cursorCommands(scoreImage, timecode, fps)
+    # sendcmd runs the commands of the same time in the listed order
+    commands.sort(key=lambda command: command[0])
+
+    pages = [
+        "format=rgb24",
+        "pad=w=iw+%d:h=ih:x=%d:y=0:color=black" %
+        (padLeft + padRight, padLeft),
+    ] + loopFilters(fps) + sendCommands(commandsPath, commands, fps) + [
+        "crop@page=w=%d:h=ih:x=%d:y=0" % (width, runs[0][2] + padLeft),
+    ]
+    if scoreImage.measuresXpositions:
+        pages.append("drawbox@measure=x=0:y=%d:w=1:h=%d:color=%s:t=fill" %
+                     (max(height - cursorHeight, 0), cursorHeight, color))
+        return "[0:v]%s" % ",".join(pages)
+    if scoreImage.noteCursor:
+        return ("[0:v]%s[pages];"
+                "color=c=%s:s=%dx%d:r=%r,format=rgba[cursor];"
+                "[pages][cursor]overlay@cursor=x=0:y=0:eval=frame:"
+                "format=rgb:shortest=1" %
+                (",".join(pages), color, CURSOR_WIDTH, height, fps))
+    return "[0:v]%s" % ",".join(pages)
@@ -24,7 +24,7 @@ General functions that parse LilyPond document text.
 """
 
 import os
-import ly.rx
+import rx
 
 
 def findIncludeFiles(lyfile, path=()):
@@ -38,13 +38,13 @@ def findIncludeFiles(lyfile, path=()):
     basedir = os.path.dirname(lyfile)
     
     def find(lyfile):
-        if os.access(lyfile, os.R_OK):
+        if lyfile not in files and os.access(lyfile, os.R_OK):
             files.add(lyfile)
             directory = os.path.dirname(lyfile)
             # read the file and delete the comments.
             with open(lyfile) as f:
-                text = ly.rx.all_comments.sub('', f.read().decode('utf-8', 'ignore'))
-            for f in ly.rx.include_file.findall(text):
+                text = rx.all_comments.sub('', f.read().decode('utf-8', 'ignore'))
+            for f in rx.include_file.findall(text):
                 # old include (relative to master file)
                 find(os.path.join(basedir, f))
                 # new, recursive, relative include
@@ -58,8 +58,8 @@ def findIncludeFiles(lyfile, path=()):
 
 def documentLanguage(text):
     """Return the LilyPond pitch language name for the document, if set."""
-    text = ly.rx.all_comments.sub('', text)
-    m = ly.rx.language.match(text)
+    text = rx.all_comments.sub('', text)
+    m = rx.language.match(text)
     if m:
         return m.group(3)
 
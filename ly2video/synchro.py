@@ -23,6 +23,60 @@
 # <https://github.com/aspiers/ly2video/>.
 
 from utils import *
+import json
+import numpy
+import os
+import zipfile
+
+class TempoMap (object):
+
+    """
+    Converts MIDI ticks into seconds and back, given the list of tempo
+    changes of a MIDI file.  The seconds elapsed at every tempo change
+    are summed up once, so that any conversion is a bisection in these
+    prefix sums followed by a linear interpolation at a single tempo.
+
+    The first tempo also applies before its own tick, and when several
+    tempo changes happen on the same tick, the last one wins.
+    """
+
+    def __init__(self, temposList, midiResolution):
+        """
+        Params:
+          - temposList:        list of (tick, bpm) tuples sorted by tick
+          - midiResolution:    resolution of MIDI file
+        """
+        self.temposList = temposList
+        self.midiResolution = midiResolution
+        self.ticks = numpy.array([tick for tick, tempo in temposList],
+                                 dtype=numpy.float64)
+        tempos = numpy.array([tempo for tick, tempo in temposList],
+                             dtype=numpy.float64)
+        self.secsPerTick = 60.0 / (tempos * midiResolution)
+        self.secs = numpy.zeros(len(self.ticks))
+        numpy.cumsum(numpy.diff(self.ticks) * self.secsPerTick[:-1],
+                     out=self.secs[1:])
+
+    def tickToSecs(self, tick):
+        """
+        Returns the time in seconds of the given tick, or of every
+        tick if given an array of ticks.
+        """
+        i = numpy.searchsorted(self.ticks, tick, side='right') - 1
+        i = numpy.maximum(i, 0)
+        return self.secs[i] + (tick - self.ticks[i]) * self.secsPerTick[i]
+
+    def secsToTick(self, secs):
+        """
+        Returns the (fractional) tick played at the given time in
+        seconds, or at every time if given an array of times.
+        """
+        i = numpy.searchsorted(self.secs, secs, side='right') - 1
+        i = numpy.maximum(i, 0)
+        return self.ticks[i] + (secs - self.secs[i]) / self.secsPerTick[i]
+
+    def secsBetween(self, startTick, endTick):
+        return self.tickToSecs(endTick) - self.tickToSecs(startTick)
 
 class TimeCode (Observable):
 
@@ -31,6 +85,10 @@ class TimeCode (Observable):
     gotToNextNote(), nbFramesToNextNote() methods.
     The 'Observer' design pattern to produce frames. The timecode object is a
     kind of 'conductor' of the process
+
+    The whole frame schedule is compiled up front, so that the note
+    shown by any frame can be looked up directly with frameAt(), and
+    goToNote() can then move the observers to it.
     """
 
     def __init__(self, miditicks, temposList, midiResolution, fps):
@@ -46,89 +104,107 @@ class TimeCode (Observable):
         self.fps = fps
         self.__miditicks = miditicks
         self.__currentTickIndex = 0
-        self.tempoIndex  = 0
-        self.temposList = temposList
         self.midiResolution = midiResolution
+        self.temposList = temposList
+        self.__tempoMap = None
 
-        # Keep track of wall clock time to ensure that rounding errors
-        # when aligning indices to frames don't accumulate over time.
-        self.secs = 0.0
-
-        self.__wroteFrames = 0
-
-        firstTempoTick, self.tempo = self.temposList[self.tempoIndex]
+        firstTempoTick, self.tempo = self.temposList[0]
         debug("first tempo is %.3f bpm" % self.tempo)
         debug("final MIDI tick is %d" % self.__miditicks[-1])
 
         self.estimateFrames()
+        self.__compile()
         progress("Writing frames ...")
         if not DEBUG:
             progress("A dot is displayed for every 10 frames generated.")
 
-        initialTick = self.__miditicks[self.__currentTickIndex]
-        if initialTick > 0:
-            #self.__miditicks = [0] + self.__miditicks
-            debug("\ncalculating wall-clock start for first audible MIDI event")
-            # This duration isn't used, but it's necessary to
-            # calculate it like this in order to ensure tempoIndex is
-            # correct before we start writing frames.
-            silentPreludeDuration = \
-                self.secsElapsedForTempoChanges(0, initialTick)
+        self.__setTickIndex(0)
 
+    @property
+    def tempoMap(self):
+        # Rebuilt whenever temposList is replaced.
+        if self.__tempoMap is None or \
+                self.__tempoMap.temposList is not self.temposList:
+            self.__tempoMap = TempoMap(self.temposList, self.midiResolution)
+        return self.__tempoMap
+
+    def __compile(self):
+        """
+        Computes the number of frames needed by every note, then
+        expands them into arrays indexed by frame number:
+          - frameNotes:    index of the note shown by the frame
+          - frameNums:     number of the frame within its note
+          - frameOffsets:  position of the frame in quarter notes
+        """
+        ticks = numpy.array(self.__miditicks, dtype=numpy.float64)
+
+        # Every note ends on the frame nearest to the wall clock time
+        # of the next note.  Rounding these times rather than the
+        # durations of the notes ensures that rounding errors don't
+        # accumulate over the course of the video.
+        secs = self.tempoMap.tickToSecs(ticks) - \
+            self.tempoMap.tickToSecs(ticks[0])
+        noteEndFrames = numpy.floor(secs * self.fps + 0.5).astype(numpy.int64)
+        self.noteFrames = numpy.diff(noteEndFrames)
+
+        # The last note is the final tick, which isn't shown.
+        nbNotes = len(self.noteFrames) - 1
+        self.noteStartFrames = noteEndFrames[:nbNotes + 1]
+        self.frameCount = int(self.noteStartFrames[-1])
+
+        self.frameNotes = numpy.repeat(numpy.arange(nbNotes),
+                                       self.noteFrames[:nbNotes])
+        self.frameNums = (numpy.arange(self.frameCount) -
+                          self.noteStartFrames[self.frameNotes])
+        offsets = ticks / self.midiResolution
+        fractions = (self.frameNums.astype(numpy.float64) /
+                     self.noteFrames[self.frameNotes])
+        self.frameOffsets = (offsets[self.frameNotes] + fractions *
+                             (offsets[self.frameNotes + 1] -
+                              offsets[self.frameNotes]))
+
+    def __setTickIndex(self, index):
+        self.__currentTickIndex = index
         self.__currentTick = self.__miditicks[self.__currentTickIndex]
         self.__nextTick = self.__miditicks[self.__currentTickIndex + 1]
         self.currentOffset = float(self.__currentTick)/self.midiResolution
         self.nextOffset = float(self.__nextTick)/self.midiResolution
 
+    @property
+    def noteIndex(self):
+        return self.__currentTickIndex
 
     def atEnd(self):
         return self.__currentTickIndex + 2 >= len(self.__miditicks)
 
     def goToNextNote (self):
-        self.__currentTickIndex += 1
-        self.__currentTick = self.__miditicks[self.__currentTickIndex]
-        self.__nextTick = self.__miditicks[self.__currentTickIndex+1]
-        self.currentOffset = float(self.__currentTick)/self.midiResolution
-        self.nextOffset = float(self.__nextTick)/self.midiResolution
+        self.__setTickIndex(self.__currentTickIndex + 1)
         ticks = self.__nextTick - self.__currentTick
         debug("ticks: %d -> %d (%d)" % (self.__currentTick, self.__nextTick, ticks))
 
         self.notifyObservers()
 
+    def goToNote (self, noteIndex):
+        """
+        Moves straight to the given note, in either direction.  The
+        observers are only notified once, so they have to catch up
+        with any jump themselves.
+        """
+        self.__setTickIndex(noteIndex)
+        self.notifyObservers()
+
+    def frameAt(self, frame):
+        """
+        Returns a (noteIndex, numFrame, among) tuple for the given
+        frame number: the index of the note it shows, and the number
+        of the frame among the frames of that note.
+        """
+        noteIndex = int(self.frameNotes[frame])
+        return (noteIndex, int(self.frameNums[frame]),
+                int(self.noteFrames[noteIndex]))
+
     def nbFramesToNextNote(self):
-        # If we have 1+ tempo changes in between adjacent indices,
-        # we need to keep track of how many seconds elapsed since
-        # the last one, since this will allow us to calculate how
-        # many frames we need in between the current pair of
-        # indices.
-        secsSinceIndex = self.secsElapsedForTempoChanges(self.__currentTick, self.__nextTick)
-
-        # This is the exact time we are *aiming* for the frameset
-        # to finish at (i.e. the start time of the first frame
-        # generated after the writeVideoFrames() invocation below
-        # has written all the frames for the current frameset).
-        # However, since we have less than an infinite number of
-        # frames per second, there will typically be a rounding
-        # error and we'll miss our target by a small amount.
-        targetSecs = self.secs + secsSinceIndex
-        debug("    secs at new tick %d: %f" % (self.__nextTick, targetSecs))
-
-        # The ideal duration of the current frameset is the target
-        # end time minus the *actual* start time, not the ideal
-        # start time.  This is crucially important to avoid
-        # rounding errors from accumulating over the course of the
-        # video.
-        neededFrameSetSecs = targetSecs - float(self.__wroteFrames)/self.fps
-        debug("    need next frameset to last %f secs" % neededFrameSetSecs)
-
-        debug("    need %f frames @ %.3f fps" % (neededFrameSetSecs * self.fps, self.fps))
-        neededFrames = int(round(neededFrameSetSecs * self.fps))
-        self.__wroteFrames += neededFrames
-        # Update time in the *ideal* (i.e. not real) world - this
-        # is totally independent of fps.
-        self.secs = targetSecs
-
-        return neededFrames
+        return int(self.noteFrames[self.__currentTickIndex])
 
     def secsElapsedForTempoChanges(self, startTick, endTick):
         """
@@ -136,35 +212,7 @@ class TimeCode (Observable):
         where the only MIDI events in between (if any) are tempo
         change events.
         """
-        secsSinceStartIndex = 0.0
-        lastTick = startTick
-        while self.tempoIndex < len(self.temposList):
-            tempoTick, tempo = self.temposList[self.tempoIndex]
-            debug("    checking tempo #%d @ tick %d: %.3f bpm" %
-                  (self.tempoIndex, tempoTick, tempo))
-            if tempoTick >= endTick:
-                break
-
-            self.tempoIndex += 1
-            self.tempo = tempo
-
-            if tempoTick == startTick:
-                continue
-
-            # startTick < tempoTick < endTick
-            secsSinceStartIndex += self.ticksToSecs(lastTick, tempoTick)
-            debug("        last %d tempo %d" % (lastTick, tempoTick))
-            debug("        secs : %f" %
-                  (secsSinceStartIndex))
-            lastTick = tempoTick
-
-        # Add on the time elapsed between the final tempo change
-        # and endTick:
-        secsSinceStartIndex += self.ticksToSecs(lastTick, endTick)
-
-#        debug("    secs between indices %d and %d: %f" %
-#              (startIndex, endIndex, secsSinceStartIndex))
-        return secsSinceStartIndex
+        return self.tempoMap.secsBetween(startTick, endTick)
 
     def ticksToSecs(self, startTick, endTick):
         beatsSinceTick = float(endTick - startTick) / self.midiResolution
@@ -180,9 +228,101 @@ class TimeCode (Observable):
     def estimateFrames(self):
         approxBeats = float(self.__miditicks[-1]) / self.midiResolution
         debug("approx %.2f MIDI beats" % approxBeats)
-        beatsPerSec = 60.0 / self.tempo
-        approxDuration = approxBeats * beatsPerSec
+        approxDuration = self.tempoMap.tickToSecs(self.__miditicks[-1])
         debug("approx duration: %.2f seconds" % approxDuration)
         estimatedFrames = approxDuration * self.fps
         progress("SYNC: ly2video will generate approx. %d frames at %.3f frames/sec." %
                  (estimatedFrames, self.fps))
+
+class SyncFileError (Exception):
+    pass
+
+class SyncData (object):
+
+    """
+    The outcome of the synchronisation of the score with the MIDI file:
+    the X position of every note, the MIDI ticks they are played at,
+    and the tempo changes.  This is everything needed to generate the
+    video, along with the score image and the MIDI file themselves.
+
+    It can be saved into a sync file, which is a zip archive holding
+    the data as JSON next to these two files, so that the video can
+    be generated again (with other dimensions, cursors, frame rate,
+    padding...) without running LilyPond and the synchronisation.
+    """
+
+    VERSION = 1
+    DATA_FILE = "sync.json"
+
+    def __init__(self, noteIndices, midiTicks, temposList, midiResolution,
+                 measuresXpositions, scorePath, midiPath,
+                 title = None, author = None):
+        """
+        Params:
+          - noteIndices:        X position of every note in the score
+          - midiTicks:          list of ticks with NoteOnEvent
+          - temposList:         list of (tick, bpm) tuples
+          - midiResolution:     resolution of MIDI file
+          - measuresXpositions: X position of every bar line, or None
+          - scorePath:          path of the score image
+          - midiPath:           path of the MIDI file
+          - title:              title of the score, or None
+          - author:             author of the score, or None
+        """
+        self.noteIndices = noteIndices
+        self.midiTicks = midiTicks
+        self.temposList = temposList
+        self.midiResolution = midiResolution
+        self.measuresXpositions = measuresXpositions
+        self.scorePath = scorePath
+        self.midiPath = midiPath
+        self.title = title
+        self.author = author
+
+    def save(self, fileName):
+        data = {
+            "version":            self.VERSION,
+            "noteIndices":        self.noteIndices,
+            "midiTicks":          self.midiTicks,
+            "temposList":         self.temposList,
+            "midiResolution":     self.midiResolution,
+            "measuresXpositions": self.measuresXpositions,
+            "score":              os.path.basename(self.scorePath),
+            "midi":               os.path.basename(self.midiPath),
+            "title":              self.title,
+            "author":             self.author,
+        }
+        with zipfile.ZipFile(fileName, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(self.DATA_FILE, json.dumps(data, separators=(",",":")))
+            # PNG files are already compressed.
+            z.write(self.scorePath, data["score"], zipfile.ZIP_STORED)
+            z.write(self.midiPath, data["midi"])
+
+    @classmethod
+    def load(cls, fileName, destDir):
+        """
+        Loads the given sync file, extracting the score image and the
+        MIDI file into destDir.  Raises SyncFileError if the file
+        can't be read.
+        """
+        try:
+            with zipfile.ZipFile(fileName) as z:
+                data = json.loads(z.read(cls.DATA_FILE))
+                if data.get("version") != cls.VERSION:
+                    raise SyncFileError(
+                        "%s is a version %s sync file, rather than %d" %
+                        (fileName, data.get("version"), cls.VERSION))
+                paths = []
+                for name in (data["score"], data["midi"]):
+                    if os.path.basename(name) != name:
+                        raise SyncFileError("%s holds an invalid file name "
+                                            "%r" % (fileName, name))
+                    paths.append(z.extract(name, destDir))
+            scorePath, midiPath = paths
+            return cls(data["noteIndices"], data["midiTicks"],
+                       [tuple(tempo) for tempo in data["temposList"]],
+                       data["midiResolution"], data["measuresXpositions"],
+                       scorePath, midiPath, data["title"], data["author"])
+        except (IOError, KeyError, TypeError, ValueError,
+                zipfile.BadZipfile) as e:
+            raise SyncFileError("Failed to read %s: %s" % (fileName, e))
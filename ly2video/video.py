@@ -24,26 +24,151 @@
 
 from synchro import *
 from utils import *
+import Queue
+import bisect
+import collections
+import errno
+import itertools
+import math
+import multiprocessing
 import os
+import shutil
+import subprocess
+import threading
+import struct
+import zlib
+import numpy
 from PIL import Image
 
 # Image manipulation functions
 
-def writeCursorLine(image, X, color):
-    """Draws a line on the image"""
-    for pixel in xrange(image.size[1]):
-        image.putpixel((X    , pixel), color)
-        image.putpixel((X + 1, pixel), color)
+def fillRect(image, box, color, coverage=1.0):
+    """
+    Fills a rectangle of the image with the given color.  An RGBA
+    color, or a coverage below 1, blends it with the image instead.
+    """
+    alpha = color[3] if len(color) > 3 else 255
+    alpha = int(round(alpha * coverage))
+    if alpha >= 255:
+        image.paste(color[:3], box)
+    elif alpha > 0:
+        mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), alpha)
+        image.paste(color[:3], box, mask)
+
+def fillColumns(image, start, end, top, bottom, color):
+    """
+    Fills the columns in between start and end, which may be
+    fractional, from top to bottom.  Partially covered columns are
+    blended in proportion to their coverage, so that cursors moving
+    by a fraction of a pixel are anti-aliased.
+    """
+    start = max(start, 0)
+    end = min(end, image.size[0])
+    if end <= start:
+        return
+    left = int(math.ceil(start))
+    right = int(math.floor(end))
+    if right < left:
+        # within a single column
+        fillRect(image, (right, top, left, bottom), color, end - start)
+        return
+    if left > start:
+        fillRect(image, (left - 1, top, left, bottom), color, left - start)
+    if right > left:
+        fillRect(image, (left, top, right, bottom), color)
+    if end > right:
+        fillRect(image, (right, top, right + 1, bottom), color, end - right)
+
+def writeCursorLine(image, X, color, width=2, box=None):
+    """
+    Draws a line on the image, or on the given box of the image, in
+    which X is then relative to the box.
+    """
+    left, top, right, bottom = box or (0, 0) + image.size
+    if X < 0 or X + width > right - left:
+        raise IndexError("cursor at x=%s is outside of the image" % X)
+    fillColumns(image, left + X, left + X + width, top, bottom, color)
 
-def writeMeasureCursor(image, start, end, color, cursor_height=10):
-    """Draws a box at the bottom of the image"""
-    w, h = image.size
+def writeMeasureCursor(image, start, end, color, cursor_height=10, box=None):
+    """
+    Draws a box at the bottom of the image, or at the bottom of the
+    given box of the image, in which start and end are then relative
+    to the box.
+    """
+    left, top, right, bottom = box or (0, 0) + image.size
+    w = right - left
     if start > w :
-        raise Exception()
-    for dx in range(end-start) :
-        for y in xrange(cursor_height):
-            if start + dx < w and start + dx > 0 :
-                image.putpixel((start + dx, h-y-1), color)
+        raise IndexError("measure cursor at x=%s is outside of the image"
+                         % start)
+    start, end = max(start, 0), min(end, w)
+    fillColumns(image, left + start, left + end,
+                max(bottom - cursor_height, top), bottom, color)
+
+def nonWhiteMask(image, threshold=255):
+    """
+    Returns a 2D array of booleans (indexed by y, then x) telling
+    which pixels of the image are not white.  A pixel is white when
+    none of its channels is darker than the threshold, so lowering it
+    lets near-white anti-aliasing count as white.
+    """
+    if image.mode in ("1", "L"):
+        if image.mode == "1":
+            image = image.convert("L")
+        return numpy.asarray(image) < min(threshold, 255)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    pixels = numpy.asarray(image)
+    if threshold >= 255:
+        # a pixel is white if and only if all bits of its channels are set
+        return (pixels[:, :, 0] & pixels[:, :, 1] & pixels[:, :, 2]) != 255
+    darkest = numpy.minimum(numpy.minimum(pixels[:, :, 0], pixels[:, :, 1]),
+                            pixels[:, :, 2])
+    return darkest < threshold
+
+SCORE_MODES = ("RGB", "L", "1")
+
+def convertScore(image, mode):
+    """
+    Converts a score image to one of the SCORE_MODES: RGB, 8-bit
+    grayscale (L) or 1-bit black and white (1).  Unlike
+    Image.convert(), the conversion to 1-bit doesn't dither, since
+    anything darker than mid-gray is ink.
+    """
+    if image.mode == mode:
+        return image
+    if mode == "1":
+        if image.mode != "L":
+            image = image.convert("L")
+        return image.point(lambda value: 255 if value >= 128 else 0, "1")
+    return image.convert(mode)
+
+def columnStrips(image):
+    """
+    Yields (x, strip) pairs of vertical strips of the image, with the
+    x-coordinate of their left edges, which cover the whole image.
+    Images too big to be analysed in one go come in several strips.
+    """
+    if isinstance(image, TiledImage):
+        return image.tiles()
+    return [(0, image)]
+
+def findContentBox(image, threshold=255):
+    """
+    Returns the bounding box (left, top, right, bottom) of the
+    non-white pixels of the image, as defined by nonWhiteMask(), or
+    None if the image is blank.
+    """
+    rows = numpy.zeros(image.size[1], dtype=bool)
+    columns = []
+    for x, strip in columnStrips(image):
+        mask = nonWhiteMask(strip, threshold)
+        rows |= mask.any(axis=1)
+        columns.extend(x + numpy.flatnonzero(mask.any(axis=0)))
+    rows = numpy.flatnonzero(rows)
+    if len(rows) == 0:
+        return None
+    return (int(columns[0]), int(rows[0]),
+            int(columns[-1]) + 1, int(rows[-1]) + 1)
 
 def findTopStaffLine(image, lineLength):
     """
@@ -57,28 +182,29 @@ def findTopStaffLine(image, lineLength):
     - image:        image with staff lines
     - lineLength:   needed length of line to accept it as staff line
     """
+    width, height = image.size
+
     # position of the first line on image
     firstLinePos = (-1, -1)
 
-    width, height = image.size
-
-    # Start searching at the hard left but allow for a left margin.
-    for x in xrange(width):
-        for y in xrange(height):
-            for length in xrange(lineLength):
-                # testing color of pixels in range (startPos, startPos + lineLength)
-                if image.getpixel((x + length, y)) == (255,255,255):
-                    # if it's white then it's not a staff line
-                    firstLinePos = (-1, -1)
-                    break
-                else:
-                    # else it can be
-                    firstLinePos = (x, y)
-            # when have a valid position, break out
-            if firstLinePos != (-1, -1):
-                break
-        if firstLinePos != (-1, -1):
-            break
+    # Only rows with at least lineLength non-white pixels can contain
+    # a staff line, and there are very few of them.
+    darkness = numpy.zeros(height, dtype=numpy.int64)
+    for x, strip in columnStrips(image):
+        darkness += numpy.count_nonzero(nonWhiteMask(strip), axis=1)
+    rows = numpy.flatnonzero(darkness >= lineLength)
+    for y in rows:
+        # find the runs of non-white pixels in the row
+        row = nonWhiteMask(image.crop((0, y, width, y + 1)))[0]
+        edges = numpy.diff(numpy.concatenate(([0], row.view(numpy.int8),
+                                              [0])))
+        starts = numpy.flatnonzero(edges == 1)
+        ends = numpy.flatnonzero(edges == -1)
+        longRuns = starts[ends - starts >= lineLength]
+        # keep the left-most line, and the top-most one at that x
+        if len(longRuns) and (firstLinePos[0] == -1 or
+                              longRuns[0] < firstLinePos[0]):
+            firstLinePos = (int(longRuns[0]), int(y))
 
     progress("First staff line found at (%d, %d)" % firstLinePos)
     return firstLinePos
@@ -100,33 +226,543 @@ def findStaffLinesInImage(image, lineLength):
     # all staffs together
     firstLineX += 3
 
-    lines = []
-    newLine = True
+    if firstLineY < 0:
+        return firstLineX, []
+
+    # every non-white pixel below a white one (or below the first
+    # line) in that column starts a new staff line
+    width, height = image.size
+    column = nonWhiteMask(image.crop((firstLineX, firstLineY,
+                                      firstLineX + 1, height)))[:, 0]
+    newLines = column & numpy.concatenate(([True], ~column[:-1]))
+    lines = [int(y) + firstLineY for y in numpy.flatnonzero(newLines)]
+
+    # return staff line indices
+    return firstLineX, lines
+
+# Channels of every PNG colour type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
 
+def pngRowBands(image, bandBytes):
+    """
+    Yields (top, band) pairs of horizontal bands of the rows of a PNG
+    image opened by PIL but not loaded, decoding about bandBytes of
+    pixel data at a time, or returns None if the image can't be
+    decoded that way: only non-interlaced PNG files whose pixels PIL
+    stores as they are (8-bit, or 1-bit black and white) can.
+
+    The compressed data is inflated by zlib as far as the band needs.
+    The rows are unfiltered by PIL's own PNG decoder, fed with the
+    filtered rows of the band preceded by the last row of the
+    previous band, unfiltered, which the filters may refer to.
+    """
+    if image.format != "PNG" or len(image.tile) != 1 or \
+            image.tile[0][0] != "zip" or image.tile[0][3] != image.mode:
+        return None
+    with open(image.filename, "rb") as f:
+        f.seek(8)
+        length, chunkType = struct.unpack(">I4s", f.read(8))
+        header = f.read(length)
+    width, height, bitDepth, colorType = struct.unpack(">IIBB", header[:10])
+    if chunkType != "IHDR" or ord(header[12]) != 0:
+        return None
+    rowBytes = (width * bitDepth * PNG_CHANNELS[colorType] + 7) / 8
+    return _pngRowBands(image, rowBytes, max(bandBytes / rowBytes, 1))
+
+def _pngRowBands(image, rowBytes, bandRows):
     width, height = image.size
+    stride = rowBytes + 1 # each row starts with its filter type
+
+    def filteredRows():
+        # the compressed data of every IDAT chunk, inflated a band at a
+        # time
+        inflater = zlib.decompressobj()
+        with open(image.filename, "rb") as f:
+            f.seek(8)
+            while True:
+                length, chunkType = struct.unpack(">I4s", f.read(8))
+                if chunkType == "IEND":
+                    break
+                data = f.read(length)
+                f.read(4) # CRC
+                if chunkType != "IDAT":
+                    continue
+                while data:
+                    yield inflater.decompress(data, bandRows * stride)
+                    data = inflater.unconsumed_tail
+
+    rows = filteredRows()
+    data = ""
+    previousRow = None
+    for top in xrange(0, height, bandRows):
+        count = min(bandRows, height - top)
+        pending = [data]
+        size = len(data)
+        while size < count * stride:
+            data = next(rows, None)
+            if data is None:
+                raise IOError("%s is truncated" % image.filename)
+            pending.append(data)
+            size += len(data)
+        data = "".join(pending)
+        raw, data = data[:count * stride], data[count * stride:]
+        if previousRow is not None:
+            raw = "\0" + previousRow + raw
+        band = Image.frombytes(image.mode, (width, len(raw) / stride),
+                               zlib.compress(raw, 0), "zip", image.mode)
+        if image.mode == "P":
+            band.putpalette(image.palette)
+        previousRow = band.crop((0, band.size[1] - 1, width,
+                                 band.size[1])).tobytes()
+        if band.size[1] > count:
+            band = band.crop((0, 1, width, count + 1))
+        yield top, band
+
+class TiledImage (object):
+
+    """
+    A read-only score image stored in a raw file as vertical tiles,
+    which is memory-mapped rather than held in memory.  Cropping a
+    region only pages in the tiles it overlaps, so the memory used
+    while rendering doesn't depend on the width of the score.
+
+    The tiles are stored in one of the SCORE_MODES; 1-bit tiles are
+    packed 8 pixels per byte.  It supports the subset of the PIL
+    Image interface which the ScoreImage needs: size, mode and crop().
+    """
+
+    def __init__ (self, path, size, tileWidth, mode = "RGB"):
+        """
+        Params:
+          - path:              raw file holding the tiles
+          - size:              (width, height) of the image
+          - tileWidth:         pixel width of the tiles, which must
+                               be a multiple of 8 for 1-bit tiles
+          - mode:              one of the SCORE_MODES
+        """
+        if mode == "1" and tileWidth % 8:
+            raise ValueError("1-bit tiles must be a multiple of 8 wide")
+        self.path = path
+        self.size = size
+        self.tileWidth = tileWidth
+        self.mode = mode
+        self.__tiles = numpy.memmap(path, dtype=numpy.uint8, mode="r",
+                                    shape=self.__shape(size, tileWidth, mode))
+
+    @staticmethod
+    def __shape (size, tileWidth, mode):
+        width, height = size
+        tileCount = (width + tileWidth - 1) / tileWidth
+        return {
+            "RGB": (tileCount, height, tileWidth, 3),
+            "L":   (tileCount, height, tileWidth),
+            "1":   (tileCount, height, tileWidth / 8),
+        }[mode]
+
+    @classmethod
+    def fromImage (cls, image, path, tileWidth = 1024, mode = "RGB"):
+        """
+        Writes the image as tiles into the given raw file, and
+        returns the TiledImage reading them.
+        """
+        width, height = image.size
+        with open(path, "wb") as f:
+            for x in xrange(0, width, tileWidth):
+                tile = image.crop((x, 0, min(x + tileWidth, width), height))
+                tile = convertScore(tile, mode)
+                if tile.size[0] < tileWidth:
+                    # pad the last tile
+                    padded = Image.new(mode, (tileWidth, height), "white")
+                    padded.paste(tile, (0, 0))
+                    tile = padded
+                f.write(tile.tobytes())
+        return cls(path, image.size, tileWidth, mode)
+
+    @classmethod
+    def fromBands (cls, bands, size, path, tileWidth = 1024, mode = "RGB"):
+        """
+        Writes the (top, band) pairs of horizontal bands of an image
+        as tiles into the given raw file, and returns the TiledImage
+        reading them.  Only one band is held in memory at a time.
+        """
+        shape = cls.__shape(size, tileWidth, mode)
+        tileCount, height = shape[:2]
+        tileBytes = numpy.prod(shape[1:])
+        rowBytes = tileBytes / height
+        with open(path, "wb") as f:
+            f.truncate(tileCount * tileBytes)
+            for top, band in bands:
+                pixels = numpy.asarray(convertScore(band, mode))
+                count, width = pixels.shape[:2]
+                # pad the last tile
+                padded = numpy.empty((count, tileCount * tileWidth) +
+                                     pixels.shape[2:], dtype=pixels.dtype)
+                padded[:, width:] = True if mode == "1" else 255
+                padded[:, :width] = pixels
+                padded = padded.reshape((count, tileCount, tileWidth) +
+                                        pixels.shape[2:])
+                if mode == "1":
+                    padded = numpy.packbits(padded, axis=2)
+                # the rows of the band are contiguous in every tile
+                for i in xrange(tileCount):
+                    f.seek(i * tileBytes + top * rowBytes)
+                    f.write(padded[:, i].tostring())
+        return cls(path, size, tileWidth, mode)
+
+    @classmethod
+    def open (cls, fileName, path, tileWidth = 1024, mode = "RGB",
+              bandBytes = 4 * 1024 * 1024):
+        """
+        Decodes an image file into tiles in the given raw file.  The
+        PNG files LilyPond makes are decoded a band of about bandBytes
+        at a time, so the whole picture is never held in memory.
+        Other images are decoded whole, in their own mode, and
+        converted one tile at a time.
+        """
+        # LilyPond output is trusted, however big it is
+        maxPixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            image = Image.open(fileName)
+            bands = pngRowBands(image, bandBytes)
+            if bands is None:
+                image.load()
+        finally:
+            Image.MAX_IMAGE_PIXELS = maxPixels
+        if bands is None:
+            return cls.fromImage(image, path, tileWidth, mode)
+        return cls.fromBands(bands, image.size, path, tileWidth, mode)
+
+    def __pixels (self, i, top, bottom, start, end):
+        """
+        Returns the pixels of the i-th tile in between the given rows
+        and columns (relative to the tile) as an array which
+        Image.fromarray() turns into an image of the right mode.
+        """
+        if self.mode != "1":
+            return self.__tiles[i, top:bottom, start:end]
+        packed = self.__tiles[i, top:bottom, start / 8:(end + 7) / 8]
+        bits = numpy.unpackbits(packed, axis=-1)
+        offset = start - start / 8 * 8
+        return bits[:, offset:offset + end - start].astype(bool)
+
+    def tiles (self):
+        """
+        Yields (x, tile) pairs of the tiles as PIL images, with the
+        x-coordinate of their left edges.
+        """
+        width, height = self.size
+        for i in xrange(len(self.__tiles)):
+            x = i * self.tileWidth
+            yield (x, Image.fromarray(self.__pixels(
+                i, 0, height, 0, min(self.tileWidth, width - x))))
 
-    for y in xrange(firstLineY, height):
-        # if color of that pixel isn't white
-        if image.getpixel((firstLineX, y)) != (255,255,255):
-            # and it can be new staff line
-            if newLine:
-                # accept it
-                newLine = False
-                lines.append(y)
+    def crop (self, box):
+        """
+        Returns the given region as a PIL image.  As with PIL, the
+        parts of the region outside of the image are black.
+        """
+        left, top, right, bottom = box
+        width, height = self.size
+        shape = (bottom - top, right - left)
+        if self.mode == "RGB":
+            region = numpy.zeros(shape + (3,), dtype=numpy.uint8)
+        elif self.mode == "L":
+            region = numpy.zeros(shape, dtype=numpy.uint8)
         else:
-            # it's space between lines
-            newLine = True
+            region = numpy.zeros(shape, dtype=bool)
+        y0, y1 = max(top, 0), min(bottom, height)
+        x0, x1 = max(left, 0), min(right, width)
+        for i in xrange(x0 / self.tileWidth,
+                        (x1 + self.tileWidth - 1) / self.tileWidth):
+            tileLeft = i * self.tileWidth
+            start = max(x0, tileLeft)
+            end = min(x1, tileLeft + self.tileWidth)
+            region[y0 - top:y1 - top, start - left:end - left] = \
+                self.__pixels(i, y0, y1, start - tileLeft, end - tileLeft)
+        return Image.fromarray(region)
+
+class FrameSink (object):
 
-    del image
+    """
+    Abstract destination for the frames generated by the
+    VideoFrameWriter. PngFrameSink and PipeFrameSink inherit from it.
 
-    # return staff line indices
-    return firstLineX, lines
+    The frames are composed into reused buffers: a frame which is
+    written is only left intact until the next frame is written.
+
+    When duplicate frames are dropped, finalRepeats is set before the
+    sink is opened to the number of repeated frames it will end with.
+    """
+
+    finalRepeats = 0
+
+    def open (self, width, height, fps):
+        pass
+
+    def write (self, frame):
+        pass
+
+    def repeat (self, frame):
+        """
+        Shows the last frame written once more.  Only called by a
+        VideoFrameWriter dropping duplicate frames, with a copy of
+        that frame, which is written again by default.
+        """
+        self.write(frame)
+
+    def close (self):
+        pass
+
+class PngFrameSink (FrameSink):
+
+    """
+    Saves every frame as a PNG file in the notes/ subdirectory of the
+    temporary directory, and lists them with their durations in
+    notes.txt, to be encoded afterwards by ffmpeg's concat demuxer.
+    This is slow and uses a lot of disk space, but it leaves every
+    single frame around for debugging.
+
+    A repeated frame isn't saved again, but shown for longer, so the
+    video gets a variable frame rate.
+    """
+
+    def __init__ (self, dirName = "notes"):
+        self.dirName = dirName
+        self.frameNum = 0
+        self.fps = None
+        self.__starts = []
+
+    @property
+    def listPath (self):
+        return tmpPath(self.dirName + ".txt")
+
+    def __framePath (self, frameNum):
+        return tmpPath(self.dirName, "frame%d.png" % frameNum)
+
+    def open (self, width, height, fps):
+        if not os.path.exists(tmpPath(self.dirName)):
+            os.mkdir(tmpPath(self.dirName))
+        self.fps = fps
+
+    def write (self, frame):
+        frame.save(self.__framePath(self.frameNum))
+        self.__starts.append(self.frameNum)
+        self.frameNum += 1
+
+    def repeat (self, frame):
+        self.frameNum += 1
+
+    def close (self):
+        if not self.__starts:
+            return
+        lastFrame = self.frameNum - 1
+        if self.__starts[-1] != lastFrame:
+            # The last frame is listed on its own, so that it starts
+            # where it does in the schedule, and the final padding is
+            # made of it.
+            shutil.copy(self.__framePath(self.__starts[-1]),
+                        self.__framePath(lastFrame))
+            self.__starts.append(lastFrame)
+        with open(self.listPath, "w") as f:
+            for start, end in zip(self.__starts, self.__starts[1:]):
+                # rounding the start and the end rather than the
+                # duration keeps rounding errors from adding up
+                duration = round(end / float(self.fps), 6) - \
+                    round(start / float(self.fps), 6)
+                f.write("file '%s'\nduration %.6f\n" %
+                        (self.__framePath(start), duration))
+            # the duration of the last frame is only taken into account
+            # when it is followed by another one, so it is left to
+            # last one frame like any other
+            f.write("file '%s'\n" % self.__framePath(lastFrame))
+
+class PipeFrameSink (FrameSink):
+
+    """
+    Streams the frames as raw RGB data through a pipe into a single
+    ffmpeg process while they are being rendered, so no intermediate
+    image files are needed.  Writes to the pipe block whenever ffmpeg
+    falls behind, so rendering never runs ahead of the encoder.
+
+    The first and the last frames are still saved as PNG files in the
+    notes/ subdirectory, since the padding segments are made of them.
+    """
+
+    def __init__ (self, ffmpeg, outputPath, encoderArgs = [],
+                  dirName = "notes", firstFrame = 0, variableRate = False):
+        """
+        Params:
+          - ffmpeg:            path to the ffmpeg executable
+          - outputPath:        video file written by ffmpeg
+          - encoderArgs:       extra ffmpeg output options
+          - dirName:           where the first and last frames go
+          - firstFrame:        number of the first frame in the whole
+                               video, when this is only a segment
+          - variableRate:      have ffmpeg drop the repeated frames and
+                               show the previous ones for longer
+        """
+        self.ffmpeg = ffmpeg
+        self.outputPath = outputPath
+        self.encoderArgs = encoderArgs
+        self.dirName = dirName
+        self.firstFrame = firstFrame
+        self.variableRate = variableRate
+        self.frameNum = 0
+        self.__size = None
+        self.__lastData = None
+        self.__process = None
+
+    def open (self, width, height, fps):
+        if not os.path.exists(tmpPath(self.dirName)):
+            os.mkdir(tmpPath(self.dirName))
+        self.__size = (width, height)
+        cmd = [
+            self.ffmpeg,
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-s", "%dx%d" % (width, height),
+            "-r", str(fps),
+            "-i", "-",
+        ]
+        if self.variableRate:
+            # Raw frames have no duration, so the repeated ones are sent
+            # again and dropped by ffmpeg, which keeps the timestamps of
+            # the others.  Only exact duplicates are dropped.
+            filters = ["mpdecimate=hi=0:lo=0:frac=0:max=0"]
+            if self.finalRepeats:
+                # A frame lasts until the next one, so the last one
+                # has to be repeated for real, or the video would end
+                # early.
+                filters.append("tpad=stop=%d:stop_mode=clone" %
+                               self.finalRepeats)
+            cmd += ["-vf", ",".join(filters), "-vsync", "vfr"]
+        cmd += list(self.encoderArgs) + [self.outputPath]
+        debug("Running: %s\n" % " ".join(cmd))
+        try:
+            self.__process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        except OSError as e:
+            fatal("Failed to run %s: %s" % (self.ffmpeg, e), 15)
+
+    def write (self, frame):
+        if frame.mode != "RGB":
+            frame = frame.convert("RGB")
+        if frame.size != self.__size:
+            bug("Frame %d is %dx%d but ffmpeg expects %dx%d" %
+                ((self.frameNum,) + frame.size + self.__size))
+        self.__send(frame.tobytes())
+        if self.frameNum == 0:
+            self.__saveFrame(frame, 0)
+        self.frameNum += 1
+
+    def repeat (self, frame):
+        self.__send(self.__lastData)
+        self.frameNum += 1
+
+    def __send (self, data):
+        if self.__process.poll() is not None:
+            self.__died()
+        try:
+            self.__process.stdin.write(data)
+        except IOError as e:
+            if e.errno not in (errno.EPIPE, errno.EINVAL):
+                raise
+            self.__died()
+        self.__lastData = data
+
+    def close (self):
+        self.__process.stdin.close()
+        status = self.__process.wait()
+        if status != 0:
+            fatal("ffmpeg failed with exit status %d while encoding %s; "
+                  "please check its output above." %
+                  (status, self.outputPath), 15)
+        if self.__lastData is not None:
+            # the frame itself may have been reused by now, but not the
+            # data sent for it
+            lastFrame = Image.frombytes("RGB", self.__size, self.__lastData)
+            self.__saveFrame(lastFrame, self.frameNum - 1)
+
+    def __saveFrame (self, frame, frameNum):
+        frame.save(tmpPath(self.dirName,
+                           "frame%d.png" % (self.firstFrame + frameNum)))
+
+    def __died (self):
+        status = self.__process.wait()
+        fatal("ffmpeg exited with status %d after receiving %d frames; "
+              "please check its output above." % (status, self.frameNum), 15)
+
+class WorkerExit (Exception):
+    """
+    Raised in the parent process when a rendering worker has called
+    fatal(); the message has already been printed by the worker.
+    """
+    pass
+
+# The VideoFrameWriter copy of the rendering workers.
+_workerFrameWriter = None
+
+def _initRenderWorker(frameWriter):
+    global _workerFrameWriter
+    _workerFrameWriter = frameWriter
 
+def _renderChunk(bounds):
+    start, end = bounds
+    try:
+        return [None if frame is None else frame.tobytes() for frame in
+                _workerFrameWriter.renderFrames(start, end)]
+    except SystemExit as e:
+        # A worker which exits would leave the pool waiting forever.
+        raise WorkerExit(e.code)
+
+class FrameCompositor (object):
+
+    """
+    Stacks the frames of several medias into the frames of the video,
+    from the bottom of the video upwards.  The layout is computed
+    once, and the frames are composed into two preallocated buffers
+    used in turn, so that the previous frame is left intact while
+    the next one is composed.
+
+    A media whose frameKey() is the same as the one of the frame last
+    composed into a buffer is not painted again into that buffer.
+    """
+
+    def __init__ (self, width, height, medias):
+        """
+        Params:
+          - width:             pixel width of the video frames
+          - height:            pixel height of the video frames
+          - medias:            medias from the bottom one upwards
+        """
+        self.layout = []
+        bottom = height
+        for media in medias:
+            top = bottom - media.height
+            self.layout.append((media, (0, top, media.width, bottom)))
+            bottom = top
+        self.__buffers = [Image.new("RGB", (width, height), "white")
+                          for i in xrange(2)]
+        self.__keys = [[None] * len(medias) for buffer in self.__buffers]
+        self.__current = 0
+
+    def compose (self, numFrame, among):
+        self.__current = 1 - self.__current
+        frame = self.__buffers[self.__current]
+        keys = self.__keys[self.__current]
+        for i, (media, box) in enumerate(self.layout):
+            key = media.frameKey(numFrame, among)
+            if key is not None and key == keys[i]:
+                continue
+            media.paintFrame(frame, box, numFrame, among)
+            keys[i] = key
+        return frame
 
 class VideoFrameWriter(object):
     """
     Generates frames for the final video, synchronized with audio.
-    Each frame is written to disk as a PNG file.
+    Each frame is handed over to a FrameSink, which either streams it
+    into ffmpeg or saves it to disk as a PNG file.
 
     Counts time between starts of two notes, gets their positions on
     image and generates needed amount of frames. The index of the last
@@ -141,7 +777,7 @@ class VideoFrameWriter(object):
     """
 
     def __init__(self, fps, cursorLineColor,
-                 midiResolution, midiTicks, temposList):
+                 midiResolution, midiTicks, temposList, workers = 1):
         """
         Params:
           - videoDef:          Strict definition of the final video
@@ -150,8 +786,16 @@ class VideoFrameWriter(object):
           - midiResolution:    resolution of MIDI file
           - midiTicks:         list of ticks with NoteOnEvent
           - temposList:        list of possible tempos in MIDI
+          - workers:           number of processes rendering frames
         """
         self.frameNum    = 0
+        self.workers = workers
+        # Number of consecutive frames rendered by a worker in one go
+        self.chunkFrames = 12
+        # Whether frames looking the same as the previous one are only
+        # repeated by the sinks, rather than rendered again
+        self.dropDuplicates = False
+        self.__duplicates = None
 
         # In cursor scrolling mode, this is the x-coordinate in the
         # original image of the left edge of the frame (i.e. the
@@ -167,6 +811,7 @@ class VideoFrameWriter(object):
 
         self.__scoreImage = None
         self.__medias = []
+        self.__compositor = None
         self.__timecode = TimeCode (midiTicks,temposList,midiResolution,fps)
 
     def push (self, media):
@@ -178,6 +823,15 @@ class VideoFrameWriter(object):
     def scoreImage (self):
         return self.__scoreImage
 
+    @property
+    def medias (self):
+        """The medias stacked above the score image."""
+        return list(self.__medias)
+
+    @property
+    def timecode (self):
+        return self.__timecode
+
     @scoreImage.setter
     def scoreImage (self, scoreImage):
         self.width = scoreImage.width
@@ -186,40 +840,196 @@ class VideoFrameWriter(object):
         self.__scoreImage.cursorLineColor = self.cursorLineColor
         self.__timecode.registerObserver(scoreImage)
 
-    def write (self):
-        # folder to store frames for video
-        if not os.path.exists("notes"):
-            os.mkdir("notes")
-
-        while not self.__timecode.atEnd() :
-            neededFrames = self.__timecode.nbFramesToNextNote()
-            for i in xrange(neededFrames):
-                videoFrame = self.__makeFrame(i, neededFrames)
-                # Save the frame.  ffmpeg doesn't work if the numbers in these
-                # filenames are zero-padded.
-                videoFrame.save(tmpPath("notes", "frame%d.png" % self.frameNum))
+    def write (self, sink = None):
+        """
+        Generates all the frames and hands them over to the sink,
+        which defaults to a PngFrameSink.
+        """
+        if sink is None:
+            sink = PngFrameSink()
+        self.writeSegments([(0, self.__timecode.frameCount, sink)])
+
+    def segmentBounds (self, count):
+        """
+        Splits the video into at most count segments of about the same
+        length, which start with a note, and returns their (start, end)
+        frame ranges.
+        """
+        frameCount = self.__timecode.frameCount
+        noteStartFrames = self.__timecode.noteStartFrames
+        bounds = [0]
+        for i in xrange(1, count):
+            target = float(i) * frameCount / count
+            j = numpy.searchsorted(noteStartFrames, target)
+            if j > 0 and (j == len(noteStartFrames) or
+                          target - noteStartFrames[j - 1] <
+                          noteStartFrames[j] - target):
+                j -= 1
+            bound = int(noteStartFrames[j])
+            if bounds[-1] < bound < frameCount:
+                bounds.append(bound)
+        bounds.append(frameCount)
+        return zip(bounds[:-1], bounds[1:])
+
+    def writeSegments (self, segments):
+        """
+        Generates the frames of consecutive segments of the video, as
+        returned by segmentBounds(), and hands them over to the sink of
+        their segment.
+
+        Params:
+          - segments:          list of (start, end, sink) tuples
+
+        The frames are generated in chunks taken from every segment in
+        turn, so that the encoders of all the sinks work at the same
+        time.
+        """
+        self.compile()
+
+        self.__duplicates = None
+        if self.dropDuplicates:
+            self.__duplicates = self.duplicateFrames()
+            # every sink needs a frame to repeat
+            for start, end, sink in segments:
+                if start < len(self.__duplicates):
+                    self.__duplicates[start] = False
+                    kept = numpy.flatnonzero(~self.__duplicates[start:end])
+                    sink.finalRepeats = end - start - 1 - kept[-1]
+            progress("%d frames out of %d are repeated" %
+                     (self.__duplicates.sum(), len(self.__duplicates)))
+
+        segmentChunks = [
+            [(chunk, min(chunk + self.chunkFrames, end))
+             for chunk in xrange(start, end, self.chunkFrames)]
+            for start, end, sink in segments]
+        chunks = [(i, chunk) for chunkRow in
+                  itertools.izip_longest(*segmentChunks)
+                  for i, chunk in enumerate(chunkRow) if chunk is not None]
+
+        if self.workers > 1:
+            # The pool has to be forked before the sinks start their
+            # encoders, otherwise the workers would hold the encoders'
+            # input open.
+            pool = multiprocessing.Pool(self.workers,
+                                        _initRenderWorker, (self,))
+            frames = self.__renderInParallel(pool, chunks)
+        else:
+            pool = None
+            frames = ((i, frame) for i, (start, end) in chunks
+                      for frame in self.__render(start, end))
+
+        # the frame numbers reached by every segment, and a copy of the
+        # last frame written to it when it is about to be repeated,
+        # since the buffers are reused by the other segments meanwhile
+        nextFrames = [start for start, end, sink in segments]
+        lastFrames = [None] * len(segments)
+        for start, end, sink in segments:
+            sink.open(self.width, self.height, self.fps)
+        try:
+            for i, videoFrame in frames:
+                start, end, sink = segments[i]
+                if videoFrame is None:
+                    sink.repeat(lastFrames[i])
+                else:
+                    sink.write(videoFrame)
+                    following = nextFrames[i] + 1
+                    if self.__duplicates is not None and \
+                       following < end and self.__duplicates[following]:
+                        lastFrames[i] = videoFrame.copy()
+                nextFrames[i] += 1
                 self.frameNum += 1
                 if not DEBUG and self.frameNum % 10 == 0:
                     sys.stdout.write(".")
                     sys.stdout.flush()
+        except WorkerExit as e:
+            pool.terminate()
+            sys.exit(e.args[0])
 
-            self.__timecode.goToNextNote()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for start, end, sink in segments:
+            sink.close()
 
+    def compile (self):
+        """
+        Has every media compile the frame schedule of the timecode.
+        This is done by write(), and has to be done before calling
+        renderFrames() directly.
+        """
+        self.__scoreImage.compile(self.__timecode)
+        for media in self.__medias :
+            media.compile(self.__timecode)
+        self.__compositor = None
 
-    def __makeFrame (self, numFrame, among):
-        debug("        writing frame %d" % (self.frameNum))
+    def duplicateFrames (self):
+        """
+        Returns an array telling which frames look the same as the
+        previous one, because every media gives them the same
+        frameKey().  This only walks the schedule, without rendering
+        anything, and has to be done after compile().
+        """
+        medias = [self.__scoreImage] + self.__medias
+        duplicates = numpy.zeros(self.__timecode.frameCount, dtype=bool)
+        previousKeys = None
+        for frame in xrange(self.__timecode.frameCount):
+            noteIndex, numFrame, among = self.__timecode.frameAt(frame)
+            if noteIndex != self.__timecode.noteIndex:
+                self.__timecode.goToNote(noteIndex)
+            keys = [media.frameKey(numFrame, among) for media in medias]
+            duplicates[frame] = None not in keys and keys == previousKeys
+            previousKeys = keys
+        return duplicates
+
+    def renderFrames (self, start, end):
+        """
+        Yields the frames numbered from start to end - 1, or None for
+        the duplicate frames when they are dropped.  Every frame is only
+        valid until the next but one frame is yielded.
+        """
+        return self.__render(start, end)
 
-        videoFrame = Image.new("RGB", (self.width,self.height), "white")
-        scoreFrame = self.__scoreImage.makeFrame(numFrame, among)
-        w, h =  scoreFrame.size
-        videoFrame.paste(scoreFrame,(0,self.height-h,w,self.height))
-        for media in self.__medias :
-            mediaFrame = media.makeFrame(numFrame, among)
-            wm, hm =  mediaFrame.size
-            w = max(w,wm)
-            h += hm
-            videoFrame.paste(mediaFrame, (0,self.height-h,wm,self.height-h+hm))
-        return videoFrame
+    def __render (self, start, end):
+        """
+        Renders the given range of frames.  The timecode is moved
+        directly to the note of each frame, so any range can be
+        rendered in any order.
+        """
+        if self.__compositor is None:
+            self.__compositor = FrameCompositor(
+                self.width, self.height, [self.__scoreImage] + self.__medias)
+        for frame in xrange(start, min(end, self.__timecode.frameCount)):
+            if self.__duplicates is not None and self.__duplicates[frame]:
+                yield None
+                continue
+            noteIndex, numFrame, among = self.__timecode.frameAt(frame)
+            if noteIndex != self.__timecode.noteIndex:
+                self.__timecode.goToNote(noteIndex)
+            debug("        writing frame %d" % frame)
+            yield self.__compositor.compose(numFrame, among)
+
+    def __renderInParallel (self, pool, chunks):
+        """
+        Has the given (segment, (start, end)) chunks of consecutive
+        frames rendered by the pool, and yields the (segment, frame)
+        pairs back in order.  The number of chunks in flight is bounded
+        so that rendering doesn't run ahead of the sinks.
+        """
+        progress("Rendering frames with %d processes" % self.workers)
+        chunks = collections.deque(chunks)
+        pending = collections.deque()
+        while chunks or pending:
+            while chunks and len(pending) < 2 * self.workers:
+                i, bounds = chunks.popleft()
+                pending.append((i, pool.apply_async(_renderChunk,
+                                                    (bounds,))))
+            i, result = pending.popleft()
+            for data in result.get():
+                if data is None:
+                    yield i, None
+                else:
+                    yield i, Image.frombytes("RGB", (self.width, self.height),
+                                             data)
 
 
 class BlankScoreImageError (Exception):
@@ -245,6 +1055,38 @@ class Media (object):
         return self.__height
 
     def makeFrame (self, numframe, among):
+        """
+        Returns the image of the given frame.  The image may be reused
+        by the next call, so it has to be consumed before then.
+        """
+        pass
+
+    def paintFrame (self, frame, box, numFrame, among):
+        """
+        Paints the given frame into the box of an RGB frame of the
+        video.  This pastes the image made by makeFrame(), unless the
+        media can paint straight into the frame of the video.
+        """
+        mediaFrame = self.makeFrame(numFrame, among)
+        if mediaFrame.size != (box[2] - box[0], box[3] - box[1]):
+            # don't leave anything from a bigger previous frame
+            frame.paste("white", box)
+        frame.paste(mediaFrame, box[:2])
+
+    def frameKey (self, numFrame, among):
+        """
+        Returns a value which is the same for any two frames that look
+        the same, or None if that is unknown.  Frames with the same
+        key don't need to be made again.
+        """
+        return None
+
+    def compile (self, timecode):
+        """
+        Called with the compiled timecode before any frame is made,
+        so that the media can precompute whatever it needs to make
+        any frame of the schedule directly.
+        """
         pass
 
     def update (self, timecode):
@@ -260,7 +1102,7 @@ class ScoreImage (Media):
     This class handles the 'measure cursor', a new type of cursor.
     """
 
-    def __init__ (self, width, height, picture, notesXpostions, measuresXpositions, leftMargin = 50, rightMargin = 50, scrollNotes = False, noteCursor = True):
+    def __init__ (self, width, height, picture, notesXpostions, measuresXpositions, leftMargin = 50, rightMargin = 50, scrollNotes = False, noteCursor = True, blankThreshold = 255):
         """
         Params:
           - width:             pixel width of frames (and video)
@@ -274,6 +1116,8 @@ class ScoreImage (Media):
                                cursor scrolling mode is enabled
           - scrollNotes:       False selects cursor scrolling mode,
                                True selects note scrolling mode
+          - blankThreshold:    pixels with no channel darker than this
+                               are white when cropping the margins
         """
         Media.__init__(self, width, height)
         self.__picture = picture
@@ -284,8 +1128,8 @@ class ScoreImage (Media):
         #self.__measuresXpositions.append(self.__measuresXpositions[-1])
         self.__currentMeasureIndex = 0
         self.__currentNotesIndex = 0
-        self.__topCroppable = None
-        self.__bottomCroppable = None
+        self.blankThreshold = blankThreshold
+        self.__contentBox = None
         self.leftMargin = leftMargin
         self.rightMargin = rightMargin
         self.__leftEdge = None
@@ -294,6 +1138,19 @@ class ScoreImage (Media):
         self.__noteCursor = noteCursor
         self.scrollNotes = scrollNotes
         self.cursorLineColor = (255,0,0)
+        # Whether the note cursor is drawn at fractional positions in
+        # between notes rather than rounded to whole pixels
+        self.antialiasCursor = False
+        # Number of cropped windows cached in cursor scrolling mode
+        self.baseWindowCacheSize = 4
+        self.__baseWindows = collections.OrderedDict()
+        self.__frameBuffer = None
+        # Set by compile()
+        self.__noteStartFrames = None
+        self.__frameIndices = None
+        self.__frameViewports = None
+        self.__frameMeasures = None
+        self.__noteMeasureIndices = None
 
     @property
     def currentXposition (self):
@@ -309,14 +1166,63 @@ class ScoreImage (Media):
             if self.currentXposition > self.__measuresXpositions[self.__currentMeasureIndex+1] :
                 self.__currentMeasureIndex += 1
 
+    def moveToNote (self, noteIndex):
+        if self.__noteMeasureIndices is not None and \
+                noteIndex < len(self.__noteMeasureIndices):
+            # compiled: jump straight there, in either direction
+            self.__currentNotesIndex = noteIndex
+            self.__currentMeasureIndex = \
+                int(self.__noteMeasureIndices[noteIndex])
+            return
+        if noteIndex < self.__currentNotesIndex:
+            self.__currentNotesIndex = 0
+            self.__currentMeasureIndex = 0
+        while self.__currentNotesIndex < noteIndex:
+            self.moveToNextNote()
+
     @property
     def notesXpostions (self):
         return self.__notesXpositions
 
+    @property
+    def measuresXpositions (self):
+        return self.__measuresXpositions
+
+    @property
+    def noteCursor (self):
+        return self.__noteCursor
+
     @property
     def picture (self):
         return self.__picture
 
+    @property
+    def cropBox (self):
+        """
+        The top and bottom edges of the rows of the picture shown in
+        the video.
+        """
+        self.__setCropTopAndBottom()
+        return (self.__cropTop, self.__cropBottom)
+
+    @property
+    def frameViewports (self):
+        """
+        The index, the left and right edges of the cropping rectangle
+        and the cursor position of every frame, as computed by
+        compile(), in an array with one row per frame.
+        """
+        return numpy.column_stack((self.__frameIndices,
+                                   self.__frameViewports))
+
+    @property
+    def frameMeasures (self):
+        """
+        The index of the measure of every frame, as computed by
+        compile(), in an array.
+        """
+        return self.__frameMeasures
+
     def __setCropTopAndBottom(self):
         """
         set the y-coordinates of the top and
@@ -326,19 +1232,20 @@ class ScoreImage (Media):
         if self.__cropTop is not None and self.__cropBottom is not None: return
         picture_width, picture_height = self.__picture.size
 
-        bottomY = picture_height - self.bottomCroppable
+        left, topCroppable, right, bottomY = self.contentBox
+        bottomCroppable = picture_height - bottomY
         progress("      Image height: %5d pixels" % picture_height)
-        progress("   Top margin size: %5d pixels" % self.topCroppable)
+        progress("   Top margin size: %5d pixels" % topCroppable)
         progress("Bottom margin size: %5d pixels (y=%d)" %
-                 (self.bottomCroppable, bottomY))
+                 (bottomCroppable, bottomY))
 
-        nonWhiteRows = picture_height - self.topCroppable - self.bottomCroppable
+        nonWhiteRows = bottomY - topCroppable
         progress("Visible content is formed of %d non-white rows of pixels" %
                  nonWhiteRows)
 
         # y-coordinate of centre of the visible content, relative to
         # the original non-cropped image
-        nonWhiteCentre = self.topCroppable + int(round(nonWhiteRows/2))
+        nonWhiteCentre = topCroppable + int(round(nonWhiteRows/2))
         progress("Centre of visible content is %d pixels from top" %
                  nonWhiteCentre)
 
@@ -349,8 +1256,8 @@ class ScoreImage (Media):
 
         # Figure out the maximum height allowed which keeps the
         # cropping rectangle within the source image.
-        maxTopHalf    =    self.topCroppable + nonWhiteRows / 2
-        maxBottomHalf = self.bottomCroppable + nonWhiteRows / 2
+        maxTopHalf    =    topCroppable + nonWhiteRows / 2
+        maxBottomHalf = bottomCroppable + nonWhiteRows / 2
         maxHeight = min(maxTopHalf, maxBottomHalf) * 2
 
         if self.__cropTop < 0:
@@ -369,12 +1276,12 @@ class ScoreImage (Media):
                   (self.__cropBottom - picture_height, maxHeight))
             self.__cropBottom = picture_height
 
-        if self.__cropTop > self.topCroppable:
+        if self.__cropTop > topCroppable:
             fatal("Would have to crop %d pixels below top of visible content! "
                   "Try increasing the video height to at least %d (option -y), "
                   "or decreasing the resolution DPI (option -r)."
-                  % (self.__cropTop - self.topCroppable, nonWhiteRows))
-            self.__cropTop = self.topCroppable
+                  % (self.__cropTop - topCroppable, nonWhiteRows))
+            self.__cropTop = topCroppable
 
         if self.__cropBottom < bottomY:
             fatal("Would have to crop %d pixels above bottom of visible content! "
@@ -385,16 +1292,21 @@ class ScoreImage (Media):
 
         progress("Will crop from y=%d to y=%d" % (self.__cropTop, self.__cropBottom))
 
-    def __cropFrame(self,index):
+    def __viewport(self, index):
+        """
+        Returns the left and right edges of the cropping rectangle for
+        the given index, and the position of the cursor in it.  In
+        cursor scrolling mode, this moves to the next page when the
+        cursor reaches the right margin.
+        """
         self.__setCropTopAndBottom()
         picture_width, picture_height = self.__picture.size
 
         if self.scrollNotes:
-            # Get frame from image of staff
             centre = self.width / 2
             left  = int(index - centre)
-            right = int(index + centre)
-            frame = self.picture.copy().crop((left, self.__cropTop, right, self.__cropBottom))
+            # the frame is a pixel wider to the right of an odd width
+            right = left + self.width
             cursorX = centre
         else:
             if self.__leftEdge is None:
@@ -414,94 +1326,344 @@ class ScoreImage (Media):
                 self.__leftEdge = picture_width - self.width
                 # the cursor has to finish its travel in the last picture cropping
                 self.rightMargin = 0
-            rightEdge = self.__leftEdge + self.width
-            frame = self.picture.copy().crop((self.__leftEdge, self.__cropTop,
-                                          rightEdge, self.__cropBottom))
-        return (frame,cursorX)
+            left = self.__leftEdge
+            right = self.__leftEdge + self.width
+        return (left, right, cursorX)
 
-    def makeFrame (self, numFrame, among):
+    def __crop(self, left, right):
+        """
+        Returns the window of the picture in between the given left
+        and right edges.  Only that window is copied out of the
+        picture, so this costs the same however wide the score is.
+        """
+        return self.__picture.crop((left, self.__cropTop,
+                                    right, self.__cropBottom))
+
+    def __baseWindow(self, left, right):
+        """
+        Returns the window of the picture in between the given left
+        and right edges, without any cursor.  In cursor scrolling mode
+        the same window is shown by all the frames of a page, so the
+        most recently used windows are cached, already expanded into
+        RGB so that this is done only once per page.
+        """
+        key = (left, right)
+        window = self.__baseWindows.pop(key, None)
+        if window is None:
+            window = self.__crop(left, right)
+            if window.mode != "RGB":
+                window = window.convert("RGB")
+            while len(self.__baseWindows) >= self.baseWindowCacheSize:
+                self.__baseWindows.popitem(last=False)
+        # (re)insert it as the most recently used one
+        self.__baseWindows[key] = window
+        return window
+
+    def __copyToBuffer(self, window):
+        """
+        Copies the window into the frame buffer, which is reused by
+        every frame so that cursors can be drawn on it without
+        spoiling the cached windows.
+        """
+        if self.__frameBuffer is None or \
+                self.__frameBuffer.size != window.size:
+            self.__frameBuffer = window.copy()
+        else:
+            self.__frameBuffer.paste(window)
+        return self.__frameBuffer
+
+    def __frameIndex (self, numFrame, among):
         startIndex  = self.currentXposition
         indexTravel = self.travelToNextNote
         travelPerFrame = float(indexTravel) / among
-        index = startIndex + int(round(numFrame * travelPerFrame))
+        return startIndex + int(round(numFrame * travelPerFrame))
+
+    def __cursorX (self, cursorX, numFrame, among):
+        """
+        Returns the position of the note cursor in the frame, which is
+        only rounded to whole pixels when it isn't anti-aliased.  In
+        cursor scrolling mode the cursor stays in the middle anyway.
+        """
+        if not self.antialiasCursor or self.scrollNotes:
+            return cursorX
+        travelPerFrame = float(self.travelToNextNote) / among
+        travel = numFrame * travelPerFrame
+        x = cursorX + travel - round(travel)
+        # don't push a cursor on the edge out of the frame
+        return x if 0 <= x <= self.width - 2 else cursorX
+
+    def compile (self, timecode):
+        """
+        Computes the index, the cropping rectangle and the cursor
+        position of every frame.  In cursor scrolling mode the left
+        edge depends on where the previous pages started, so this is
+        the only place where frames have to be visited in order.
+        """
+        savedNotesIndex = self.__currentNotesIndex
+        savedRightMargin = self.rightMargin
+        frameIndices = numpy.zeros(timecode.frameCount, dtype=numpy.int64)
+        frameViewports = numpy.zeros((timecode.frameCount, 3),
+                                     dtype=numpy.int64)
+        for frame in xrange(timecode.frameCount):
+            noteIndex, numFrame, among = timecode.frameAt(frame)
+            self.__currentNotesIndex = noteIndex
+            index = self.__frameIndex(numFrame, among)
+            frameIndices[frame] = index
+            frameViewports[frame] = self.__viewport(index)
+        self.__currentNotesIndex = savedNotesIndex
+        self.rightMargin = savedRightMargin
+        self.__leftEdge = None
+
+        self.__noteStartFrames = timecode.noteStartFrames
+        self.__frameIndices = frameIndices
+        self.__frameViewports = frameViewports
+        self.__noteMeasureIndices = self.__noteMeasures(timecode)
+        self.__frameMeasures = self.__noteMeasureIndices[timecode.frameNotes]
+
+    def __noteMeasures (self, timecode):
+        """
+        Returns the index of the measure of every note shown by the
+        frames, as moveToNote() finds it.
+        """
+        nbNotes = len(timecode.noteStartFrames) - 1
+        noteMeasures = numpy.zeros(max(nbNotes, 1), dtype=numpy.int64)
+        if not self.__measuresXpositions:
+            return noteMeasures
+        savedNotesIndex = self.__currentNotesIndex
+        savedMeasureIndex = self.__currentMeasureIndex
+        self.__currentNotesIndex = 0
+        self.__currentMeasureIndex = 0
+        for note in xrange(1, nbNotes):
+            self.moveToNextNote()
+            noteMeasures[note] = self.__currentMeasureIndex
+        self.__currentNotesIndex = savedNotesIndex
+        self.__currentMeasureIndex = savedMeasureIndex
+        return noteMeasures
+
+    def __window(self, left, right):
+        """
+        Returns the frame in between the given left and right edges,
+        ready for a cursor to be drawn on it.
+        """
+        if self.scrollNotes:
+            # the window moves on every frame, so there's nothing to reuse
+            window = self.__crop(left, right)
+            if window.mode != "RGB":
+                window = window.convert("RGB")
+            return window
+        return self.__copyToBuffer(self.__baseWindow(left, right))
+
+    def __cropFrame(self,index):
+        left, right, cursorX = self.__viewport(index)
+        # Get frame from image of staff
+        frame = self.__window(left, right)
+        return (frame,cursorX)
 
-        scoreFrame, cursorX = self.__cropFrame(index)
+    def __compiledViewport (self, numFrame):
+        """
+        Returns the index of the given frame of the current note, the
+        left and right edges of its cropping rectangle, and the
+        position of the cursor in it, as computed by compile().
+        """
+        frame = self.__noteStartFrames[self.__currentNotesIndex] + numFrame
+        left, right, cursorX = [int(x) for x in self.__frameViewports[frame]]
+        return (int(self.__frameIndices[frame]), left, right, cursorX)
+
+    def frameKey (self, numFrame, among):
+        if self.__frameIndices is None:
+            return None
+        index, left, right, cursorX = self.__compiledViewport(numFrame)
+        if self.__measuresXpositions :
+            return (left, right, index - cursorX, self.__currentMeasureIndex)
+        elif self.__noteCursor:
+            return (left, right, self.__cursorX(cursorX, numFrame, among))
+        return (left, right)
 
-        # Cursors
+    def __frameViewport (self, numFrame, among):
+        """
+        Returns the index of the given frame of the current note, the
+        left and right edges of its cropping rectangle, and the
+        position of the cursor in it.
+        """
+        if self.__frameIndices is not None:
+            return self.__compiledViewport(numFrame)
+        index = self.__frameIndex(numFrame, among)
+        left, right, cursorX = self.__viewport(index)
+        return (index, left, right, cursorX)
+
+    def __drawCursor (self, frame, index, cursorX, numFrame, among,
+                      box=None):
         if self.__measuresXpositions :
             origin = index - cursorX
             start = self.__measuresXpositions[self.__currentMeasureIndex] - origin
             end = self.__measuresXpositions[self.__currentMeasureIndex + 1] - origin
-            writeMeasureCursor(scoreFrame, start, end, self.cursorLineColor)
+            writeMeasureCursor(frame, start, end, self.cursorLineColor,
+                               box=box)
         elif self.__noteCursor:
-            writeCursorLine(scoreFrame, cursorX, self.cursorLineColor)
+            writeCursorLine(frame, self.__cursorX(cursorX, numFrame, among),
+                            self.cursorLineColor, box=box)
 
+    def makeFrame (self, numFrame, among):
+        index, left, right, cursorX = self.__frameViewport(numFrame, among)
+        scoreFrame = self.__window(left, right)
+        self.__drawCursor(scoreFrame, index, cursorX, numFrame, among)
         return scoreFrame
 
-    def __isLineBlank(self, pixels, width, y):
+    def paintFrame (self, frame, box, numFrame, among):
         """
-        Returns True if the line with the given y coordinate
-        is entirely white.
+        Pastes the window of the score straight into the frame of the
+        video and draws the cursor over it, which saves copying it
+        into the frame buffer first.  In notes scrolling mode the
+        window is pasted as held in the score mode, which expands it
+        into RGB on the way.
         """
-        for x in xrange(width):
-            if pixels[x, y] != (255, 255, 255):
-                return False
-        return True
-
-    def __setTopCroppable (self):
-        # This is way faster than width*height invocations of getPixel()
-        picture_width, picture_height = self.__picture.size
-        pixels = self.__picture.load()
-        progress("Auto-detecting top margin; this may take a while ...")
-        self.__topCroppable = 0
-        for y in xrange(picture_height):
-            if y == picture_height - 1:
-                raise BlankScoreImageError
-            if self.__isLineBlank(pixels, picture_width, y):
-                self.__topCroppable += 1
-            else:
-                break
+        index, left, right, cursorX = self.__frameViewport(numFrame, among)
+        if self.scrollNotes:
+            window = self.__crop(left, right)
+        else:
+            window = self.__baseWindow(left, right)
+        if window.size != (box[2] - box[0], box[3] - box[1]):
+            # don't leave anything from a bigger previous frame
+            frame.paste("white", box)
+        frame.paste(window, box[:2])
+        box = box[:2] + (box[0] + window.size[0], box[1] + window.size[1])
+        self.__drawCursor(frame, index, cursorX, numFrame, among, box)
 
-    def __setBottomCroppable (self):
-        # This is way faster than width*height invocations of getPixel()
-        picture_width, picture_height = self.__picture.size
-        pixels = self.__picture.load()
-        progress("Auto-detecting top margin; this may take a while ...")
-        self.__bottomCroppable = 0
-        for y in xrange(picture_height - 1, -1, -1):
-            if y == 0:
+    @property
+    def contentBox (self): # raises BlankScoreImageError
+        """
+        The bounding box (left, top, right, bottom) of the non-white
+        content of the picture.
+        """
+        if self.__contentBox is None:
+            progress("Auto-detecting margins ...")
+            self.__contentBox = findContentBox(self.__picture,
+                                               self.blankThreshold)
+            if self.__contentBox is None:
                 raise BlankScoreImageError
-            if self.__isLineBlank(pixels, picture_width, y):
-                self.__bottomCroppable += 1
-            else:
-                break
+        return self.__contentBox
 
     @property
     def topCroppable (self): # raises BlankScoreImageError
-        if self.__topCroppable is None:
-            self.__setTopCroppable()
-        return self.__topCroppable
+        return self.contentBox[1]
 
     @property
-    def bottomCroppable (self):
-        if self.__bottomCroppable is None:
-            self.__setBottomCroppable()
-        return self.__bottomCroppable
+    def bottomCroppable (self): # raises BlankScoreImageError
+        return self.__picture.size[1] - self.contentBox[3]
 
     def update (self, timecode):
-        self.moveToNextNote()
+        self.moveToNote(timecode.noteIndex)
+
+class SlideCache (object):
+
+    """
+    Holds the most recently used slides of a SlideShow once decoded,
+    and decodes the upcoming ones ahead of time in a background
+    thread, so that the rendering never waits for a slide to load.
+    """
+
+    def __init__ (self, fileNames, size = 4, lookAhead = 2):
+        """
+        Params:
+          - fileNames:         file names of the slides, in order
+          - size:              number of decoded slides kept
+          - lookAhead:         number of upcoming slides to decode
+        """
+        self.fileNames = fileNames
+        self.size = size
+        self.lookAhead = lookAhead
+        self.__slides = collections.OrderedDict()
+        self.__pending = set()
+        self.__condition = threading.Condition()
+        self.__queue = None
+        self.__pid = None
+
+    def __decode (self, index):
+        slide = Image.open(self.fileNames[index])
+        slide.load()
+        debug("Decoded slide from file " + self.fileNames[index])
+        return slide
+
+    def __store (self, index, slide):
+        # must be called with the condition held
+        self.__slides.pop(index, None)
+        self.__slides[index] = slide
+        while len(self.__slides) > self.size:
+            self.__slides.popitem(last=False)
+
+    def __prefetchSlides (self):
+        while True:
+            index = self.__queue.get()
+            try:
+                slide = self.__decode(index)
+            except IOError:
+                slide = None
+            with self.__condition:
+                self.__pending.discard(index)
+                if slide is not None:
+                    self.__store(index, slide)
+                self.__condition.notify_all()
+
+    def __startThread (self):
+        # Threads don't survive a fork, so every rendering process
+        # needs a thread of its own, and a condition of its own too,
+        # since the lock may have been held by the thread of the
+        # parent when it forked.
+        if self.__pid == os.getpid():
+            return
+        self.__pid = os.getpid()
+        self.__condition = threading.Condition()
+        self.__pending.clear()
+        self.__queue = Queue.Queue()
+        thread = threading.Thread(target=self.__prefetchSlides)
+        thread.daemon = True
+        thread.start()
+
+    def get (self, index):
+        """
+        Returns the given slide, and starts decoding the next ones.
+        """
+        self.__startThread()
+        with self.__condition:
+            for upcoming in xrange(index + 1, min(index + 1 + self.lookAhead,
+                                                  len(self.fileNames))):
+                if upcoming not in self.__slides and \
+                        upcoming not in self.__pending:
+                    self.__pending.add(upcoming)
+                    self.__queue.put(upcoming)
+            while index in self.__pending:
+                self.__condition.wait()
+            slide = self.__slides.pop(index, None)
+            if slide is not None:
+                self.__store(index, slide)
+                return slide
+        slide = self.__decode(index)
+        with self.__condition:
+            self.__store(index, slide)
+        return slide
 
 class SlideShow (Media):
 
     """
     This class is needed to run show composed of several pictures as
     the music is playing. A horizontal line cursor can be added if needed.
+
+    The slides are the files named after the prefix followed by the
+    offset (in quarter notes) from which they are shown, e.g.
+    slide0012.5000.png.  The directory is scanned once, and the slide
+    shown at any offset is looked up by bisection.
     """
 
     def __init__(self, fileNamePrefix, cursorPos = None, lastOffset = None):
         self.__fileNamePrefix = fileNamePrefix
-        self.__fileName = "%s%09.4f.png" % (self.__fileNamePrefix,0.0)
-        self.__slide = Image.open(self.__fileName)
+        self.__slideOffsets, fileNames = self.__scanSlides(fileNamePrefix)
+        if not self.__slideOffsets or self.__slideOffsets[0] != 0.0:
+            raise IOError("No slide found at offset 0 with prefix %s"
+                          % fileNamePrefix)
+        self.__slides = SlideCache(fileNames)
+        self.__slideIndex = 0
+        self.__slide = self.__slides.get(0)
+        self.__frameBuffer = None
         Media.__init__(self,self.__slide.size[0], self.__slide.size[1])
         self.cursorLineColor = (255,0,0)
 
@@ -518,23 +1680,66 @@ class SlideShow (Media):
         self.startOffset = 0.0
         self.endOffset = 0.0
 
-    def makeFrame (self, numFrame, among):
-        # We check if the slide must change
+    @staticmethod
+    def __scanSlides (fileNamePrefix):
+        """
+        Returns the sorted offsets of the slides with the given file
+        name prefix, and the file names of these slides.
+        """
+        dirName, prefix = os.path.split(fileNamePrefix)
+        slides = []
+        for fileName in os.listdir(dirName or "."):
+            if not (fileName.startswith(prefix) and
+                    fileName.endswith(".png")):
+                continue
+            offset = fileName[len(prefix):-len(".png")]
+            try:
+                if "%09.4f" % float(offset) != offset:
+                    continue
+            except ValueError:
+                continue
+            slides.append((float(offset), os.path.join(dirName, fileName)))
+        slides.sort()
+        return [offset for offset, fileName in slides], \
+            [fileName for offset, fileName in slides]
+
+    def __cursorIndex (self, numFrame, among):
+        if self.__cursorStart is None:
+            return None
         start = self.startOffset * self.__scale
         end = self.endOffset * self.__scale
         travelPerFrame = float(end - start) / among
         index = start + int(round(numFrame * travelPerFrame)) + self.__cursorStart
+        return int(index)
 
-        newFileName = "%s%09.4f.png" % (self.__fileNamePrefix,self.startOffset)
-        if newFileName != self.__fileName:
-            self.__fileName = newFileName
-            if os.path.exists(self.__fileName):
-                self.__slide = Image.open(self.__fileName)
-                debug ("Add slide from file " + self.__fileName)
-        tmpSlide = self.__slide.copy()
-        writeCursorLine(tmpSlide, int(index), self.cursorLineColor)
-        return tmpSlide
+    def frameKey (self, numFrame, among):
+        return (self.__slideIndex, self.__cursorIndex(numFrame, among))
+
+    def makeFrame (self, numFrame, among):
+        index = self.__cursorIndex(numFrame, among)
+        if index is None:
+            return self.__slide
+
+        # draw the cursor on a reused copy of the slide
+        if self.__frameBuffer is None or \
+                self.__frameBuffer.size != self.__slide.size:
+            self.__frameBuffer = self.__slide.copy()
+        else:
+            self.__frameBuffer.paste(self.__slide)
+        writeCursorLine(self.__frameBuffer, index, self.cursorLineColor)
+        return self.__frameBuffer
+
+    def __selectSlide (self):
+        # The slide shown is the last one starting at or before the
+        # current offset, as rounded in the file names.
+        offset = float("%09.4f" % self.startOffset)
+        index = max(bisect.bisect_right(self.__slideOffsets, offset) - 1, 0)
+        if index != self.__slideIndex:
+            self.__slideIndex = index
+            self.__slide = self.__slides.get(index)
+            debug ("Add slide from file " + self.__slides.fileNames[index])
 
     def update(self, timecode):
         self.startOffset = timecode.currentOffset
         self.endOffset = timecode.nextOffset
+        self.__selectSlide()
@@ -22,11 +22,53 @@
 # For more information about this program, please visit
 # <https://github.com/aspiers/ly2video/>.
 
+import random
+import re
+import shutil
+import signal
+import struct
+import subprocess
+import tempfile
+import threading
 import unittest
+import zipfile
+import zlib
+from distutils.spawn import find_executable
 from ly2video.video import *
 from ly2video.synchro import *
+from ly2video.cache import RenderCache
+from ly2video.filters import *
+from ly2video.cli import SpaceTimeParser, safeRunLines, staffSpacesToPixels
+from ly2video.cli import AudioJob
+from ly2video.cli import getNoteIndices, SKIP_TICK_WITHOUT_GROB, \
+    SKIP_GROB_WITHOUT_TICK, SKIP_PITCH_MISMATCH
 from PIL import Image
 
+class TempoMapTest (unittest.TestCase):
+
+    def setUp(self):
+        self.tempoMap = TempoMap([(0, 60.0),(1152, 90.0),(3456, 60.0)], 384)
+
+    def testTickToSecs(self):
+        self.assertEqual(self.tempoMap.tickToSecs(0), 0.0)
+        self.assertEqual(self.tempoMap.tickToSecs(1152), 3.0)
+        self.assertEqual(self.tempoMap.tickToSecs(3456), 7.0)
+        self.assertEqual(self.tempoMap.tickToSecs(4608), 10.0)
+
+    def testTickToSecs_withArray(self):
+        secs = self.tempoMap.tickToSecs(numpy.array([384, 1536, 3840]))
+        self.assertEqual(list(secs), [1.0, 3.0 + 2.0/3, 8.0])
+
+    def testSecsToTick(self):
+        self.assertEqual(self.tempoMap.secsToTick(0.0), 0.0)
+        self.assertEqual(self.tempoMap.secsToTick(3.0), 1152.0)
+        self.assertEqual(self.tempoMap.secsToTick(5.0), 2304.0)
+        self.assertEqual(self.tempoMap.secsToTick(10.0), 4608.0)
+
+    def testSameTickTempos(self):
+        tempoMap = TempoMap([(0, 60.0),(0, 120.0)], 384)
+        self.assertEqual(tempoMap.tickToSecs(384), 0.5)
+
 class TimeCodeTest (unittest.TestCase):
 
     def setUp(self):
@@ -56,13 +98,13 @@ class TimeCodeTest (unittest.TestCase):
         result = self.timecode.secsElapsedForTempoChanges(startTick = 0, endTick = 1152)
         self.assertEqual(result,3.0,"")
         result = self.timecode.secsElapsedForTempoChanges(startTick = 0, endTick = 3456)
-        self.assertEqual(result,6.0,"")
+        self.assertEqual(result,7.0,"")
         result = self.timecode.secsElapsedForTempoChanges(startTick = 1152, endTick = 3456)
         self.assertEqual(result,4.0,"")
         result = self.timecode.secsElapsedForTempoChanges(startTick = 3456, endTick = 4608)
         self.assertEqual(result,3.0,"")
         result = self.timecode.secsElapsedForTempoChanges(startTick = 0, endTick = 4608)
-        self.assertEqual(result,12.0,"")
+        self.assertEqual(result,10.0,"")
 
     def testNbFramesToNextNote(self):
         self.assertEqual(self.timecode.nbFramesToNextNote(), 30, "")
@@ -138,6 +180,31 @@ class TimeCodeTest (unittest.TestCase):
             memOffset = slideshow.startOffset
         os.remove("test0000.0000.png")
 
+    def testFrameCount(self):
+        self.assertEqual(self.timecode.frameCount, 60, "")
+
+    def testFrameAt(self):
+        self.timecode = TimeCode([0,370,768,1152],[(0,60.0),(370,90.0),(768,60.0)], 384, 30.0)
+        self.assertEqual(self.timecode.frameAt(0), (0, 0, 29), "")
+        self.assertEqual(self.timecode.frameAt(28), (0, 28, 29), "")
+        self.assertEqual(self.timecode.frameAt(29), (1, 0, 21), "")
+        self.assertEqual(self.timecode.frameAt(49), (1, 20, 21), "")
+
+    def testFrameOffsets(self):
+        self.assertEqual(self.timecode.frameOffsets[0], 0.0, "")
+        self.assertEqual(self.timecode.frameOffsets[15], 0.5, "")
+        self.assertEqual(self.timecode.frameOffsets[45], 1.5, "")
+
+    def testGoToNote_withScoreImageNotification(self):
+        image = ScoreImage(16,16,Image.new("RGB",(16,16),(0,0,0)), [0,1,2,3], [])
+        self.timecode.registerObserver(image)
+        self.timecode.goToNote(2)
+        self.assertEqual(self.timecode.noteIndex, 2, "")
+        self.assertEqual(image.currentXposition, 2, "")
+        self.timecode.goToNote(1)
+        self.assertEqual(self.timecode.noteIndex, 1, "")
+        self.assertEqual(image.currentXposition, 1, "")
+
     def testNotAtEnd(self):
         self.assertFalse(self.timecode.atEnd(), "")
 
@@ -146,6 +213,65 @@ class TimeCodeTest (unittest.TestCase):
         self.timecode.goToNextNote()
         self.assertTrue(self.timecode.atEnd(), "")
 
+class SyncDataTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.scorePath = os.path.join(self.dir, "score.png")
+        self.midiPath = os.path.join(self.dir, "score.midi")
+        Image.new("RGB",(16,16),(255,0,0)).save(self.scorePath)
+        with open(self.midiPath, "wb") as f:
+            f.write("MThd")
+        self.syncPath = os.path.join(self.dir, "score.sync")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSaveAndLoad (self):
+        SyncData([10,20], [0,384,768], [(0,60.0),(384,120.0)], 384,
+                 [5,15], self.scorePath, self.midiPath).save(self.syncPath)
+        destDir = os.path.join(self.dir, "dest")
+        sync = SyncData.load(self.syncPath, destDir)
+        self.assertEqual(sync.noteIndices, [10,20], "")
+        self.assertEqual(sync.midiTicks, [0,384,768], "")
+        self.assertEqual(sync.temposList, [(0,60.0),(384,120.0)], "")
+        self.assertEqual(sync.midiResolution, 384, "")
+        self.assertEqual(sync.measuresXpositions, [5,15], "")
+        self.assertEqual(sync.scorePath, os.path.join(destDir, "score.png"))
+        self.assertEqual(Image.open(sync.scorePath).getpixel((0,0)),
+                         (255,0,0), "")
+        with open(sync.midiPath, "rb") as f:
+            self.assertEqual(f.read(), "MThd", "")
+
+    def testSaveAndLoad_withTitle (self):
+        SyncData([10,20], [0,384,768], [(0,60.0)], 384, None,
+                 self.scorePath, self.midiPath,
+                 u"Pr\xe9lude", "J. S. Bach").save(self.syncPath)
+        sync = SyncData.load(self.syncPath, os.path.join(self.dir, "dest"))
+        self.assertEqual(sync.title, u"Pr\xe9lude", "")
+        self.assertEqual(sync.author, "J. S. Bach", "")
+
+    def testLoad_withMissingData (self):
+        with zipfile.ZipFile(self.syncPath, "w") as z:
+            z.writestr(SyncData.DATA_FILE,
+                       '{"version": 1, "noteIndices": [10], "midiTicks": [0],'
+                       ' "temposList": [[0, 60.0]], "midiResolution": 384,'
+                       ' "score": "score.png", "midi": "score.midi"}')
+            z.write(self.scorePath, "score.png")
+            z.write(self.midiPath, "score.midi")
+        self.assertRaises(SyncFileError, SyncData.load, self.syncPath,
+                          os.path.join(self.dir, "dest"))
+
+    def testLoad_withOtherVersion (self):
+        with zipfile.ZipFile(self.syncPath, "w") as z:
+            z.writestr(SyncData.DATA_FILE, '{"version": 0}')
+        self.assertRaises(SyncFileError, SyncData.load, self.syncPath,
+                          self.dir)
+
+    def testLoad_withoutSyncFile (self):
+        self.assertRaises(SyncFileError, SyncData.load, self.scorePath,
+                          self.dir)
+
 class ScoreImageTest (unittest.TestCase):
 
     def setUp(self):
@@ -157,29 +283,6 @@ class ScoreImageTest (unittest.TestCase):
         self.pointsImage = ScoreImage(1000,200,image, [], [])
 
     # PRIVATE METHODS
-    # __isLineBlank
-    def test__IsLineBlank (self):
-        image = Image.new("RGB",(16,16),(255,255,255))
-        for x in range(16) : image.putpixel((x,8),(0,0,0))
-        pixels = image.load()
-        w, h = image.size
-        self.assertTrue(self.blankImage._ScoreImage__isLineBlank(pixels, w, 0), "Line should be blank")
-        self.assertFalse(self.blankImage._ScoreImage__isLineBlank(pixels, w, 8), "Line should not be blank")
-
-    def test__IsLineBlank_withLineAlmostBlack (self):
-        image = Image.new("RGB",(16,16),(255,255,255))
-        for x in range(15) : image.putpixel((x,10),(0,0,0))
-        w, h = image.size
-        pixels = image.load()
-        self.assertFalse(self.blankImage._ScoreImage__isLineBlank(pixels, w, 10), "Line should not be blank")
-
-    def test__IsLineBlank_withLineAlmostBlank (self):
-        image = Image.new("RGB",(16,16),(255,255,255))
-        image.putpixel((4,4),(0,0,0))
-        w, h = image.size
-        pixels = image.load()
-        self.assertFalse(self.blankImage._ScoreImage__isLineBlank(pixels, w, 4), "Line should not be blank")
-
     # __setCropTopAndBottom
     def test__setCropTopAndBottom_withBlackImage(self):
         blackImage = ScoreImage(16,16,Image.new("RGB",(16,16),(0,0,0)), [], [])
@@ -332,6 +435,14 @@ class ScoreImageTest (unittest.TestCase):
         blackImage = ScoreImage(16,16,image, [], [])
         self.assertEqual(blackImage.topCroppable, 8, "Bad topMarginSize")
 
+    def testTopCroppable_withBlankThreshold (self):
+        image = Image.new("RGB",(16,16),(255,255,255))
+        image.putpixel((8,4),(250,250,250))
+        image.putpixel((8,8),(0,0,0))
+        self.assertEqual(ScoreImage(16,16,image, [], []).topCroppable, 4)
+        self.assertEqual(ScoreImage(16,16,image, [], [],
+                                    blankThreshold = 240).topCroppable, 8)
+
     # bottomCroppable
     def testBottomCroppable_withBlackImage (self):
         blackImage = ScoreImage(16, 16, Image.new("RGB",(16,16),(0,0,0)), [], [])
@@ -368,6 +479,189 @@ class ScoreImageTest (unittest.TestCase):
         self.assertEqual(w, 200, "")
         self.assertEqual(h, 40, "")
 
+    # moveToNote
+    def testMoveToNote_whenCompiled (self):
+        def makeScoreImage():
+            image = Image.new("RGB",(400,40),(255,255,255))
+            for x in range(20, 380) : image.putpixel((x,20),(0,0,0))
+            return ScoreImage(100, 16, image, [40,120,200,250,300],
+                              [20,100,180,260,390], 10, 20)
+        stepped = makeScoreImage()
+        measures = []
+        for note in range(4):
+            stepped.moveToNote(note)
+            measures.append((stepped.currentXposition,
+                             stepped._ScoreImage__currentMeasureIndex))
+        compiled = makeScoreImage()
+        compiled.compile(TimeCode([0,384,768,960,1536],[(0,60.0)],
+                                  384, 30.0))
+        for note in (3, 1, 2, 0, 3):
+            compiled.moveToNote(note)
+            self.assertEqual((compiled.currentXposition,
+                              compiled._ScoreImage__currentMeasureIndex),
+                             measures[note], "note %d" % note)
+
+    def testMakeFrame_withAntialiasCursor (self):
+        image = Image.new("RGB",(1000,200),(255,255,255))
+        for x in range(1000) : image.putpixel((x,100),(0,0,0))
+        rows = []
+        for antialias in (False, True):
+            scoreImage = ScoreImage(100, 100, image, [300, 400], [], 10, 10)
+            scoreImage.antialiasCursor = antialias
+            # a third of the way to the next pixel
+            frame = scoreImage.makeFrame(numFrame = 1, among = 3)
+            rows.append([frame.getpixel((x,0)) for x in range(100)])
+        sharp, smooth = rows
+        x = sharp.index((255,0,0))
+        self.assertEqual(sharp[x-1:x+3],
+                         [(255,255,255), (255,0,0), (255,0,0), (255,255,255)],
+                         "")
+        self.assertEqual(smooth[x-1:x+3],
+                         [(255,255,255), (255,85,85), (255,0,0), (255,170,170)],
+                         "")
+
+class ContentBoxTest (unittest.TestCase):
+
+    def testFindContentBox (self):
+        image = Image.new("RGB",(16,16),(255,255,255))
+        for x in range(3,12) : image.putpixel((x,8),(0,0,0))
+        image.putpixel((5,2),(0,0,0))
+        self.assertEqual(findContentBox(image), (3,2,12,9), "")
+
+    def testFindContentBox_withBlankImage (self):
+        image = Image.new("RGB",(16,16),(255,255,255))
+        self.assertEqual(findContentBox(image), None, "")
+
+    def testFindContentBox_withThreshold (self):
+        image = Image.new("RGB",(16,16),(255,255,255))
+        image.putpixel((4,4),(255,255,200))
+        self.assertEqual(findContentBox(image), (4,4,5,5), "")
+        self.assertEqual(findContentBox(image, 200), None, "")
+
+    def testNonWhiteMask_withPaletteImage (self):
+        image = Image.new("RGB",(16,16),(255,255,255))
+        image.putpixel((4,4),(255,0,0))
+        mask = nonWhiteMask(image.convert("P"))
+        self.assertEqual(mask.sum(), 1, "")
+        self.assertTrue(mask[4,4], "")
+
+class TiledImageTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.image = Image.new("RGB",(100,30),(255,255,255))
+        for y in (10, 14, 18):
+            for x in range(20, 90) : self.image.putpixel((x,y),(0,0,0))
+        self.image.putpixel((95,25),(10,20,30))
+        self.tiled = TiledImage.fromImage(self.image,
+                                          os.path.join(self.dir, "tiles"), 7)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testCrop (self):
+        for box in ((0,0,100,30), (5,3,23,20), (-10,-5,10,5), (90,20,110,40)):
+            self.assertEqual(self.tiled.crop(box).tobytes(),
+                             self.image.crop(box).tobytes(), "")
+
+    def testFindContentBox (self):
+        self.assertEqual(findContentBox(self.tiled), (20,10,96,26), "")
+
+    def testFindStaffLinesInImage (self):
+        self.assertEqual(findStaffLinesInImage(self.tiled, 50),
+                         (23, [10, 14, 18]), "")
+
+    def testCrop_withScoreModes (self):
+        for mode in ("L", "1"):
+            image = convertScore(self.image, mode)
+            tiled = TiledImage.fromImage(self.image,
+                                         os.path.join(self.dir, mode), 16, mode)
+            self.assertEqual(tiled.mode, mode, "")
+            for box in ((0,0,100,30), (5,3,23,20), (-10,-5,10,5),
+                        (90,20,110,40)):
+                cropped = tiled.crop(box)
+                self.assertEqual(cropped.mode, mode, "")
+                self.assertEqual(cropped.tobytes(),
+                                 image.crop(box).tobytes(), "")
+            self.assertEqual(findStaffLinesInImage(tiled, 50),
+                             (23, [10, 14, 18]), "")
+
+    def testOpen_withPaletteImage (self):
+        fileName = os.path.join(self.dir, "score.png")
+        image = self.image.convert("P")
+        image.save(fileName)
+        tiled = TiledImage.open(fileName, os.path.join(self.dir, "open"), 16)
+        self.assertEqual(tiled.crop((0,0,100,30)).tobytes(),
+                         image.convert("RGB").tobytes(), "")
+
+    def testOpen_inBands (self):
+        # rows filtered by the previous one ("Up" filter), as PIL
+        # doesn't filter the rows of the images it saves
+        pixels = numpy.asarray(self.image.convert("L"))
+        filtered = numpy.diff(numpy.vstack([numpy.zeros((1, 100), "B"),
+                                            pixels]).astype("B"), axis=0)
+        raw = "".join("\x02" + row.tostring() for row in filtered)
+        def chunk(chunkType, data):
+            return struct.pack(">I", len(data)) + chunkType + data + \
+                struct.pack(">I", zlib.crc32(chunkType + data) & 0xffffffff)
+        fileName = os.path.join(self.dir, "score.png")
+        with open(fileName, "wb") as f:
+            f.write("\x89PNG\r\n\x1a\n" +
+                    chunk("IHDR", struct.pack(">IIBBBBB", 100, 30,
+                                              8, 0, 0, 0, 0)) +
+                    chunk("IDAT", zlib.compress(raw)) +
+                    chunk("IEND", ""))
+        for mode in ("RGB", "L", "1"):
+            tiled = TiledImage.open(fileName, os.path.join(self.dir, mode),
+                                    16, mode, bandBytes = 700)
+            self.assertEqual(tiled.crop((0,0,100,30)).tobytes(),
+                             convertScore(self.image.convert("L"),
+                                          mode).tobytes(), "")
+
+class ScoreModeTest (unittest.TestCase):
+
+    def testConvertScore_withoutDithering (self):
+        image = Image.new("RGB",(16,16),(100,100,100))
+        image.putpixel((3,3),(200,200,200))
+        bits = convertScore(image, "1")
+        self.assertEqual(bits.mode, "1", "")
+        self.assertEqual(bits.getpixel((0,0)), 0, "")
+        self.assertEqual(bits.getpixel((3,3)), 255, "")
+
+    def testMakeFrame_withScoreModes (self):
+        image = Image.new("RGB",(1000,200),(255,255,255))
+        for x in range(1000) : image.putpixel((x,100),(0,0,0))
+        frames = []
+        for mode in SCORE_MODES:
+            for scrollNotes in (False, True):
+                scoreImage = ScoreImage(100, 100, convertScore(image, mode),
+                                        [300, 400], [], 10, 10, scrollNotes)
+                frame = scoreImage.makeFrame(numFrame = 10, among = 30)
+                self.assertEqual(frame.mode, "RGB", "")
+                frames.append(frame.tobytes())
+        self.assertEqual(frames[0::2], [frames[0]] * 3, "")
+        self.assertEqual(frames[1::2], [frames[1]] * 3, "")
+
+    def testPaintFrame_withScoreModes (self):
+        image = Image.new("RGB",(1000,200),(255,255,255))
+        for x in range(0, 1000, 3) : image.putpixel((x,100),(0,0,0))
+        for mode in SCORE_MODES:
+            for scrollNotes in (False, True):
+                for measures in ([], [250, 320, 450]):
+                    scoreImage = ScoreImage(100, 100,
+                                            convertScore(image, mode),
+                                            [300, 400], measures, 10, 10,
+                                            scrollNotes)
+                    expected = scoreImage.makeFrame(numFrame = 10,
+                                                    among = 30).copy()
+                    frame = Image.new("RGB",(120,110),(0,0,255))
+                    scoreImage.paintFrame(frame, (10,5,110,105), 10, 30)
+                    self.assertEqual(frame.crop((10,5,110,105)).tobytes(),
+                                     expected.tobytes(), "")
+                    self.assertEqual(frame.getpixel((5,50)), (0,0,255), "")
+                    self.assertEqual(frame.getpixel((115,107)), (0,0,255),
+                                     "")
+
 class CursorsTest (unittest.TestCase):
 
     def testWriteCursorLine (self):
@@ -386,6 +680,43 @@ class CursorsTest (unittest.TestCase):
         for i in range (5):
             self.assertEqual(frame.getpixel((5+i,14)), (255,0,0), "")
 
+    def testWriteCursorLine_withFractionalX (self):
+        frame = Image.new("RGB",(16,16),(255,255,255))
+        writeCursorLine(frame, 10.5, (255,0,0))
+        self.assertEqual(frame.getpixel((10,0)), (255,127,127), "")
+        self.assertEqual(frame.getpixel((11,0)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((12,0)), (255,127,127), "")
+        self.assertEqual(frame.getpixel((13,0)), (255,255,255), "")
+
+    def testWriteCursorLine_withAlpha (self):
+        frame = Image.new("RGB",(16,16),(255,255,255))
+        writeCursorLine(frame, 10, (0,0,0,128))
+        self.assertEqual(frame.getpixel((10,5)), (127,127,127), "")
+        self.assertEqual(frame.getpixel((9,5)), (255,255,255), "")
+
+    def testWriteMeasureCursor_clipped (self):
+        frame = Image.new("RGB",(16,16),(255,255,255))
+        writeMeasureCursor(frame, -5, 30, (255,0,0))
+        self.assertEqual(frame.getpixel((0,15)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((15,6)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((15,5)), (255,255,255), "")
+
+    def testWriteCursors_inBox (self):
+        frame = Image.new("RGB",(16,16),(255,255,255))
+        writeCursorLine(frame, 2, (255,0,0), box = (4,4,12,12))
+        self.assertEqual(frame.getpixel((6,4)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((6,11)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((6,12)), (255,255,255), "")
+        self.assertRaises(IndexError, writeCursorLine, frame, 7, (255,0,0),
+                          box = (4,4,12,12))
+        writeMeasureCursor(frame, -5, 30, (0,255,0), cursor_height = 20,
+                           box = (4,4,12,12))
+        self.assertEqual(frame.getpixel((4,4)), (0,255,0), "")
+        self.assertEqual(frame.getpixel((11,11)), (0,255,0), "")
+        self.assertEqual(frame.getpixel((3,11)), (255,255,255), "")
+        self.assertEqual(frame.getpixel((12,11)), (255,255,255), "")
+        self.assertEqual(frame.getpixel((11,3)), (255,255,255), "")
+
     def testWriteMeasureCursorOut (self):
         frame = Image.new("RGB",(16,16),(255,255,255))
         self.assertRaises(Exception, writeMeasureCursor, frame, 20, 30, (255,0,0))
@@ -423,6 +754,906 @@ class VideoFrameWriterTest(unittest.TestCase):
         self.assertEqual(staffX, 23, "")
         self.assertEqual(staffYs[0], 20, "")
 
+    def testFindStaffLinesInImage_withSeveralLines (self):
+        image = Image.new("RGB",(1000,200),(255,255,255))
+        for y in (30, 31, 40, 50, 60, 70):
+            for x in range(100) : image.putpixel((x+25,y),(0,0,0))
+        # a longer line starting further right isn't the top staff line
+        for x in range(200) : image.putpixel((x+40,10),(0,0,0))
+        # a short line further left isn't a staff line
+        for x in range(20) : image.putpixel((x,35),(0,0,0))
+        staffX, staffYs = findStaffLinesInImage(image, 50)
+        self.assertEqual(staffX, 28, "")
+        self.assertEqual(staffYs, [30, 40, 50, 60, 70], "")
+
+    def testFindStaffLinesInImage_withoutLines (self):
+        image = Image.new("RGB",(1000,200),(255,255,255))
+        self.assertEqual(findTopStaffLine(image, 50), (-1, -1), "")
+
+class SlideShowTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.dir, "slide")
+        for offset, color in ((0.0, (255,0,0)), (2.0, (0,255,0)),
+                              (2.5, (0,0,255))):
+            image = Image.new("RGB",(16,16),color)
+            image.save("%s%09.4f.png" % (self.prefix, offset))
+        Image.new("RGB",(16,16)).save(os.path.join(self.dir, "slide-x.png"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSelectSlide (self):
+        timecode = TimeCode([0,384,768,1152],[(0,60.0)], 384, 30.0)
+        slideshow = SlideShow(self.prefix)
+        timecode.registerObserver(slideshow)
+        colors = [slideshow.makeFrame(0, 1).getpixel((0,0))]
+        for i in range(2):
+            timecode.goToNextNote()
+            colors.append(slideshow.makeFrame(0, 1).getpixel((0,0)))
+        timecode.goToNote(0)
+        colors.append(slideshow.makeFrame(0, 1).getpixel((0,0)))
+        self.assertEqual(colors, [(255,0,0), (255,0,0), (0,255,0),
+                                  (255,0,0)], "")
+
+    def testFrameKey_withCursor (self):
+        slideshow = SlideShow(self.prefix, (0, 10), 10)
+        slideshow.endOffset = 1.0
+        self.assertEqual(slideshow.frameKey(0, 2), (0, 0), "")
+        self.assertEqual(slideshow.frameKey(1, 2), (0, 1), "")
+        frame = slideshow.makeFrame(1, 2)
+        self.assertEqual(frame.getpixel((1,0)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((3,0)), (255,0,0), "")
+
+    def testSlideCache (self):
+        fileNames = ["%s%09.4f.png" % (self.prefix, offset)
+                     for offset in (0.0, 2.0, 2.5)]
+        cache = SlideCache(fileNames, size = 2, lookAhead = 1)
+        self.assertEqual(cache.get(2).getpixel((0,0)), (0,0,255), "")
+        self.assertEqual(cache.get(0).getpixel((0,0)), (255,0,0), "")
+        self.assertEqual(cache.get(1).getpixel((0,0)), (0,255,0), "")
+
+    def testSlideCache_afterFork (self):
+        fileNames = ["%s%09.4f.png" % (self.prefix, offset)
+                     for offset in (0.0, 2.0, 2.5)]
+        cache = SlideCache(fileNames)
+        cache.get(0)
+        # as if the prefetching thread held the lock when forking
+        condition = cache._SlideCache__condition
+        held, release = threading.Event(), threading.Event()
+        def holdLock():
+            with condition:
+                held.set()
+                release.wait()
+        thread = threading.Thread(target=holdLock)
+        thread.start()
+        held.wait()
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(5)
+            ok = False
+            try:
+                ok = cache.get(1).getpixel((0,0)) == (0,255,0)
+            finally:
+                os._exit(0 if ok else 1)
+        release.set()
+        thread.join()
+        pid, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0, "")
+
+    def testMissingFirstSlide (self):
+        os.remove("%s%09.4f.png" % (self.prefix, 0.0))
+        self.assertRaises(IOError, SlideShow, self.prefix)
+
+class RenderCacheTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = RenderCache(os.path.join(self.dir, "cache"), 1300)
+        self.src = os.path.join(self.dir, "src")
+        self.inc = os.path.join(self.dir, "inc")
+        os.mkdir(self.src)
+        os.mkdir(self.inc)
+        self.write(self.src, "score.ly",
+                   '\\include "notes.ly"\n% \\include "missing.ly"\n')
+        self.write(self.inc, "notes.ly",
+                   '\\include "score.ly"\n{ c4 }\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, directory, fileName, text):
+        with open(os.path.join(directory, fileName), "w") as f:
+            f.write(text)
+
+    def key(self, *params):
+        return self.cache.key(os.path.join(self.src, "score.ly"),
+                              [self.inc], *params)
+
+    def testKey (self):
+        key = self.key("2.18.2", 110)
+        self.assertEqual(self.key("2.18.2", 110), key, "")
+        self.assertNotEqual(self.key("2.18.2", 120), key, "")
+        self.write(self.inc, "notes.ly", '{ d4 }\n')
+        self.assertNotEqual(self.key("2.18.2", 110), key, "")
+
+    def testKey_inOtherDirectory (self):
+        key = self.key("2.18.2", 110)
+        otherDir = os.path.join(self.dir, "other")
+        os.mkdir(otherDir)
+        for name in ("src", "inc"):
+            shutil.copytree(os.path.join(self.dir, name),
+                            os.path.join(otherDir, name))
+        self.assertEqual(self.cache.key(os.path.join(otherDir, "src",
+                                                     "score.ly"),
+                                        [os.path.join(otherDir, "inc")],
+                                        "2.18.2", 110), key, "")
+
+    def testStoreAndFetch (self):
+        self.assertEqual(self.cache.fetch("k", self.dir), None, "")
+        self.write(self.src, "score.png", "png")
+        self.cache.store("k", self.src, ["score.png"], "output")
+        os.remove(os.path.join(self.src, "score.png"))
+        self.assertEqual(self.cache.fetch("k", self.src), "output", "")
+        with open(os.path.join(self.src, "score.png")) as f:
+            self.assertEqual(f.read(), "png", "")
+
+    def testBeginAndStore (self):
+        self.write(self.src, "score.png", "png")
+        output = self.cache.begin("k")
+        output.write("line 1\n")
+        output.write("line 2\n")
+        output.close()
+        self.assertEqual(self.cache.fetch("k", self.dir), None, "")
+        self.cache.store("k", self.src, ["score.png"])
+        self.assertEqual(self.cache.fetch("k", self.dir), "line 1\nline 2\n",
+                         "")
+        self.cache.begin("l").close()
+        self.cache.discard("l")
+        self.assertEqual(os.listdir(self.cache.cacheDir), ["k"], "")
+
+    def testEvict (self):
+        self.write(self.src, "score.png", "x" * 400)
+        for key in ("a", "b", "c"):
+            self.cache.store(key, self.src, ["score.png"], "")
+            # make the entries distinctly older than the next ones
+            os.utime(os.path.join(self.cache.cacheDir, key),
+                     (ord(key), ord(key)))
+        self.cache.fetch("a", self.dir)
+        self.cache.store("d", self.src, ["score.png"], "")
+        self.assertEqual(sorted(os.listdir(self.cache.cacheDir)),
+                         ["a", "c", "d"], "")
+
+class FiltersTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def makeFrameWriter (self, scrollNotes = True, width = 100):
+        frameWriter = VideoFrameWriter(29.97,(255,0,0),384,
+                                       [0,100,384,500,768,1000,1100,1536],
+                                       [(0,60.0),(500,100.0),(1100,45.0)])
+        image = Image.new("RGB",(400,40),(255,255,255))
+        for x in range(20, 380) : image.putpixel((x,20),(0,0,0))
+        frameWriter.scoreImage = ScoreImage(width,16,image,
+                                            [30,60,61,150,200,200,330],
+                                            [], 10, 20, scrollNotes)
+        frameWriter.compile()
+        return frameWriter
+
+    def readCommands (self, path):
+        commands = []
+        with open(path) as f:
+            for line in f:
+                secs, target, command, arg = line.rstrip(";\n").split(" ")
+                commands.append((float(secs), target, command, arg))
+        return commands
+
+    def testEscapeFilterValue (self):
+        self.assertEqual(escapeFilterValue("/tmp/a:b"), "/tmp/a\\\\:b", "")
+        self.assertEqual(escapeFilterValue("a,b"), "a\\,b", "")
+
+    def testFfmpegColor (self):
+        self.assertEqual(ffmpegColor((255,0,16)), "0xff0010@1.0000", "")
+        self.assertEqual(ffmpegColor((255,0,16,51)), "0xff0010@0.2000", "")
+
+    def testScrollNotesGraph (self):
+        frameWriter = self.makeFrameWriter()
+        commandsPath = os.path.join(self.dir, "scroll.cmd")
+        graph = scrollNotesGraph(frameWriter.scoreImage,
+                                 frameWriter.timecode, frameWriter.fps,
+                                 commandsPath)
+        self.assertTrue("pad=w=iw+100:h=ih:x=50:y=0" in graph, graph)
+        self.assertTrue("crop@scroll=w=100:" in graph, graph)
+        self.assertTrue("drawbox=x=50:y=0:w=2:" in graph, graph)
+        viewports = frameWriter.scoreImage.frameViewports
+        frames = self.emulateCommands(self.readCommands(commandsPath),
+                                      frameWriter.fps, len(viewports))
+        for n, (index, left, right, cursorX) in enumerate(viewports):
+            self.assertEqual(frames[n]["crop@scroll", "x"], left + 50,
+                             "frame %d" % n)
+
+    def testScrollNotesGraph_withOddWidth (self):
+        frameWriter = self.makeFrameWriter(width = 101)
+        graph = scrollNotesGraph(frameWriter.scoreImage,
+                                 frameWriter.timecode, frameWriter.fps,
+                                 os.path.join(self.dir, "scroll.cmd"))
+        self.assertTrue("pad=w=iw+101:h=ih:x=50:y=0" in graph, graph)
+        self.assertTrue("crop@scroll=w=101:" in graph, graph)
+        self.assertTrue("drawbox=x=50:y=0:w=2:" in graph, graph)
+        for index, left, right, cursorX in \
+                frameWriter.scoreImage.frameViewports:
+            self.assertEqual(right - left, 101, "")
+
+    def testScrollNotesGraph_withoutCursor (self):
+        frameWriter = self.makeFrameWriter()
+        frameWriter.scoreImage._ScoreImage__noteCursor = False
+        graph = scrollNotesGraph(frameWriter.scoreImage,
+                                 frameWriter.timecode, frameWriter.fps,
+                                 os.path.join(self.dir, "scroll.cmd"))
+        self.assertFalse("drawbox" in graph, graph)
+
+    def emulateCommands (self, commands, fps, frameCount):
+        """
+        Returns the value of every argument of every target in every
+        frame, as set by the commands.
+        """
+        values = {}
+        frames = []
+        for n in xrange(frameCount):
+            for secs, target, command, arg in commands:
+                if secs <= n / fps:
+                    values[target, command] = arg
+            # the frames are timestamped like loopFilters() does
+            variables = {"t": round(n / fps, 6),
+                         "round": lambda v: int(round(v))}
+            frames.append(dict((key, eval(arg, variables))
+                               for key, arg in values.items()))
+        return frames
+
+    def testPageRuns (self):
+        frameWriter = self.makeFrameWriter(False)
+        runs = pageRuns(frameWriter.scoreImage)
+        viewports = frameWriter.scoreImage.frameViewports
+        self.assertTrue(len(runs) > 1, runs)
+        self.assertEqual(runs[0][0], 0, "")
+        self.assertEqual(runs[-1][1], len(viewports), "")
+        for (start, end, left, right), nextRun in zip(runs, runs[1:] + [None]):
+            if nextRun:
+                self.assertEqual(end, nextRun[0], "")
+            for index, frameLeft, frameRight, cursorX in viewports[start:end]:
+                self.assertEqual((frameLeft, frameRight), (left, right), "")
+
+    def testCursorPagesGraph (self):
+        frameWriter = self.makeFrameWriter(False)
+        commandsPath = os.path.join(self.dir, "cursor.cmd")
+        graph = cursorPagesGraph(frameWriter.scoreImage,
+                                 frameWriter.timecode, frameWriter.fps,
+                                 commandsPath)
+        self.assertTrue("overlay@cursor=" in graph, graph)
+        viewports = frameWriter.scoreImage.frameViewports
+        firstLeft = viewports[0][1]
+        self.assertTrue("crop@page=w=100:h=ih:x=%d:" % firstLeft in graph,
+                        graph)
+        frames = self.emulateCommands(self.readCommands(commandsPath),
+                                      frameWriter.fps, len(viewports))
+        for n, (index, left, right, cursorX) in enumerate(viewports):
+            self.assertEqual(frames[n]["overlay@cursor", "x"], cursorX,
+                             "frame %d" % n)
+            self.assertEqual(frames[n].get(("crop@page", "x"), firstLeft),
+                             left, "frame %d" % n)
+
+    def testCursorPagesGraph_withMeasureCursor (self):
+        frameWriter = self.makeFrameWriter(False)
+        measures = [20, 100, 180, 260, 390]
+        scoreImage = frameWriter.scoreImage
+        scoreImage._ScoreImage__measuresXpositions = measures
+        frameWriter.compile()
+        commandsPath = os.path.join(self.dir, "cursor.cmd")
+        graph = cursorPagesGraph(scoreImage, frameWriter.timecode,
+                                 frameWriter.fps, commandsPath)
+        self.assertTrue("drawbox@measure=" in graph, graph)
+        viewports = scoreImage.frameViewports
+        frames = self.emulateCommands(self.readCommands(commandsPath),
+                                      frameWriter.fps, len(viewports))
+        timecode = frameWriter.timecode
+        for n, (index, left, right, cursorX) in enumerate(viewports):
+            timecode.goToNote(timecode.frameAt(n)[0])
+            measure = scoreImage._ScoreImage__currentMeasureIndex
+            self.assertEqual(scoreImage.frameMeasures[n], measure, "")
+            start = measures[measure] - (index - cursorX)
+            end = measures[measure + 1] - (index - cursorX)
+            self.assertEqual((frames[n]["drawbox@measure", "x"],
+                              frames[n]["drawbox@measure", "w"]),
+                             (start, end - start), "frame %d" % n)
+
+    def testCursorPagesGraph_withoutCursor (self):
+        frameWriter = self.makeFrameWriter(False)
+        frameWriter.scoreImage._ScoreImage__noteCursor = False
+        commandsPath = os.path.join(self.dir, "cursor.cmd")
+        graph = cursorPagesGraph(frameWriter.scoreImage,
+                                 frameWriter.timecode, frameWriter.fps,
+                                 commandsPath)
+        self.assertFalse("overlay" in graph, graph)
+        self.assertEqual(set(target for secs, target, command, arg in
+                             self.readCommands(commandsPath)),
+                         set(["crop@page"]), "")
+        # a single page needs no command, and ffmpeg refuses a sendcmd
+        # filter without any
+        frameWriter = self.makeFrameWriter(False, width = 400)
+        frameWriter.scoreImage._ScoreImage__noteCursor = False
+        graph = cursorPagesGraph(frameWriter.scoreImage,
+                                 frameWriter.timecode, frameWriter.fps,
+                                 commandsPath)
+        self.assertFalse("sendcmd" in graph, graph)
+
+    def renderWithFfmpeg (self, frameWriter):
+        """
+        Renders the frames of the frameWriter with ffmpeg, as
+        renderWithFfmpeg() does, and returns their raw RGB data.
+        """
+        scoreImage = frameWriter.scoreImage
+        stripPath = os.path.join(self.dir, "strip.png")
+        writeScoreStrip(scoreImage, stripPath)
+        commandsPath = os.path.join(self.dir, "commands.cmd")
+        if scoreImage.scrollNotes:
+            graph = scrollNotesGraph(scoreImage, frameWriter.timecode,
+                                     frameWriter.fps, commandsPath)
+        else:
+            graph = cursorPagesGraph(scoreImage, frameWriter.timecode,
+                                     frameWriter.fps, commandsPath)
+        frameCount = frameWriter.timecode.frameCount
+        output = subprocess.check_output([
+            "ffmpeg", "-v", "error",
+            "-i", stripPath,
+            "-filter_complex", graph,
+            "-frames:v", str(frameCount),
+            "-r", str(frameWriter.fps),
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-"])
+        size = frameWriter.width * frameWriter.height * 3
+        return [output[i:i + size] for i in xrange(0, len(output), size)]
+
+    def assertRendersLikePython (self, frameWriter):
+        frames = [frame.tobytes() for frame in
+                  frameWriter.renderFrames(0, frameWriter.timecode.frameCount)]
+        rendered = self.renderWithFfmpeg(frameWriter)
+        self.assertEqual(len(rendered), len(frames), "")
+        for n, (frame, expected) in enumerate(zip(rendered, frames)):
+            self.assertTrue(frame == expected, "frame %d" % n)
+
+    @unittest.skipUnless(find_executable("ffmpeg"), "ffmpeg is missing")
+    def testFfmpegRendering_scrollNotes (self):
+        self.assertRendersLikePython(self.makeFrameWriter())
+
+    @unittest.skipUnless(find_executable("ffmpeg"), "ffmpeg is missing")
+    def testFfmpegRendering_noteCursor (self):
+        self.assertRendersLikePython(self.makeFrameWriter(False))
+
+    @unittest.skipUnless(find_executable("ffmpeg"), "ffmpeg is missing")
+    def testFfmpegRendering_measureCursor (self):
+        frameWriter = self.makeFrameWriter(False)
+        frameWriter.scoreImage._ScoreImage__measuresXpositions = \
+            [20, 100, 180, 260, 390]
+        frameWriter.compile()
+        self.assertRendersLikePython(frameWriter)
+
+    @unittest.skipUnless(find_executable("ffmpeg"), "ffmpeg is missing")
+    def testFfmpegRendering_withoutCursor (self):
+        frameWriter = self.makeFrameWriter(False)
+        frameWriter.scoreImage._ScoreImage__noteCursor = False
+        self.assertRendersLikePython(frameWriter)
+
+class ColorMedia (Media):
+
+    def __init__ (self, width, height, colors):
+        Media.__init__(self, width, height)
+        self.colors = colors
+        self.madeFrames = 0
+
+    def frameKey (self, numFrame, among):
+        return self.colors[numFrame]
+
+    def makeFrame (self, numFrame, among):
+        self.madeFrames += 1
+        return Image.new("RGB", (self.width, self.height),
+                         self.colors[numFrame])
+
+class FrameCompositorTest (unittest.TestCase):
+
+    def testCompose_stacksMedias (self):
+        bottom = ColorMedia(4, 2, [(255,0,0)])
+        top = ColorMedia(2, 3, [(0,0,255)])
+        frame = FrameCompositor(4, 5, [bottom, top]).compose(0, 1)
+        self.assertEqual(frame.getpixel((3,4)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((3,3)), (255,0,0), "")
+        self.assertEqual(frame.getpixel((1,2)), (0,0,255), "")
+        self.assertEqual(frame.getpixel((1,0)), (0,0,255), "")
+        self.assertEqual(frame.getpixel((3,0)), (255,255,255), "")
+
+    def testCompose_skipsUnchangedFrames (self):
+        black, white = (0,0,0), (255,255,255)
+        media = ColorMedia(4, 4, [black, black, black, white, black])
+        compositor = FrameCompositor(4, 4, [media])
+        frames = [compositor.compose(numFrame, 5).getpixel((0,0))
+                  for numFrame in range(5)]
+        self.assertEqual(frames, media.colors, "")
+        # only the first frame of each buffer and the white frame are
+        # different from the frame composed two frames before
+        self.assertEqual(media.madeFrames, 3, "")
+
+class ListFrameSink (FrameSink):
+
+    def __init__ (self):
+        self.frames = []
+
+    def write (self, frame):
+        self.frames.append(frame.tobytes())
+
+class RepeatingFrameSink (ListFrameSink):
+
+    def __init__ (self):
+        ListFrameSink.__init__(self)
+        self.lastWritten = None
+
+    def write (self, frame):
+        self.lastWritten = len(self.frames)
+        ListFrameSink.write(self, frame)
+
+    def repeat (self, frame):
+        self.frames.append(self.frames[-1])
+
+class FrameSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runDir = tempfile.mkdtemp()
+        setRunDir(self.runDir)
+        os.mkdir(tmpPath())
+        self.frame = Image.new("RGB",(16,16),(255,255,255))
+
+    def tearDown(self):
+        setRunDir("")
+        shutil.rmtree(self.runDir)
+
+    def testPngFrameSink (self):
+        sink = PngFrameSink()
+        sink.open(16, 16, 30.0)
+        sink.write(self.frame)
+        sink.write(self.frame)
+        sink.close()
+        self.assertTrue(os.path.exists(tmpPath("notes", "frame0.png")))
+        self.assertTrue(os.path.exists(tmpPath("notes", "frame1.png")))
+
+    def testPngFrameSink_withRepeats (self):
+        sink = PngFrameSink()
+        sink.open(16, 16, 30.0)
+        sink.write(self.frame)
+        sink.repeat(self.frame)
+        sink.repeat(self.frame)
+        sink.write(self.frame)
+        sink.repeat(self.frame)
+        sink.close()
+        self.assertEqual(sorted(os.listdir(tmpPath("notes"))),
+                         ["frame0.png", "frame3.png", "frame4.png"], "")
+        with open(tmpPath("notes.txt")) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, [
+            "file '%s'" % tmpPath("notes", "frame0.png"),
+            "duration 0.100000",
+            "file '%s'" % tmpPath("notes", "frame3.png"),
+            "duration 0.033333",
+            "file '%s'" % tmpPath("notes", "frame4.png"),
+        ], "")
+
+    def testPipeFrameSink_withDeadEncoder (self):
+        sink = PipeFrameSink("true", tmpPath("notes.mpg"))
+        sink.open(16, 16, 30.0)
+        sink._PipeFrameSink__process.wait()
+        with self.assertRaises(SystemExit) as cm:
+            sink.write(self.frame)
+        self.assertEqual(cm.exception.code, 15)
+
+    def testWrite_withPngFrameSink (self):
+        frameWriter = VideoFrameWriter(30.0,(255,0,0),384,[0,384,768],[(0,60.0)])
+        image = Image.new("RGB",(100,40),(255,255,255))
+        for x in range(100) : image.putpixel((x,20),(0,0,0))
+        frameWriter.scoreImage = ScoreImage(16,16,image, [0,10,20], [], scrollNotes = True)
+        frameWriter.write(PngFrameSink())
+        self.assertEqual(frameWriter.frameNum, 30)
+        self.assertEqual(len(os.listdir(tmpPath("notes"))), 30)
+
+    def testWrite_withWorkers (self):
+        def render(workers, scrollNotes):
+            sink = ListFrameSink()
+            frameWriter = self.makeFrameWriter(workers,
+                                               scrollNotes = scrollNotes)
+            frameWriter.write(sink)
+            return sink.frames
+        for scrollNotes in (False, True):
+            serial = render(1, scrollNotes)
+            self.assertEqual(len(serial), 75)
+            self.assertEqual(render(3, scrollNotes), serial)
+
+    def makeFrameWriter (self, workers = 1, noteCursor = True,
+                         scrollNotes = False):
+        frameWriter = VideoFrameWriter(30.0,(255,0,0),384,
+                                       [0,384,768,960,1536],[(0,60.0)],
+                                       workers)
+        frameWriter.chunkFrames = 7
+        image = Image.new("RGB",(400,40),(255,255,255))
+        for x in range(20, 380) : image.putpixel((x,20),(0,0,0))
+        frameWriter.scoreImage = ScoreImage(100,16,image,
+                                            [40,120,200,250,300], [], 10, 20,
+                                            scrollNotes, noteCursor)
+        return frameWriter
+
+    def testSegmentBounds (self):
+        frameWriter = self.makeFrameWriter()
+        self.assertEqual(frameWriter.segmentBounds(1), [(0,75)], "")
+        # the notes start at frames 0, 30, 60 and 75
+        self.assertEqual(frameWriter.segmentBounds(2), [(0,30),(30,75)], "")
+        self.assertEqual(frameWriter.segmentBounds(3),
+                         [(0,30),(30,60),(60,75)], "")
+        self.assertEqual(frameWriter.segmentBounds(10),
+                         [(0,30),(30,60),(60,75)], "")
+
+    def testWriteSegments (self):
+        frameWriter = self.makeFrameWriter()
+        sink = ListFrameSink()
+        frameWriter.write(sink)
+        for workers in (1, 3):
+            frameWriter = self.makeFrameWriter(workers)
+            segments = [(start, end, ListFrameSink()) for start, end in
+                        frameWriter.segmentBounds(2)]
+            frameWriter.writeSegments(segments)
+            self.assertEqual(frameWriter.frameNum, 75, "")
+            self.assertEqual(segments[0][2].frames + segments[1][2].frames,
+                             sink.frames, "")
+
+    def testWriteSegments_withPipeFrameSinks (self):
+        ffmpeg = tmpPath("ffmpeg")
+        with open(ffmpeg, "w") as f:
+            f.write('#!/bin/sh\ncat > /dev/null\n')
+        os.chmod(ffmpeg, 0755)
+        frameWriter = self.makeFrameWriter()
+        sink = ListFrameSink()
+        frameWriter.write(sink)
+        frameWriter = self.makeFrameWriter()
+        segments = [(start, end,
+                     PipeFrameSink(ffmpeg, tmpPath("notes%d.mkv" % start),
+                                   firstFrame = start))
+                    for start, end in frameWriter.segmentBounds(2)]
+        frameWriter.writeSegments(segments)
+        # the last frame of the first segment is saved once the second
+        # segment has been rendered into the same buffers
+        for frameNum in (0, 29, 30, 74):
+            image = Image.open(tmpPath("notes", "frame%d.png" % frameNum))
+            self.assertEqual(image.convert("RGB").tobytes(),
+                             sink.frames[frameNum], "")
+
+    def testDuplicateFrames (self):
+        frameWriter = self.makeFrameWriter(noteCursor = False)
+        frameWriter.compile()
+        duplicates = frameWriter.duplicateFrames()
+        self.assertEqual(len(duplicates), 75, "")
+        self.assertFalse(duplicates[0], "")
+        # without a cursor, only the page changes
+        self.assertTrue(duplicates.sum() > 60, "")
+        # the cursor moves on every frame
+        frameWriter = self.makeFrameWriter()
+        frameWriter.compile()
+        self.assertFalse(frameWriter.duplicateFrames().any(), "")
+
+    def testWriteSegments_droppingDuplicates (self):
+        frameWriter = self.makeFrameWriter(noteCursor = False)
+        sink = ListFrameSink()
+        frameWriter.write(sink)
+        for workers in (1, 3):
+            frameWriter = self.makeFrameWriter(workers, noteCursor = False)
+            frameWriter.dropDuplicates = True
+            segments = [(start, end, RepeatingFrameSink()) for start, end in
+                        frameWriter.segmentBounds(2)]
+            frameWriter.writeSegments(segments)
+            self.assertEqual(segments[0][2].frames + segments[1][2].frames,
+                             sink.frames, "")
+
+    def testWriteSegments_droppingDuplicates_withDefaultRepeat (self):
+        frameWriter = self.makeFrameWriter(noteCursor = False)
+        sink = ListFrameSink()
+        frameWriter.write(sink)
+        frameWriter = self.makeFrameWriter(noteCursor = False)
+        frameWriter.dropDuplicates = True
+        segments = [(start, end, ListFrameSink()) for start, end in
+                    frameWriter.segmentBounds(2)]
+        frameWriter.writeSegments(segments)
+        self.assertEqual(segments[0][2].frames + segments[1][2].frames,
+                         sink.frames, "")
+
+
+    def testWriteSegments_droppingDuplicates_keepsDurations (self):
+        frameWriter = self.makeFrameWriter(noteCursor = False)
+        frameWriter.dropDuplicates = True
+        segments = [(start, end, RepeatingFrameSink()) for start, end in
+                    frameWriter.segmentBounds(3)]
+        frameWriter.writeSegments(segments)
+        # every written frame lasts until the next one, and the final
+        # repeats are encoded for real
+        durations = [(sink.lastWritten + 1 + sink.finalRepeats) / 30.0
+                     for start, end, sink in segments]
+        self.assertTrue(any(sink.finalRepeats
+                            for start, end, sink in segments), "")
+        for (start, end, sink), duration in zip(segments, durations):
+            self.assertAlmostEqual(duration, (end - start) / 30.0)
+        self.assertAlmostEqual(sum(durations),
+                               frameWriter.timecode.frameCount / 30.0)
+
+    def testPipeFrameSink_withFinalRepeats (self):
+        ffmpeg = tmpPath("ffmpeg")
+        with open(ffmpeg, "w") as f:
+            f.write('#!/bin/sh\necho "$@" > %s\ncat > /dev/null\n' %
+                    tmpPath("args.txt"))
+        os.chmod(ffmpeg, 0755)
+        sink = PipeFrameSink(ffmpeg, tmpPath("notes.mkv"),
+                             variableRate = True)
+        sink.finalRepeats = 2
+        sink.open(16, 16, 30.0)
+        sink.write(self.frame)
+        sink.repeat(self.frame)
+        sink.repeat(self.frame)
+        sink.close()
+        with open(tmpPath("args.txt")) as f:
+            args = f.read().split()
+        self.assertEqual(args[args.index("-vf") + 1],
+                         "mpdecimate=hi=0:lo=0:frac=0:max=0,"
+                         "tpad=stop=2:stop_mode=clone", "")
+
+
+class SpaceTimeParserTest (unittest.TestCase):
+
+    def grobLine (self, left, right, moment, fileName, lineNum, column):
+        return "ly2video: (%23.16f, %23.16f) @ %23.16f from %s:%3d:%d\n" % \
+            (left, right, moment, fileName, lineNum, column)
+
+    def barLine (self, left, right, moment):
+        return "ly2videoBar: (%23.16f, %23.16f) @ %23.16f\n" % \
+            (left, right, moment)
+
+    def xcoord (self, left, right):
+        return int(round(staffSpacesToPixels((left + right) / 2, 110))) + 30
+
+    def grobs (self, parser):
+        return [(moment, x, (location.filename,) + location.coords())
+                for moment, x, location in parser.leftmostGrobs()]
+
+    def testLeftmostGrobs (self):
+        parser = SpaceTimeParser(110, 30)
+        for line in [self.grobLine(10.0, 12.0, 0.25, "a.ly", 3, 4),
+                     self.grobLine(2.0, 4.0, 0.0, "a.ly", 1, 2),
+                     # further left at the same moment
+                     self.grobLine(8.0, 9.0, 0.25, "b.ly", 7, 8),
+                     # further right at the same moment
+                     self.grobLine(20.0, 21.0, 0.25, "a.ly", 5, 6)]:
+            self.assertTrue(parser.feed(line), line)
+        self.assertEqual(self.grobs(parser), [
+            (0.0, self.xcoord(2.0, 4.0), ("a.ly", 0, 2)),
+            (0.25, self.xcoord(8.0, 9.0), ("b.ly", 6, 8)),
+        ], "")
+
+    def testMeasuresXpositions (self):
+        parser = SpaceTimeParser(110, 30)
+        for line in [self.barLine(30.0, 30.5, 1.0),
+                     self.barLine(10.0, 10.5, 0.5),
+                     # the same bar line printed for every staff
+                     self.barLine(10.0, 10.5, 0.5)]:
+            self.assertTrue(parser.feed(line), line)
+        self.assertEqual(parser.measuresXpositions(),
+                         [30, self.xcoord(10.0, 10.5),
+                          self.xcoord(30.0, 30.5)], "")
+
+    def testFeed_passesOtherLinesThrough (self):
+        parser = SpaceTimeParser(110, 30)
+        for line in ["GNU LilyPond 2.18.2\n",
+                     "Processing `sanitised.ly'\n",
+                     "warning: ly2video: not data\n",
+                     "ly2videoBarline\n",
+                     "\n"]:
+            self.assertFalse(parser.feed(line), line)
+        self.assertEqual(parser.measuresXpositions(), [30], "")
+
+    def bufferedParse (self, output):
+        """
+        Parses the whole output at once, the way ly2video did before
+        it was parsed while printed.
+        """
+        leftmostGrobs = {}
+        bars = [30]
+        for line in output.split("\n"):
+            m = re.match("^ly2video:\\s+\\(\\s*(-?\\d+\\.\\d+),"
+                         "\\s*(-?\\d+\\.\\d+)\\s*\\)\\s+@\\s+"
+                         "(-?\\d+\\.\\d+)\\s+from\\s+"
+                         "([^:]+): *(\\d+):(\\d+)$", line)
+            if m:
+                left, right, moment, fileName, lineNum, column = m.groups()
+                x = self.xcoord(float(left), float(right))
+                moment = float(moment)
+                if moment not in leftmostGrobs or \
+                        x < leftmostGrobs[moment][0]:
+                    leftmostGrobs[moment] = \
+                        (x, (fileName, int(lineNum) - 1, int(column)))
+            m = re.match("^ly2videoBar:\\s+\\(\\s*(-?\\d+\\.\\d+),"
+                         "\\s*(-?\\d+\\.\\d+)\\s*\\)\\s+@\\s+"
+                         "(-?\\d+\\.\\d+)$", line)
+            if m:
+                x = self.xcoord(float(m.group(1)), float(m.group(2)))
+                if x not in bars:
+                    bars.append(x)
+        grobs = [(moment,) + leftmostGrobs[moment]
+                 for moment in sorted(leftmostGrobs)]
+        return grobs, sorted(bars)
+
+    def testSafeRunLines_matchesBufferedParse (self):
+        random.seed(1)
+        lines = ["GNU LilyPond 2.18.2\n"]
+        for i in xrange(2000):
+            left = random.uniform(-1.0, 400.0)
+            right = left + random.uniform(0.0, 3.0)
+            moment = random.randrange(200) / 8.0
+            if random.random() < 0.1:
+                lines.append(self.barLine(left, right, moment))
+            elif random.random() < 0.1:
+                lines.append("Interpreting music...[%d]\n" % i)
+            else:
+                lines.append(self.grobLine(left, right, moment,
+                                           random.choice(["a.ly", "b.ly"]),
+                                           random.randrange(1, 500),
+                                           random.randrange(80)))
+        output = "".join(lines)
+        outputDir = tempfile.mkdtemp()
+        try:
+            outputPath = os.path.join(outputDir, "output.txt")
+            with open(outputPath, "w") as f:
+                f.write(output)
+            parser = SpaceTimeParser(110, 30)
+            passedThrough = []
+            def handleLine(line):
+                if not parser.feed(line):
+                    passedThrough.append(line)
+            safeRunLines(["cat", outputPath], handleLine)
+        finally:
+            shutil.rmtree(outputDir)
+        grobs, bars = self.bufferedParse(output)
+        self.assertEqual(self.grobs(parser), grobs, "")
+        self.assertEqual(parser.measuresXpositions(), bars, "")
+        self.assertEqual(passedThrough,
+                         [line for line in lines
+                          if not line.startswith("ly2video")], "")
+
+
+class PitchedLocation (object):
+
+    def __init__ (self, pitch, token):
+        self.filename = "score.ly"
+        self.lineNum = 0
+        self.columnNum = 0
+        self.pitch = pitch
+        self.token = token
+
+    def getAbsolutePitch (self):
+        return (self.pitch, self.token)
+
+class NoteOn (object):
+
+    def __init__ (self, pitch):
+        self.pitch = pitch
+        self.length = 1
+
+    def get_pitch (self):
+        return self.pitch
+
+class GetNoteIndicesTest (unittest.TestCase):
+
+    def setUp(self):
+        self.grobs = [
+            (0.0, 10, PitchedLocation(60, "c")),
+            (0.25, 20, PitchedLocation(62, "d")),
+            # the right-hand side of a tie
+            (0.5, 30, PitchedLocation(62, "d")),
+            (0.75, 40, PitchedLocation(65, "f")),
+            # <c e g>
+            (1.0, 50, PitchedLocation(60, "c")),
+            (1.25, 60, PitchedLocation(None, "q")),
+        ]
+        self.midiTicks = [0, 384, 600, 1152, 1536, 1920, 2304]
+        self.notesInTicks = {
+            0: [NoteOn(60)],
+            384: [NoteOn(62)],
+            # a hidden note
+            600: [NoteOn(72)],
+            1152: [NoteOn(67)],
+            1536: [NoteOn(64), NoteOn(60), NoteOn(67)],
+            # the other notes of the repeated chord are tied
+            1920: [NoteOn(60)],
+        }
+
+    def align (self):
+        return getNoteIndices(self.grobs, 384, self.midiTicks,
+                              self.notesInTicks, {})
+
+    def testAlignment (self):
+        alignment = self.align()
+        self.assertEqual(alignment.noteIndices, [10, 20, 50, 60], "")
+        self.assertEqual(alignment.midiTicks, [0, 384, 1536, 1920, 2304], "")
+        self.assertEqual(alignment.keepTicks,
+                         [True, True, False, False, True, True, True], "")
+        self.assertEqual(alignment.pairs, [(0,0), (1,1), (4,4), (5,5)], "")
+        self.assertEqual(alignment.skips, [
+            (SKIP_TICK_WITHOUT_GROB, None, 2),
+            (SKIP_GROB_WITHOUT_TICK, 2, None),
+            (SKIP_PITCH_MISMATCH, 3, 3),
+        ], "")
+
+    def testAlignment_leavesArgumentsUntouched (self):
+        grobs = list(self.grobs)
+        midiTicks = list(self.midiTicks)
+        self.align()
+        self.assertEqual(self.grobs, grobs, "")
+        self.assertEqual(self.midiTicks, midiTicks, "")
+
+    def testAlignment_repeatedChordHasLowestPitch (self):
+        # a repeated chord only matches the lowest note of the chord
+        # before it, whatever the order of the MIDI events
+        self.notesInTicks[1536].reverse()
+        self.assertEqual(self.align().pairs[-1], (5,5), "")
+
+    def testAlignment_repeatedChordWithoutChord (self):
+        self.grobs[4] = (1.0, 50, PitchedLocation(60, "c"))
+        self.notesInTicks[1536] = [NoteOn(60)]
+        self.assertRaises(SystemExit, self.align)
+
+
+class AudioJobTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.midiPath = os.path.join(self.dir, "score.midi")
+        with open(self.midiPath, "w") as f:
+            f.write("MThd")
+        self.timidity = self.script("timidity",
+                                    'cp "$1" "$(basename "$1" .midi).wav"')
+        # the output file comes last
+        self.ffmpeg = self.script("ffmpeg",
+                                  'for arg; do :; done; echo "$*" > "$arg"')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def script (self, name, command):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n%s\n" % command)
+        os.chmod(path, 0755)
+        return path
+
+    def testJoin (self):
+        job = AudioJob(self.timidity, self.ffmpeg, self.midiPath,
+                       ["-c:a", "flac"])
+        audioPath = job.join()
+        self.assertEqual(audioPath, os.path.join(self.dir, "score.mka"), "")
+        with open(audioPath) as f:
+            self.assertEqual(f.read().split(),
+                             ["-i", os.path.join(self.dir, "score.wav"),
+                              "-c:a", "flac", audioPath], "")
+
+    def testJoin_withFailingEncoder (self):
+        job = AudioJob(self.timidity, self.script("ffmpeg", "exit 1"),
+                       self.midiPath, [])
+        with self.assertRaises(SystemExit) as cm:
+            job.join()
+        self.assertEqual(cm.exception.code, 11)
+
 
 if __name__ == "__main__":
     unittest.main()